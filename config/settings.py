@@ -127,4 +127,145 @@ import os
 STATIC_URL = 'static/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
-]
\ No newline at end of file
+]
+# RAG設定
+# ロード済みベクトルストアのキャッシュ(メモリ予算はディスク上のサイズで見積もる)
+RAG_VECTORSTORE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RAG_VECTORSTORE_CACHE_MAX_ENTRIES = 32
+
+# Visionによる画像説明文生成(同時実行数、1秒あたりのリクエスト上限(0で無制限)、429/5xxの再試行回数)
+RAG_VISION_MODEL = 'gpt-4o'
+RAG_VISION_MAX_WORKERS = 8
+RAG_VISION_RATE_LIMIT = 0
+RAG_VISION_MAX_RETRIES = 5
+
+# 画像説明文の永続キャッシュ(画像のハッシュ、プロンプト、モデルがキー)
+RAG_CAPTION_CACHE_ENABLED = True
+RAG_CAPTION_CACHE_PATH = os.path.join(BASE_DIR, 'cache', 'captions.sqlite3')
+RAG_CAPTION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# 取り込みジョブのワーカー(python manage.py run_ingest_workers)
+RAG_INGEST_WORKERS = 2
+RAG_INGEST_POLL_INTERVAL = 2.0
+# 処理中のジョブのリース(秒)。この間ハートビートが無いジョブは他のワーカーが取り直す
+RAG_INGEST_LEASE_SECONDS = 300
+
+# インデックス作成時のベクトルの永続キャッシュ(モデルとテキストのハッシュがキー)
+RAG_EMBEDDING_CACHE_ENABLED = True
+RAG_EMBEDDING_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'embeddings')
+RAG_EMBEDDING_BATCH_SIZE = 256
+
+# 回答キャッシュ(マニュアルごと。完全一致と、質問ベクトルのコサイン類似度がしきい値以上の近似一致)
+RAG_ANSWER_CACHE_ENABLED = True
+RAG_ANSWER_CACHE_TTL = 24 * 60 * 60
+RAG_ANSWER_CACHE_MAX_ENTRIES = 256
+RAG_ANSWER_CACHE_MAX_SCOPES = 64
+RAG_ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+
+# Vision付きPDF解析で一度に読み込むページ数(画像はこの範囲の分だけメモリに保持する)
+RAG_PDF_PAGE_WINDOW = 16
+
+# ハイブリッド検索(ベクトル検索とBM25をReciprocal Rank Fusionで統合)
+RAG_HYBRID_VECTOR_WEIGHT = 1.0
+RAG_HYBRID_SPARSE_WEIGHT = 1.0
+RAG_HYBRID_RRF_K = 60
+RAG_HYBRID_FETCH_MULTIPLIER = 4
+RAG_SEARCH_THREADS = 8
+
+# FAISSインデックスの種類('flat', 'ivf_flat', 'ivf_pq', 'hnsw')と作成時のパラメータ(nlist, m, nbits, M など)
+# 検索時の精度と速度は RAG_INDEX_NPROBE(IVF系)と RAG_INDEX_EF_SEARCH(HNSW)で調整する。
+# 選び方は python manage.py benchmark_index で recall@k と検索時間を比較できる。
+RAG_INDEX_TYPE = 'flat'
+RAG_INDEX_PARAMS = {}
+RAG_INDEX_NPROBE = 8
+RAG_INDEX_EF_SEARCH = 64
+
+# 全マニュアルを1つのFAISSインデックスにまとめる共有インデックス(マニュアルごとの行の範囲だけを検索する)
+# 有効にすると新しく取り込んだマニュアルは共有インデックスに追加される。
+# 既存のマニュアルは python manage.py import_vectorstores で移行し、
+# 削除で溜まった行は python manage.py compact_shared_index で回収する。
+RAG_SHARED_INDEX_ENABLED = False
+RAG_SHARED_INDEX_DIR = os.path.join(BASE_DIR, 'vectorstores', 'shared')
+
+# ベクトルストアのdocstoreの保存形式。'sqlite' はチャンクを検索時に1件ずつ読み、pickleを使わない。
+# 既存のpickle形式のベクトルストアも読み込めるが、python manage.py convert_docstores で変換できる。
+RAG_DOCSTORE_FORMAT = 'sqlite'
+
+# PDFのダウンロードキャッシュ(内容のハッシュで保存し、ETag/Last-Modifiedで再検証する)
+RAG_DOWNLOAD_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'downloads')
+RAG_DOWNLOAD_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+RAG_DOWNLOAD_TIMEOUT = 30
+RAG_DOWNLOAD_POOL_SIZE = 8
+
+# 取扱説明書のPDFの検索('google' または 'fixture')。fixture は記録済みの検索結果を使う(ネットワーク不要)
+# 候補には並列にHEADリクエストを送り、PDFとして取得できるものを順位付けする。結果はクエリごとにTTLの間キャッシュする。
+RAG_DISCOVERY_BACKEND = 'google'
+RAG_DISCOVERY_FIXTURE_PATH = os.path.join(BASE_DIR, 'cache', 'discovery_fixture.json')
+RAG_DISCOVERY_CACHE_PATH = os.path.join(BASE_DIR, 'cache', 'discovery.sqlite3')
+RAG_DISCOVERY_CACHE_TTL = 7 * 24 * 60 * 60
+RAG_DISCOVERY_NUM_RESULTS = 5
+RAG_DISCOVERY_PROBE_WORKERS = 8
+RAG_DISCOVERY_PROBE_TIMEOUT = 5
+RAG_DISCOVERY_MIN_BYTES = 20 * 1024
+RAG_DISCOVERY_MAX_BYTES = 200 * 1024 * 1024
+RAG_DISCOVERY_MAX_ATTEMPTS = 3
+
+# パイプラインの計測(/metrics でPrometheus形式で出力)。RAG_METRICS_LOG を有効にすると段階ごとにJSONのログを出す
+RAG_METRICS_ENABLED = True
+RAG_METRICS_LOG = False
+# /metrics を見られるのは、スタッフのユーザー、RAG_METRICS_ALLOWED_IPS のアドレスからのアクセス、
+# RAG_METRICS_TOKEN を設定した場合は Authorization: Bearer <トークン> を付けたアクセスだけ
+RAG_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+RAG_METRICS_TOKEN = os.getenv('RAG_METRICS_TOKEN', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'ragapp.metrics': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# python manage.py benchmark_pipeline --save-baseline NAME で保存するベースラインの置き場所
+RAG_BENCHMARK_BASELINE_DIR = os.path.join(BASE_DIR, 'benchmarks')
+# benchmark_pipeline が tiktoken のトークナイザーをキャッシュするディレクトリ(環境変数 TIKTOKEN_CACHE_DIR が優先)
+RAG_TIKTOKEN_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'tiktoken')
+
+# Vision取り込みでのチャンクの分け方('structured' または 'recursive')
+# structured は見出し単位の親セクションと小さな子チャンクを作り、検索した子チャンクを予算内で親セクションに広げる
+RAG_CHUNKING = 'structured'
+RAG_CHILD_CHUNK_SIZE = 400
+RAG_CHILD_CHUNK_OVERLAP = 50
+RAG_PARENT_MAX_CHARS = 4000
+# プロンプトに入れる検索結果のトークン数の上限(回答生成のモデルのトークナイザーで数える)
+RAG_CONTEXT_TOKEN_BUDGET = 1500
+RAG_LLM_MODEL = 'gpt-3.5-turbo'
+
+# 検索結果の圧縮。質問に関係の深い文だけを選び、チャンクをまたいだほぼ同じ文を除いて、トークン数の予算内に収める
+# MIN_SCORE は最も関係の深い文の点数に対する割合、DEDUP_THRESHOLD は同じ文とみなす文字3-gramのJaccard係数
+RAG_COMPRESSION_ENABLED = True
+RAG_COMPRESSION_TOKEN_BUDGET = 1000
+RAG_COMPRESSION_MIN_SCORE = 0.2
+RAG_COMPRESSION_DEDUP_THRESHOLD = 0.8
+
+# ベクトルストアの掃除(python manage.py gc_vectorstores、または run_ingest_workers で RAG_GC_INTERVAL 秒ごと。0で無効)
+# 使われていないディレクトリと一時ファイルは RAG_GC_GRACE_SECONDS 秒より古いものを削除し、
+# ベクトルストアの合計が RAG_VECTORSTORE_QUOTA_BYTES を超えた場合は、最後に使われた時刻が古いものから削除する(Noneで無制限)
+RAG_VECTORSTORE_QUOTA_BYTES = 10 * 1024 * 1024 * 1024
+RAG_GC_GRACE_SECONDS = 60 * 60
+RAG_GC_INTERVAL = 0
+# 最後に使われた時刻をDBに記録する間隔(秒)
+RAG_ACCESS_TOUCH_INTERVAL = 60
+
+# Webサーバーのプロセスの起動時に、バックグラウンドでOpenAIのクライアントと
+# 最近使われたマニュアルのベクトルストア(RAG_WARMUP_MANUALS 件)を読み込む
+RAG_WARMUP_ENABLED = False
+RAG_WARMUP_MANUALS = 5
+
+# 複数の質問にまとめて回答するAPI(/api/manuals/<id>/batch/)と python manage.py answer_questions
+# APIで1回に受け付ける質問数の上限(コマンドには適用しない)
+RAG_BATCH_MAX_QUESTIONS = 100
+RAG_BATCH_LLM_CONCURRENCY = 8
@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# ragapp の起動時のウォームアップは、Webサーバーのプロセスでだけ行う
+os.environ['RAG_SERVER_PROCESS'] = '1'
 
 application = get_wsgi_application()
@@ -0,0 +1,158 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+
+def normalize_question(question: str) -> str:
+    """
+    質問文を比較用に正規化する関数(全角半角の統一、小文字化、空白と末尾の記号の除去)。
+    """
+    text = unicodedata.normalize('NFKC', question).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?？!！。.、, ')
+
+
+class _Entry:
+    def __init__(self, answer, vector, expires_at):
+        self.answer = answer
+        self.vector = vector
+        self.expires_at = expires_at
+
+
+class _Scope:
+    def __init__(self, version):
+        self.version = version
+        self.entries = OrderedDict()
+
+
+class AnswerCache:
+    """
+    マニュアルごとの回答キャッシュ。
+    正規化した質問文の完全一致と、質問のベクトルのコサイン類似度による近似一致の2段階で引く。
+    スコープ(ベクトルストア)のバージョンが変わると、そのスコープのエントリは全て破棄される。
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_scopes: int, threshold: float):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.threshold = threshold
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _get_scope(self, scope_key, version, create=False):
+        scope = self._scopes.get(scope_key)
+        if scope is not None and scope.version != version:
+            del self._scopes[scope_key]
+            scope = None
+        if scope is None and create:
+            scope = self._scopes[scope_key] = _Scope(version)
+            while len(self._scopes) > self.max_scopes:
+                self._scopes.popitem(last=False)
+        if scope is not None:
+            self._scopes.move_to_end(scope_key)
+        return scope
+
+    def _purge_expired(self, scope, now):
+        expired = [key for key, entry in scope.entries.items() if entry.expires_at <= now]
+        for key in expired:
+            del scope.entries[key]
+
+    def get_exact(self, scope_key, version, normalized_question):
+        with self._lock:
+            scope = self._get_scope(scope_key, version)
+            if scope is None:
+                return None
+            entry = scope.entries.get(normalized_question)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del scope.entries[normalized_question]
+                return None
+            scope.entries.move_to_end(normalized_question)
+            self.exact_hits += 1
+            return entry.answer
+
+    def get_similar(self, scope_key, version, vector):
+        """
+        コサイン類似度がしきい値以上で最も近い質問の回答を返す。無ければNoneを返す。
+        """
+        query = _unit(vector)
+        with self._lock:
+            scope = self._get_scope(scope_key, version)
+            if scope is None:
+                self.misses += 1
+                return None
+            self._purge_expired(scope, time.monotonic())
+            if not scope.entries:
+                self.misses += 1
+                return None
+            keys = list(scope.entries.keys())
+            matrix = np.vstack([scope.entries[key].vector for key in keys])
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            scope.entries.move_to_end(keys[best])
+            self.semantic_hits += 1
+            return scope.entries[keys[best]].answer
+
+    def put(self, scope_key, version, normalized_question, vector, answer):
+        with self._lock:
+            scope = self._get_scope(scope_key, version, create=True)
+            scope.entries[normalized_question] = _Entry(answer, _unit(vector), time.monotonic() + self.ttl)
+            scope.entries.move_to_end(normalized_question)
+            while len(scope.entries) > self.max_entries:
+                scope.entries.popitem(last=False)
+
+    def invalidate(self, scope_key):
+        with self._lock:
+            self._scopes.pop(scope_key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'scopes': len(self._scopes),
+                'entries': sum(len(scope.entries) for scope in self._scopes.values()),
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+            }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """
+    プロセス全体で共有するAnswerCacheを返す関数。設定で無効化されている場合はNoneを返す。
+    """
+    global _cache
+    if not getattr(settings, 'RAG_ANSWER_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnswerCache(
+                    ttl=getattr(settings, 'RAG_ANSWER_CACHE_TTL', 24 * 60 * 60),
+                    max_entries=getattr(settings, 'RAG_ANSWER_CACHE_MAX_ENTRIES', 256),
+                    max_scopes=getattr(settings, 'RAG_ANSWER_CACHE_MAX_SCOPES', 64),
+                    threshold=getattr(settings, 'RAG_ANSWER_CACHE_SIMILARITY_THRESHOLD', 0.95),
+                )
+    return _cache
@@ -1,6 +1,31 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+
+def _serves_requests() -> bool:
+    """
+    Webサーバーのプロセスかどうか。config/asgi.py と config/wsgi.py が設定する環境変数 RAG_SERVER_PROCESS と、
+    manage.py runserver だけをWebサーバーとみなす。テスト、管理コマンド、ワーカーなどでは False を返す。
+    """
+    if os.environ.get('RAG_SERVER_PROCESS') == '1':
+        return True
+    if os.path.basename(sys.argv[0]) == 'manage.py' and len(sys.argv) > 1 and sys.argv[1] == 'runserver':
+        # 自動リロードでは、リクエストを処理するのは子プロセスだけ
+        return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+    return False
 
 
 class RagappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'ragapp'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+
+        if getattr(settings, 'RAG_WARMUP_ENABLED', False) and _serves_requests():
+            from .warmup import start_warm_up
+
+            start_warm_up()
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+
+def caption_cache_key(image_bytes: bytes, prompt: str, model: str) -> str:
+    """
+    画像のバイト列、プロンプト、モデル名からキャッシュキーを作る関数。
+    """
+    h = hashlib.sha256()
+    h.update(model.encode('utf-8'))
+    h.update(b'\0')
+    h.update(prompt.encode('utf-8'))
+    h.update(b'\0')
+    h.update(image_bytes)
+    return h.hexdigest()
+
+
+class CaptionCache:
+    """
+    画像の説明文をSQLiteに保存する永続キャッシュ。
+    保存済みの説明文の合計サイズがmax_bytesを超えた場合、最後に使われた時刻が古いものから削除する。
+    """
+
+    def __init__(self, db_path: str, max_bytes: int):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, description TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+        self._conn.commit()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        キーに対応する説明文をまとめて取得し、{キー: 説明文} を返す。
+        """
+        if not keys:
+            return {}
+        found = {}
+        now = time.time()
+        with self._lock:
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, description FROM captions WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                self._conn.executemany(
+                    "UPDATE captions SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+                )
+                self._conn.commit()
+        return found
+
+    def set_many(self, items: dict):
+        """
+        {キー: 説明文} を保存し、必要であれば古いものを削除する。
+        """
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO captions (key, description, size, last_used) VALUES (?, ?, ?, ?)",
+                [(key, text, len(text.encode('utf-8')), now) for key, text in items.items()],
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM captions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM captions ORDER BY last_used").fetchall()
+        to_delete = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM captions WHERE key = ?", to_delete)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_caption_cache():
+    """
+    プロセス全体で共有するCaptionCacheを返す関数。設定で無効化されている場合はNoneを返す。
+    """
+    global _cache
+    if not getattr(settings, 'RAG_CAPTION_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CaptionCache(
+                    db_path=str(getattr(settings, 'RAG_CAPTION_CACHE_PATH',
+                                        os.path.join(settings.BASE_DIR, 'cache', 'captions.sqlite3'))),
+                    max_bytes=getattr(settings, 'RAG_CAPTION_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                )
+    return _cache
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import sqlite3
+import statistics
+
+from django.conf import settings
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+from .tokens import count_tokens
+
+PARENTS_NAME = 'parents.sqlite3'
+
+
+def extract_text_blocks(page) -> list:
+    """
+    PyMuPDFのページからテキストのブロックを読み順に取り出し、見出しと本文に分ける関数。
+    ページ内の本文の文字サイズ(中央値)より十分大きい短い行、または太字の短い行を見出しとみなす。
+    戻り値は {'type': 'heading' または 'text', 'text': ...} のリスト。
+    """
+    blocks = []
+    for block in page.get_text('dict')['blocks']:
+        if block.get('type') != 0:
+            continue
+        spans = [span for line in block['lines'] for span in line['spans'] if span['text'].strip()]
+        if not spans:
+            continue
+        text = "\n".join("".join(span['text'] for span in line['spans']) for line in block['lines']).strip()
+        blocks.append({
+            'text': text,
+            'size': max(span['size'] for span in spans),
+            'bold': all(span['flags'] & 16 for span in spans),
+        })
+    if not blocks:
+        return []
+
+    body_size = statistics.median(block['size'] for block in blocks)
+    result = []
+    for block in blocks:
+        short = len(block['text']) <= 80 and '\n' not in block['text']
+        is_heading = short and (block['size'] >= body_size * 1.2 or (block['bold'] and block['size'] >= body_size))
+        result.append({'type': 'heading' if is_heading else 'text', 'text': block['text']})
+    return result
+
+
+class StructuredChunker:
+    """
+    ページごとのブロック(見出し・本文・図の説明)から、見出し単位の親セクションと、検索用の小さな子チャンクを作る。
+    子チャンクには page, heading, parent_id(図の場合は figure_id も)をメタデータとして付ける。
+    親セクションが max_parent_chars を超える場合は、同じ見出しの続きとして分ける。
+    """
+
+    def __init__(self, child_size: int = None, child_overlap: int = None, max_parent_chars: int = None):
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=child_size or getattr(settings, 'RAG_CHILD_CHUNK_SIZE', 400),
+            chunk_overlap=child_overlap if child_overlap is not None else getattr(settings, 'RAG_CHILD_CHUNK_OVERLAP', 50),
+        )
+        self.max_parent_chars = max_parent_chars or getattr(settings, 'RAG_PARENT_MAX_CHARS', 4000)
+        self._heading_counts = {}
+
+    def split(self, page_blocks, on_parent):
+        """
+        (ページ番号, ブロックのリスト) のイテラブルから子チャンクのDocumentを順に返すジェネレータ。
+        親セクションができるたびに on_parent(parent_id, heading, pages, text) を呼ぶ。
+        """
+        section = None
+        for page, blocks in page_blocks:
+            for block in blocks:
+                if block['type'] == 'heading':
+                    yield from self._close(section, on_parent)
+                    section = self._new_section(block['text'])
+                    continue
+                if section is None:
+                    section = self._new_section('')
+                elif section['blocks'] and section['chars'] + len(block['text']) > self.max_parent_chars:
+                    yield from self._close(section, on_parent)
+                    section = self._new_section(section['heading'])
+                section['blocks'].append((page, block))
+                section['chars'] += len(block['text'])
+        yield from self._close(section, on_parent)
+
+    def _new_section(self, heading: str) -> dict:
+        # 同じ見出しが何回目に出てきたかでIDを決めるため、内容が変わっても同じ見出しは同じIDになる
+        ordinal = self._heading_counts.get(heading, 0)
+        self._heading_counts[heading] = ordinal + 1
+        parent_id = hashlib.sha256(f"{heading}\0{ordinal}".encode('utf-8')).hexdigest()[:16]
+        return {'id': parent_id, 'heading': heading, 'blocks': [], 'chars': 0}
+
+    def _close(self, section, on_parent):
+        if section is None or not section['blocks']:
+            return
+        heading = section['heading']
+        pages = sorted({page for page, _ in section['blocks']})
+        parts = [heading] if heading else []
+        for page, block in section['blocks']:
+            if block['type'] == 'figure':
+                parts.append(f"[図 {block['figure_id']} の説明]\n{block['text']}")
+            else:
+                parts.append(block['text'])
+        on_parent(section['id'], heading, pages, "\n\n".join(parts))
+
+        # 同じページの本文はまとめて分割し、図の説明はそれぞれ別のチャンクにする
+        metadata = {'parent_id': section['id'], 'heading': heading}
+        pending_page, pending_texts = None, []
+        for page, block in section['blocks'] + [(None, None)]:
+            if pending_texts and (block is None or block['type'] == 'figure' or page != pending_page):
+                yield from self._children("\n".join(pending_texts), dict(metadata, page=pending_page), heading)
+                pending_texts = []
+            if block is None:
+                break
+            if block['type'] == 'figure':
+                yield from self._children(block['text'], dict(metadata, page=page, figure_id=block['figure_id']), heading)
+            else:
+                pending_page = page
+                pending_texts.append(block['text'])
+
+    def _children(self, text: str, metadata: dict, heading: str):
+        for piece in self.splitter.split_text(text):
+            yield Document(page_content=f"{heading}\n{piece}" if heading else piece, metadata=metadata)
+
+
+class ParentStoreWriter:
+    """
+    親セクションをSQLiteに書き出す。一時ファイルに書いてから commit() で置き換える。
+    """
+
+    def __init__(self, vectorstore_dir: str):
+        os.makedirs(vectorstore_dir, exist_ok=True)
+        self.path = os.path.join(vectorstore_dir, PARENTS_NAME)
+        self.tmp_path = f"{self.path}.tmp"
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self._conn = sqlite3.connect(self.tmp_path)
+        self._conn.execute(
+            "CREATE TABLE parents (parent_id TEXT PRIMARY KEY, heading TEXT NOT NULL, pages TEXT NOT NULL, text TEXT NOT NULL)"
+        )
+
+    def add(self, parent_id: str, heading: str, pages: list, text: str):
+        self._conn.execute("INSERT OR REPLACE INTO parents (parent_id, heading, pages, text) VALUES (?, ?, ?, ?)",
+                           (parent_id, heading, json.dumps(pages), text))
+
+    def commit(self):
+        self._conn.commit()
+        self._conn.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        書きかけの一時ファイルを削除する。commit() の後に呼んでも何もしない。
+        """
+        self._conn.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def remove_parent_store(vectorstore_dir: str):
+    """
+    構造化チャンクを使わずに作り直す場合に、古い親セクションを削除する関数。
+    """
+    path = os.path.join(vectorstore_dir, PARENTS_NAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class ParentStore:
+    """
+    保存された親セクションをIDで読み出す。
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    @classmethod
+    def load(cls, vectorstore_dir: str):
+        """
+        親セクションを読み込む。無い場合(構造化チャンクを使わないベクトルストア)はNoneを返す。
+        """
+        path = os.path.join(vectorstore_dir, PARENTS_NAME)
+        return cls(path) if os.path.exists(path) else None
+
+    def get_many(self, parent_ids: list) -> dict:
+        if not parent_ids:
+            return {}
+        placeholders = ','.join('?' * len(parent_ids))
+        rows = self._conn.execute(
+            f"SELECT parent_id, heading, pages, text FROM parents WHERE parent_id IN ({placeholders})", parent_ids
+        ).fetchall()
+        return {
+            parent_id: Document(page_content=text, metadata={'parent_id': parent_id, 'heading': heading,
+                                                             'pages': json.loads(pages)})
+            for parent_id, heading, pages, text in rows
+        }
+
+
+def expand_to_parents(parents: ParentStore, docs: list, token_budget: int = None) -> list:
+    """
+    検索された子チャンクを、トークン数の予算内で親セクションに広げる関数。
+    順位の高い子チャンクから順に、親セクションが予算に収まれば親を、収まらなければ子チャンク自体を使う。
+    同じ親の子チャンクは1つにまとめる。
+    """
+    token_budget = token_budget or getattr(settings, 'RAG_CONTEXT_TOKEN_BUDGET', 1500)
+    parent_docs = parents.get_many(list({doc.metadata['parent_id'] for doc in docs if doc.metadata.get('parent_id')}))
+    result = []
+    used_parents = set()
+    remaining = token_budget
+    for doc in docs:
+        parent_id = doc.metadata.get('parent_id')
+        if parent_id in used_parents:
+            continue
+        parent = parent_docs.get(parent_id)
+        if parent is not None:
+            tokens = count_tokens(parent.page_content)
+            if tokens <= remaining:
+                result.append(parent)
+                used_parents.add(parent_id)
+                remaining -= tokens
+                continue
+        tokens = count_tokens(doc.page_content)
+        if tokens <= remaining:
+            result.append(doc)
+            remaining -= tokens
+    return result
@@ -0,0 +1,142 @@
+import math
+import re
+import unicodedata
+
+from django.conf import settings
+from langchain_core.documents import Document
+
+from .sparse_index import tokenize
+from .tokens import count_tokens, get_encoding
+
+# 文末の記号の直後、または改行で文を区切る
+_SENTENCE_BREAK = re.compile(r'(?<=[。！？!?])|\n+')
+# 「[ページ 3 のテキスト]」のような、チャンクの出どころを示す行
+_HEADER_LINE = re.compile(r'^\[[^\]]+\]$')
+
+
+def split_sentences(text: str) -> list:
+    return [sentence.strip() for sentence in _SENTENCE_BREAK.split(text) if sentence and sentence.strip()]
+
+
+def _shingles(text: str, n: int = 3) -> set:
+    text = re.sub(r'\s+', '', unicodedata.normalize('NFKC', text).lower())
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class _Sentence:
+    def __init__(self, doc_index: int, position: int, text: str, header: bool):
+        self.doc_index = doc_index
+        self.position = position
+        self.text = text
+        self.header = header
+        self.tokens = count_tokens(text)
+        self.shingles = _shingles(text)
+        self.score = 0.0
+
+
+def _is_header(doc: Document, position: int, sentence: str) -> bool:
+    return position == 0 and (sentence == doc.metadata.get('heading') or bool(_HEADER_LINE.match(sentence)))
+
+
+def _score_sentences(sentences: list, query: str):
+    """
+    質問との語(英数字の語と日本語の文字bigram)の重なりで文に点数を付ける。
+    候補の文の中で珍しい語ほど重く数え、検索順位の高いチャンクの文を少し優先する。
+    """
+    query_terms = set(tokenize(query))
+    terms = [set(tokenize(sentence.text)) & query_terms for sentence in sentences]
+    document_frequency = {}
+    for matched in terms:
+        for term in matched:
+            document_frequency[term] = document_frequency.get(term, 0) + 1
+    for sentence, matched in zip(sentences, terms):
+        overlap = sum(math.log(1 + len(sentences) / document_frequency[term]) for term in matched)
+        sentence.score = overlap / (1 + math.log(1 + sentence.tokens)) + 0.1 / (sentence.doc_index + 1)
+
+
+def _assemble(docs: list, chosen: list) -> list:
+    by_doc = {}
+    for sentence in sorted(chosen, key=lambda s: (s.doc_index, s.position)):
+        by_doc.setdefault(sentence.doc_index, []).append(sentence.text)
+    result = []
+    for doc_index, texts in sorted(by_doc.items()):
+        content = texts[0]
+        for text in texts[1:]:
+            # 日本語の文は続けて書き、それ以外は改行で区切る
+            content += text if content[-1] in '。！？' else f"\n{text}"
+        result.append(Document(page_content=content, metadata=docs[doc_index].metadata))
+    return result
+
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    encoding = get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    # 文字の途中で切れたバイト列は置換文字になるため取り除く
+    return encoding.decode(tokens[:max_tokens]).rstrip('\ufffd')
+
+
+def compress_documents(docs: list, query: str, token_budget: int = None) -> list:
+    """
+    検索されたチャンクから質問に関係の深い文だけを選び、トークン数の予算内に収めたDocumentのリストを返す関数。
+    チャンクをまたいでほぼ同じ文(文字3-gramのJaccard係数が閾値以上)は1つにまとめる。
+    質問と重なる語を含む文が無い場合は、検索順位の順に予算まで詰める。
+    予算に収まる文が無い場合は、最も点数の高い文を予算のトークン数で切り詰めて返す。
+    チャンクの出どころを示す1行目(見出しやページ番号)は、そのチャンクの文を使う場合に残す。
+    """
+    token_budget = token_budget or getattr(settings, 'RAG_COMPRESSION_TOKEN_BUDGET', 1000)
+    min_score = getattr(settings, 'RAG_COMPRESSION_MIN_SCORE', 0.2)
+    dedup_threshold = getattr(settings, 'RAG_COMPRESSION_DEDUP_THRESHOLD', 0.8)
+
+    sentences = []
+    for doc_index, doc in enumerate(docs):
+        for position, text in enumerate(split_sentences(doc.page_content)):
+            sentences.append(_Sentence(doc_index, position, text, _is_header(doc, position, text)))
+    body = [sentence for sentence in sentences if not sentence.header]
+    if not body:
+        return docs
+    _score_sentences(body, query)
+    headers = {sentence.doc_index: sentence for sentence in sentences if sentence.header}
+
+    best = max(sentence.score for sentence in body)
+    # 語の重なりが無い文は、順位による点数(最大0.1)しか持たない
+    if best > 0.1:
+        candidates = [sentence for sentence in body if sentence.score >= best * min_score]
+    else:
+        candidates = body
+    candidates.sort(key=lambda s: (-s.score, s.doc_index, s.position))
+
+    chosen = []
+    remaining = token_budget
+    for sentence in candidates:
+        if any(_jaccard(sentence.shingles, other.shingles) >= dedup_threshold for other in chosen):
+            continue
+        header = headers.get(sentence.doc_index)
+        cost = sentence.tokens + 1
+        if header is not None and header not in chosen:
+            cost += header.tokens + 1
+        if cost > remaining:
+            continue
+        chosen.append(sentence)
+        if header is not None and header not in chosen:
+            chosen.append(header)
+        remaining -= cost
+
+    result = _assemble(docs, chosen)
+    # 区切りの分で予算を超えた場合は、点数の低い文から外す
+    while result and count_tokens("\n\n".join(doc.page_content for doc in result)) > token_budget:
+        chosen.remove(min((s for s in chosen if not s.header), key=lambda s: s.score))
+        chosen = [s for s in chosen if not s.header or any(o.doc_index == s.doc_index and not o.header for o in chosen)]
+        result = _assemble(docs, chosen)
+    if not result:
+        # 予算に収まる文が1つも無い場合は、最も点数の高い文を予算のトークン数で切り詰めて使う
+        top = candidates[0]
+        return [Document(page_content=_truncate_tokens(top.text, token_budget), metadata=docs[top.doc_index].metadata)]
+    return result
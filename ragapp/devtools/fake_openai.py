@@ -0,0 +1,161 @@
+"""
+ローカル検証用のOpenAI互換フェイクサーバー。
+
+    python -m ragapp.devtools.fake_openai --port 8765 --latency 0.5 --fail-rate 0.1
+
+起動後、OPENAI_BASE_URL=http://127.0.0.1:8765/v1 を設定するとアプリからの呼び出しがこのサーバーに向く。
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def fake_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> list:
+    """
+    テキストのハッシュから決まる、長さ1のベクトルを返す関数。同じテキストには常に同じベクトルを返す。
+    """
+    rng = random.Random(hashlib.sha256(text.encode('utf-8')).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    /v1/chat/completions(stream にも対応)と /v1/embeddings に固定形式の応答を返すハンドラ。
+    latency秒待ってから応答し、fail_rateの確率で429か503を返す。
+    """
+    latency = 0.0
+    fail_rate = 0.0
+    request_count = 0
+    _count_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        with self._count_lock:
+            type(self).request_count += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_rate and random.random() < self.fail_rate:
+            status = random.choice([429, 503])
+            self._send_json(status, {'error': {'message': 'fake failure', 'type': 'fake'}}, {'Retry-After': '0'})
+            return
+
+        if self.path.rstrip('/').endswith('/chat/completions'):
+            if payload.get('stream'):
+                self._send_stream(self._chat_completion(payload))
+            else:
+                self._send_json(200, self._chat_completion(payload))
+        elif self.path.rstrip('/').endswith('/embeddings'):
+            self._send_json(200, self._embeddings(payload))
+        else:
+            self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+
+    def _send_stream(self, completion):
+        """
+        チャットの応答を1文字ずつServer-Sent Eventsで返す。
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        content = completion['choices'][0]['message']['content']
+        for i, char in enumerate(content):
+            chunk = {
+                'id': completion['id'], 'object': 'chat.completion.chunk', 'created': completion['created'],
+                'model': completion['model'],
+                'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': char} if i == 0 else {'content': char},
+                             'finish_reason': None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+        final = dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+
+    def _embeddings(self, payload):
+        inputs = payload.get('input', [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = payload.get('dimensions') or EMBEDDING_DIMENSIONS
+        data = []
+        for i, text in enumerate(inputs):
+            # トークンIDの列で送られてきた場合も、その列から決まるベクトルを返す
+            vector = fake_embedding(text if isinstance(text, str) else json.dumps(text), dimensions)
+            if payload.get('encoding_format') == 'base64':
+                vector = base64.b64encode(struct.pack(f'<{len(vector)}f', *vector)).decode('ascii')
+            data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+        return {
+            'object': 'list', 'data': data, 'model': payload.get('model', 'fake'),
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+        }
+
+    def _chat_completion(self, payload):
+        # 同じリクエストには同じ応答を返す
+        digest = hashlib.sha256(json.dumps(payload.get('messages', []), sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        return {
+            'id': f'chatcmpl-fake-{self.request_count}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': f'フェイク応答 {digest}'},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }
+
+
+def run_server(host='127.0.0.1', port=8765, latency=0.0, fail_rate=0.0):
+    """
+    フェイクサーバーをバックグラウンドスレッドで起動し、サーバーオブジェクトを返す関数。
+    """
+    handler = type('ConfiguredFakeOpenAIHandler', (FakeOpenAIHandler,), {'latency': latency, 'fail_rate': fail_rate})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI互換のフェイクサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答までの待ち時間(秒)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='429/503を返す確率')
+    args = parser.parse_args()
+
+    server = run_server(args.host, args.port, args.latency, args.fail_rate)
+    print(f"Fake OpenAI server listening on http://{args.host}:{args.port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
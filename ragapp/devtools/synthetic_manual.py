@@ -0,0 +1,84 @@
+"""
+ベンチマーク用の架空の取扱説明書PDFを作るモジュール。
+
+    python -m ragapp.devtools.synthetic_manual out.pdf --pages 50 --images-per-page 2
+
+同じ引数からは常に同じPDFができる。各ページには見出し、本文、図(ページごとに異なる画像)と、
+全ページ共通のロゴ(同じxrefを使い回す画像)を入れる。
+"""
+import argparse
+import random
+
+import fitz  # PyMuPDF
+
+# 日本語の本文を描画するためのPyMuPDF組み込みフォント
+FONT_NAME = 'japan'
+
+SECTIONS = ['安全上のご注意', '各部の名前', '準備', '基本的な使いかた', '便利な機能', 'お手入れ', '故障かな？と思ったら', '仕様']
+SENTENCES = [
+    '電源プラグは根元まで確実に差し込んでください。',
+    'フィルターは2週間に1回を目安に掃除してください。',
+    '運転中は吹出口に指や棒などを入れないでください。',
+    'リモコンの運転/停止ボタンを押すと運転を開始します。',
+    'エラーコード E-{code:02d} が表示された場合は、販売店にご相談ください。',
+    'タイマーは1時間単位で最大12時間まで設定できます。',
+    '長期間使用しない場合は、電源プラグを抜いてください。',
+    '本体が汚れたときは、柔らかい布で乾拭きしてください。',
+    'お手入れの前には必ず運転を停止し、電源を切ってください。',
+    '設置場所は直射日光の当たらない、風通しのよい場所を選んでください。',
+]
+
+
+def _image_png(rng: random.Random, width=320, height=240) -> bytes:
+    """
+    いくつかの色付きの長方形を描いた画像(PNG)を返す。
+    """
+    pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, width, height), False)
+    pixmap.set_rect(pixmap.irect, (255, 255, 255))
+    for _ in range(6):
+        # ロゴのような小さな画像でも範囲が空にならないようにする
+        x0, y0 = rng.randrange(max(1, width - 40)), rng.randrange(max(1, height - 40))
+        rect = fitz.IRect(x0, y0, x0 + rng.randrange(20, 120), y0 + rng.randrange(20, 120)) & pixmap.irect
+        pixmap.set_rect(rect, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    return pixmap.tobytes('png')
+
+
+def generate_manual(path: str, pages: int, images_per_page: int = 1, seed: int = 0):
+    """
+    架空の取扱説明書PDFを path に保存する関数。
+    """
+    rng = random.Random(seed)
+    doc = fitz.open()
+    logo = _image_png(random.Random(-1), 120, 40)
+    logo_xref = 0
+    for page_num in range(pages):
+        page = doc.new_page(width=595, height=842)  # A4
+        section = SECTIONS[page_num * len(SECTIONS) // max(pages, 1)]
+        if logo_xref:
+            page.insert_image(fitz.Rect(460, 20, 560, 53), xref=logo_xref)
+        else:
+            logo_xref = page.insert_image(fitz.Rect(460, 20, 560, 53), stream=logo)
+        page.insert_text((40, 60), f"{page_num + 1}. {section}", fontname=FONT_NAME, fontsize=16)
+
+        body = ''.join(rng.choice(SENTENCES).format(code=rng.randrange(100)) for _ in range(12))
+        page.insert_textbox(fitz.Rect(40, 80, 555, 420), body, fontname=FONT_NAME, fontsize=10)
+        for i in range(images_per_page):
+            top = 440 + i * (360 // max(images_per_page, 1))
+            height = 360 // max(images_per_page, 1) - 10
+            page.insert_image(fitz.Rect(40, top, 40 + height * 4 / 3, top + height), stream=_image_png(rng))
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用の架空の取扱説明書PDFを作る')
+    parser.add_argument('path')
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--images-per-page', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_manual(args.path, args.pages, args.images_per_page, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+import os
+
+from django.conf import settings
+
+
+def prepare_tokenizer() -> str:
+    """
+    ベンチマーク用に tiktoken のトークナイザーを読み込む関数。読み込みに使ったキャッシュのディレクトリを返す。
+    tiktoken は初回にトークナイザーのファイルをダウンロードするため、TIKTOKEN_CACHE_DIR にキャッシュして
+    2回目以降はネットワーク無しで動くようにする。キャッシュが無くダウンロードもできない場合は RuntimeError にする。
+    """
+    cache_dir = os.environ.setdefault('TIKTOKEN_CACHE_DIR', str(getattr(
+        settings, 'RAG_TIKTOKEN_CACHE_DIR', os.path.join(settings.BASE_DIR, 'cache', 'tiktoken'))))
+    from ragapp.tokens import get_encoding
+
+    try:
+        get_encoding()
+    except Exception as e:
+        raise RuntimeError(f"トークナイザーを読み込めません({e})。ネットワークに接続できる環境で一度実行し、"
+                           f"'{cache_dir}' にキャッシュしてください。") from e
+    return cache_dir
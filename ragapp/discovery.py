@@ -0,0 +1,213 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+PDF_CONTENT_TYPES = ('application/pdf', 'application/x-pdf')
+
+
+class Candidate:
+    """
+    検索で見つかったPDFのURLと、HEADリクエストで確認した情報
+    """
+
+    def __init__(self, url, rank, status=None, content_type='', size=None, error=''):
+        self.url = url
+        self.rank = rank
+        self.status = status
+        self.content_type = content_type
+        self.size = size
+        self.error = error
+
+    @property
+    def score(self) -> float:
+        """
+        候補の良さ。PDFとして取得できないものは負の値になる。
+        """
+        if self.error or self.status is None or self.status >= 400:
+            return -1.0
+        is_pdf = self.content_type.split(';')[0].strip().lower() in PDF_CONTENT_TYPES
+        if not is_pdf and not self.url.lower().split('?')[0].endswith('.pdf'):
+            return -1.0
+        max_bytes = getattr(settings, 'RAG_DISCOVERY_MAX_BYTES', 200 * 1024 * 1024)
+        if self.size is not None and (self.size < getattr(settings, 'RAG_DISCOVERY_MIN_BYTES', 20 * 1024)
+                                      or self.size > max_bytes):
+            return -1.0
+        score = 2.0 if is_pdf else 1.0
+        # 検索順位が高いものを優先する
+        return score + 1.0 / (self.rank + 1)
+
+    def to_dict(self) -> dict:
+        return {'url': self.url, 'rank': self.rank, 'status': self.status, 'content_type': self.content_type,
+                'size': self.size, 'error': self.error}
+
+
+class DiscoveryBackend:
+    """
+    PDFの候補を探す検索バックエンドの基底クラス。search() と probe() を実装する。
+    """
+
+    def search(self, query: str, num_results: int) -> list:
+        raise NotImplementedError
+
+    def probe(self, url: str, rank: int) -> Candidate:
+        """
+        HEADリクエストで候補の状態を確認する。HEADに対応していないサーバーにはGETでヘッダーだけを読む。
+        """
+        from .download_cache import get_http_session
+
+        session = get_http_session()
+        timeout = getattr(settings, 'RAG_DISCOVERY_PROBE_TIMEOUT', 5)
+        try:
+            response = session.head(url, allow_redirects=True, timeout=timeout, verify=False)
+            if response.status_code in (403, 405, 501):
+                with session.get(url, stream=True, timeout=timeout, verify=False) as response:
+                    pass
+        except Exception as e:
+            return Candidate(url, rank, error=str(e))
+        length = response.headers.get('Content-Length')
+        return Candidate(url, rank, status=response.status_code,
+                         content_type=response.headers.get('Content-Type', ''),
+                         size=int(length) if length and length.isdigit() else None)
+
+
+class GoogleSearchBackend(DiscoveryBackend):
+    def search(self, query: str, num_results: int) -> list:
+        from googlesearch import search
+
+        return list(search(query, num_results=num_results, lang="ja",
+                           sleep_interval=getattr(settings, 'RAG_DISCOVERY_SLEEP_INTERVAL', 1)))
+
+
+class FixtureSearchBackend(DiscoveryBackend):
+    """
+    記録済みの検索結果とHEADの結果(JSON)を返すバックエンド。ネットワーク無しでのテストや計測に使う。
+    ファイルの形式: {"searches": {クエリ: [URL, ...]},
+                     "probes": {URL: {"status": ..., "content_type": ..., "size": ..., "error": ...}}}
+    latency を指定すると、検索とHEADのたびにその秒数だけ待つ。
+    """
+
+    def __init__(self, path: str, latency: float = 0.0):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.searches = data.get('searches', {})
+        self.probes = data.get('probes', {})
+        self.latency = latency
+
+    def search(self, query: str, num_results: int) -> list:
+        time.sleep(self.latency)
+        return self.searches.get(query, [])[:num_results]
+
+    def probe(self, url: str, rank: int) -> Candidate:
+        time.sleep(self.latency)
+        probe = self.probes.get(url)
+        if probe is None:
+            return Candidate(url, rank, error='not recorded')
+        return Candidate(url, rank, status=probe.get('status'), content_type=probe.get('content_type', ''),
+                         size=probe.get('size'), error=probe.get('error', ''))
+
+
+class DiscoveryCache:
+    """
+    検索クエリごとの候補の順位をSQLiteに保存するキャッシュ。ttl秒を過ぎたものは使わない。
+    """
+
+    def __init__(self, db_path: str, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS discoveries (query TEXT PRIMARY KEY, candidates TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, query: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT candidates, fetched_at FROM discoveries WHERE query = ?", (query,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return [Candidate(**data) for data in json.loads(row[0])]
+
+    def set(self, query: str, candidates: list):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO discoveries (query, candidates, fetched_at) VALUES (?, ?, ?)",
+                (query, json.dumps([c.to_dict() for c in candidates]), time.time()),
+            )
+            self._conn.commit()
+
+
+def build_query(product_name_raw: str) -> str:
+    return f'"{product_name_raw}" 取扱説明書 filetype:pdf'
+
+
+def discover_pdf_candidates(product_name_raw: str, backend: DiscoveryBackend = None, cache=None,
+                            use_cache: bool = True) -> list:
+    """
+    製品名から取扱説明書のPDFの候補を探し、良い順に並べて返す関数。
+    検索結果の候補には並列にHEADリクエストを送り、PDFとして取得できないものは除く。
+    結果は検索クエリごとにキャッシュする。use_cache=False の場合はキャッシュを読みも書きもしない。
+    """
+    backend = backend or get_discovery_backend()
+    cache = cache if cache is not None else get_discovery_cache()
+    query = build_query(product_name_raw)
+    if use_cache and cache is not None:
+        cached = cache.get(query)
+        if cached is not None:
+            return cached
+
+    urls = backend.search(query, getattr(settings, 'RAG_DISCOVERY_NUM_RESULTS', 5))
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(urls), getattr(settings, 'RAG_DISCOVERY_PROBE_WORKERS', 8))) as pool:
+        probed = list(pool.map(backend.probe, urls, range(len(urls))))
+    candidates = sorted((c for c in probed if c.score >= 0), key=lambda c: c.score, reverse=True)
+    if use_cache and cache is not None and candidates:
+        cache.set(query, candidates)
+    return candidates
+
+
+_backend = None
+_cache = None
+_lock = threading.Lock()
+
+
+def get_discovery_backend() -> DiscoveryBackend:
+    """
+    設定(RAG_DISCOVERY_BACKEND: 'google' または 'fixture')に応じた検索バックエンドを返す関数。
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                if getattr(settings, 'RAG_DISCOVERY_BACKEND', 'google') == 'fixture':
+                    _backend = FixtureSearchBackend(str(settings.RAG_DISCOVERY_FIXTURE_PATH))
+                else:
+                    _backend = GoogleSearchBackend()
+    return _backend
+
+
+def get_discovery_cache():
+    """
+    プロセス全体で共有するDiscoveryCacheを返す関数。TTLが0の場合はNoneを返す。
+    """
+    global _cache
+    ttl = getattr(settings, 'RAG_DISCOVERY_CACHE_TTL', 7 * 24 * 60 * 60)
+    if not ttl:
+        return None
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                _cache = DiscoveryCache(
+                    str(getattr(settings, 'RAG_DISCOVERY_CACHE_PATH',
+                                os.path.join(settings.BASE_DIR, 'cache', 'discovery.sqlite3'))),
+                    ttl,
+                )
+    return _cache
@@ -0,0 +1,147 @@
+import json
+import os
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+import faiss
+from django.conf import settings
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+DOCSTORE_NAME = 'docstore.sqlite3'
+PICKLE_NAME = 'index.pkl'
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+class SQLiteDocstore:
+    """
+    チャンクのテキストとメタデータをSQLiteに置き、IDで引かれたときに1件ずつ読むdocstore。
+    pickleと違って読み込み時に全チャンクを展開しないため、ロード時間とメモリが検索したチャンク数分で済む。
+    LangChainのFAISSからは search(ID) だけが呼ばれる(書き込みには使えない)。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = _connect(path)
+        self._lock = threading.Lock()
+
+    def search(self, doc_id: str):
+        with self._lock:
+            row = self._db.execute("SELECT text, metadata FROM chunks WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            return f"ID {doc_id} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def row_doc_id(self, row: int):
+        with self._lock:
+            result = self._db.execute("SELECT doc_id FROM chunks WHERE row = ?", (row,)).fetchone()
+        return result[0] if result else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def iter_rows(self):
+        """
+        (行番号, ID, Document) を行番号の順に返す。書き込み用に全件を読み込むときに使う。
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT row, doc_id, text, metadata FROM chunks ORDER BY row").fetchall()
+        for row, doc_id, text, metadata in rows:
+            yield row, doc_id, Document(page_content=text, metadata=json.loads(metadata))
+
+
+class LazyIndexToDocstoreId(Mapping):
+    """
+    FAISSの行番号からdocstoreのIDへの対応表。index_to_docstore_id の代わりに、必要な行だけをSQLiteから引く。
+    """
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self._docstore = docstore
+        self._length = None
+
+    def __getitem__(self, row):
+        doc_id = self._docstore.row_doc_id(int(row))
+        if doc_id is None:
+            raise KeyError(row)
+        return doc_id
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._docstore.count()
+        return self._length
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+
+def write_docstore(db, path: str):
+    """
+    FAISSベクトルストアのdocstoreをSQLite形式で書き出す関数。一時ファイルに書いてから置き換える。
+    """
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = _connect(tmp_path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE chunks (row INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        conn.executemany(
+            "INSERT INTO chunks (row, doc_id, text, metadata) VALUES (?, ?, ?, ?)",
+            (
+                (row, doc_id, doc.page_content, json.dumps(doc.metadata, ensure_ascii=False))
+                for row, doc_id in db.index_to_docstore_id.items()
+                for doc in (db.docstore.search(doc_id),)
+            ),
+        )
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+def save_vectorstore(db, vectorstore_dir: str):
+    """
+    FAISSベクトルストアを保存する関数。RAG_DOCSTORE_FORMAT が 'sqlite'(既定)なら
+    index.faiss と docstore.sqlite3 に、'pickle' なら従来どおり save_local で保存する。
+    """
+    os.makedirs(vectorstore_dir, exist_ok=True)
+    if getattr(settings, 'RAG_DOCSTORE_FORMAT', 'sqlite') == 'pickle':
+        db.save_local(vectorstore_dir)
+        docstore_path = os.path.join(vectorstore_dir, DOCSTORE_NAME)
+        if os.path.exists(docstore_path):
+            os.remove(docstore_path)
+        return
+    write_docstore(db, os.path.join(vectorstore_dir, DOCSTORE_NAME))
+    faiss.write_index(db.index, os.path.join(vectorstore_dir, 'index.faiss'))
+    pickle_path = os.path.join(vectorstore_dir, PICKLE_NAME)
+    if os.path.exists(pickle_path):
+        os.remove(pickle_path)
+
+
+def load_vectorstore_dir(vectorstore_dir: str, embeddings, lazy: bool = True):
+    """
+    保存されたFAISSベクトルストアを読み込む関数。
+    SQLite形式なら、lazy=True では検索時にチャンクを1件ずつ読むdocstoreを使う。
+    差分更新や統合など書き込みを行う場合は lazy=False で全件をメモリ上のdocstoreに読み込む。
+    SQLite形式でなければ従来のpickleを読み込む。
+    """
+    docstore_path = os.path.join(vectorstore_dir, DOCSTORE_NAME)
+    if not os.path.exists(docstore_path):
+        return FAISS.load_local(vectorstore_dir, embeddings, allow_dangerous_deserialization=True)
+
+    index = faiss.read_index(os.path.join(vectorstore_dir, 'index.faiss'))
+    docstore = SQLiteDocstore(docstore_path)
+    if lazy:
+        return FAISS(embeddings, index, docstore, LazyIndexToDocstoreId(docstore))
+
+    documents = {}
+    index_to_docstore_id = {}
+    for row, doc_id, doc in docstore.iter_rows():
+        documents[doc_id] = doc
+        index_to_docstore_id[row] = doc_id
+    return FAISS(embeddings, index, InMemoryDocstore(documents), index_to_docstore_id)
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    PDFのダウンロードに使うrequests.Sessionを返す関数。接続はプロセス内で使い回す。
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, 'RAG_DOWNLOAD_POOL_SIZE', 8)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+class DownloadCache:
+    """
+    ダウンロードしたPDFを内容のハッシュで保存する永続キャッシュ。
+    URLごとにETag/Last-Modifiedを記録し、次回は条件付きリクエストで変更があった場合だけ取り直す。
+    同じ内容のPDFは別のURLから取得しても1つのファイルになる。
+    ファイルの合計サイズがmax_bytesを超えた場合、最後に使われた時刻が古いものから削除する。
+    """
+
+    def __init__(self, directory: str, max_bytes: int, timeout: float = 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "url TEXT PRIMARY KEY, content_hash TEXT NOT NULL, etag TEXT, last_modified TEXT, fetched_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "content_hash TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_last_used ON blobs (last_used)")
+        self._conn.commit()
+        self.stats = {'hits': 0, 'revalidated': 0, 'downloads': 0, 'bytes': 0}
+
+    def blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, 'blobs', content_hash[:2], f"{content_hash}.pdf")
+
+    def fetch(self, url: str):
+        """
+        URLのPDFを取得し、(キャッシュ内のファイルのパス, 内容のSHA-256) を返す。
+        返したファイルはキャッシュの一部なので、呼び出し側で削除してはいけない。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content_hash, etag, last_modified FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        headers = {}
+        if row and os.path.exists(self.blob_path(row[0])):
+            if row[1]:
+                headers['If-None-Match'] = row[1]
+            if row[2]:
+                headers['If-Modified-Since'] = row[2]
+
+        with get_http_session().get(url, headers=headers, timeout=self.timeout, verify=False, stream=True) as response:
+            if response.status_code == 304 and row:
+                self.stats['revalidated'] += 1
+                metrics.inc('rag_download_requests_total', result='not_modified')
+                self._touch(url, row[0], response.headers)
+                return self.blob_path(row[0]), row[0]
+            response.raise_for_status()
+            content_hash, size = self._store(response)
+
+        self.stats['downloads'] += 1
+        self.stats['bytes'] += size
+        metrics.inc('rag_download_requests_total', result='downloaded')
+        metrics.inc('rag_download_bytes_total', size)
+        self._touch(url, content_hash, response.headers, size)
+        return self.blob_path(content_hash), content_hash
+
+    def _store(self, response):
+        """
+        レスポンスを少しずつ一時ファイルに書きながらハッシュを計算し、内容のハッシュの名前で保存する。
+        """
+        tmp_path = os.path.join(self.directory, 'blobs', f".tmp-{uuid.uuid4()}")
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+            content_hash = h.hexdigest()
+            blob_path = self.blob_path(content_hash)
+            if os.path.exists(blob_path):
+                self.stats['hits'] += 1
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        return content_hash, size
+
+    def _touch(self, url, content_hash, headers, size=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO urls (url, content_hash, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                (url, content_hash, headers.get('ETag'), headers.get('Last-Modified'), now),
+            )
+            if size is None:
+                self._conn.execute("UPDATE blobs SET last_used = ? WHERE content_hash = ?", (now, content_hash))
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO blobs (content_hash, size, last_used) VALUES (?, ?, ?)",
+                    (content_hash, size, now),
+                )
+            self._evict(keep=content_hash)
+            self._conn.commit()
+
+    def _evict(self, keep):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT content_hash, size FROM blobs ORDER BY last_used").fetchall()
+        for content_hash, size in rows:
+            if total <= self.max_bytes:
+                break
+            # 今回取得したファイルは予算を超えていても残す
+            if content_hash == keep:
+                continue
+            self._conn.execute("DELETE FROM blobs WHERE content_hash = ?", (content_hash,))
+            self._conn.execute("DELETE FROM urls WHERE content_hash = ?", (content_hash,))
+            try:
+                os.remove(self.blob_path(content_hash))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_download_cache() -> DownloadCache:
+    """
+    プロセス全体で共有するDownloadCacheを返す関数。
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DownloadCache(
+                    directory=str(getattr(settings, 'RAG_DOWNLOAD_CACHE_DIR',
+                                          os.path.join(settings.BASE_DIR, 'cache', 'downloads'))),
+                    max_bytes=getattr(settings, 'RAG_DOWNLOAD_CACHE_MAX_BYTES', 1024 * 1024 * 1024),
+                    timeout=getattr(settings, 'RAG_DOWNLOAD_TIMEOUT', 30),
+                )
+    return _cache
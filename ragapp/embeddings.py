@@ -0,0 +1,192 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from . import metrics
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    ベクトルをディスクに保存する永続キャッシュ。
+    ベクトルはfloat32の連続したファイル(.f32)に追記し、memmapで読み出す。
+    キーと行番号の対応はSQLiteに保存する。モデルごとに別のファイルを使う。
+    """
+
+    def __init__(self, directory: str, model: str):
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, re.sub(r'[^A-Za-z0-9_.-]', '_', model))
+        self.vectors_path = base + '.f32'
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(base + '.sqlite3', check_same_thread=False, isolation_level=None)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._mmap = None
+
+    def _meta(self, name):
+        row = self._conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _vectors(self, dim: int, min_rows: int):
+        # 他のプロセスやスレッドが追記した行を読むために、必要であればmemmapを開き直す
+        if self._mmap is None or self._mmap.shape[0] < min_rows or self._mmap.shape[1] != dim:
+            rows = os.path.getsize(self.vectors_path) // (4 * dim)
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, dim))
+        return self._mmap
+
+    def get_many(self, keys: list) -> dict:
+        """
+        キャッシュ済みのベクトルを {キー: np.ndarray} で返す。
+        """
+        if not keys:
+            return {}
+        with self._lock:
+            dim = self._meta('dim')
+            if dim is None:
+                return {}
+            found = {}
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self._conn.execute(
+                    f"SELECT key, row FROM rows WHERE key IN ({placeholders})", batch
+                ).fetchall())
+            if not found:
+                return {}
+            vectors = self._vectors(dim, max(found.values()) + 1)
+            return {key: np.array(vectors[row]) for key, row in found.items()}
+
+    def add_many(self, items: dict):
+        """
+        {キー: ベクトル} を保存する。
+        """
+        if not items:
+            return
+        keys = list(items.keys())
+        matrix = np.asarray([items[key] for key in keys], dtype=np.float32)
+        with self._lock:
+            # BEGIN IMMEDIATE で他のプロセスからの書き込みと直列化する
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                dim = self._meta('dim')
+                if dim is None:
+                    dim = matrix.shape[1]
+                    self._conn.execute("INSERT INTO meta (name, value) VALUES ('dim', ?)", (dim,))
+                elif dim != matrix.shape[1]:
+                    raise ValueError(f"Embedding dimension mismatch: {matrix.shape[1]} != {dim}")
+                start_row = self._meta('rows') or 0
+
+                mode = 'r+b' if os.path.exists(self.vectors_path) else 'wb'
+                with open(self.vectors_path, mode) as f:
+                    f.seek(start_row * dim * 4)
+                    f.write(matrix.tobytes())
+
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO rows (key, row) VALUES (?, ?)",
+                    [(key, start_row + i) for i, key in enumerate(keys)],
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (name, value) VALUES ('rows', ?)", (start_row + len(keys),)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    EmbeddingStoreを使うEmbeddings。
+    キャッシュに無いテキストだけを重複を除いてbatch_size件ずつ元のモデルに送る。
+    statsにはこのインスタンスでのヒット数などが記録される。
+    """
+
+    def __init__(self, base: Embeddings, model: str, store, batch_size: int):
+        self.base = base
+        self.model = model
+        self.store = store
+        self.batch_size = batch_size
+        self.stats = {'texts': 0, 'hits': 0, 'misses': 0, 'api_batches': 0}
+
+    def embed_documents(self, texts: list) -> list:
+        keys = [embedding_cache_key(self.model, text) for text in texts]
+        known = self.store.get_many(keys) if self.store is not None else {}
+
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in known and key not in pending:
+                pending[key] = text
+
+        pending_keys = list(pending.keys())
+        for i in range(0, len(pending_keys), self.batch_size):
+            batch_keys = pending_keys[i:i + self.batch_size]
+            with metrics.span('embedding'):
+                vectors = self.base.embed_documents([pending[key] for key in batch_keys])
+            generated = dict(zip(batch_keys, vectors))
+            if self.store is not None:
+                self.store.add_many(generated)
+            known.update({key: np.asarray(vector, dtype=np.float32) for key, vector in generated.items()})
+            self.stats['api_batches'] += 1
+
+        self.stats['texts'] += len(texts)
+        self.stats['misses'] += len(pending)
+        self.stats['hits'] += len(texts) - len(pending)
+        metrics.inc('rag_embedding_texts_total', len(texts) - len(pending), result='hit')
+        metrics.inc('rag_embedding_texts_total', len(pending), result='miss')
+        return [known[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed_documents([text])[0]
+
+    @property
+    def hit_rate(self) -> float:
+        return self.stats['hits'] / self.stats['texts'] if self.stats['texts'] else 0.0
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store(model: str):
+    if not getattr(settings, 'RAG_EMBEDDING_CACHE_ENABLED', True):
+        return None
+    with _stores_lock:
+        if model not in _stores:
+            directory = str(getattr(settings, 'RAG_EMBEDDING_CACHE_DIR',
+                                    os.path.join(settings.BASE_DIR, 'cache', 'embeddings')))
+            _stores[model] = EmbeddingStore(directory, model)
+        return _stores[model]
+
+
+def get_embeddings() -> CachedEmbeddings:
+    """
+    インデックス作成で使うEmbeddingsを返す関数。
+    キャッシュはプロセス全体で共有し、統計は呼び出しごとに新しく数える。
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    base = OpenAIEmbeddings()
+    return CachedEmbeddings(
+        base=base,
+        model=base.model,
+        store=_get_store(base.model),
+        batch_size=getattr(settings, 'RAG_EMBEDDING_BATCH_SIZE', 256),
+    )
+
+
+def format_embedding_stats(embeddings) -> str:
+    stats = getattr(embeddings, 'stats', None)
+    if not stats:
+        return ""
+    return (f"embedding cache: {stats['hits']}/{stats['texts']} hits "
+            f"({embeddings.hit_rate:.0%}), {stats['api_batches']} API batches")
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from .docstore import load_vectorstore_dir, save_vectorstore
+from .index_factory import apply_index_config, default_index_config, save_index_config, to_flat
+from .sparse_index import save_sparse_index
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_sha256(path: str) -> str:
+    """
+    ファイル内容のSHA-256を返す関数。
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_chunk_ids(source: str, texts: list, seen: dict = None) -> list:
+    """
+    チャンクの内容からIDを作る関数。同じ内容のチャンクは同じIDになる。
+    1つの文書内で同じ内容が複数回出てきた場合は出現順の番号で区別する。
+    文書を分割して渡す場合は、同じ seen を渡し続ける。
+    """
+    seen = {} if seen is None else seen
+    ids = []
+    for text in texts:
+        digest = hashlib.sha256(f"{source}\0{text}".encode('utf-8')).hexdigest()
+        count = seen.get(digest, 0)
+        seen[digest] = count + 1
+        ids.append(digest if count == 0 else f"{digest}-{count}")
+    return ids
+
+
+class IncrementalIndex:
+    """
+    マニフェストを使って差分だけを更新するFAISSベクトルストア。
+    マニフェストには文書(source)ごとに、元ファイルのハッシュとチャンクIDの一覧を記録する。
+    内容が変わっていない文書は読み飛ばし、変わった文書も新しく増えたチャンクだけをベクトル化する。
+    更新はflatインデックスで行い、保存時に index_config の種類(IVFやHNSWなど)に作り直す。
+    """
+
+    def __init__(self, vectorstore_dir: str, embeddings, index_config: dict = None):
+        self.vectorstore_dir = vectorstore_dir
+        self.embeddings = embeddings
+        self.index_config = index_config or default_index_config()
+        self.stats = {'embedded': 0, 'deleted': 0, 'reused': 0, 'skipped_sources': 0}
+        self.manifest = {'version': 1, 'sources': {}}
+        self.db = None
+        self._dirty = False
+
+        manifest_path = os.path.join(vectorstore_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path) and os.path.exists(os.path.join(vectorstore_dir, 'index.faiss')):
+            with open(manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+
+    def _load_db(self):
+        if self.db is None and self.manifest['sources']:
+            self.db = load_vectorstore_dir(self.vectorstore_dir, self.embeddings, lazy=False)
+            to_flat(self.db, self.embeddings)
+        return self.db
+
+    @property
+    def sources(self) -> list:
+        return list(self.manifest['sources'].keys())
+
+    def is_current(self, source: str, source_hash: str) -> bool:
+        """
+        文書が前回と同じ内容で登録済みであればTrueを返す。
+        """
+        entry = self.manifest['sources'].get(source)
+        if entry is not None and entry['hash'] == source_hash:
+            self.stats['skipped_sources'] += 1
+            return True
+        return False
+
+    def update_source(self, source: str, source_hash: str, chunks: list):
+        """
+        文書のチャンクを入れ替える。既に登録されているチャンクはベクトル化し直さない。
+        """
+        return self.update_source_batches(source, source_hash, [chunks])
+
+    def update_source_batches(self, source: str, source_hash: str, chunk_batches) -> int:
+        """
+        update_source と同じだが、チャンクをバッチのイテラブルで受け取り、バッチごとにベクトル化して追加する。
+        文書全体のチャンクを一度にメモリに持たなくてよい。登録したチャンク数を返す。
+        """
+        old_ids = set(self.manifest['sources'].get(source, {}).get('chunks', []))
+        new_ids = []
+        seen = {}
+
+        for chunks in chunk_batches:
+            batch_ids = make_chunk_ids(source, [chunk.page_content for chunk in chunks], seen)
+            new_ids.extend(batch_ids)
+            added = [(chunk_id, chunk) for chunk_id, chunk in zip(batch_ids, chunks) if chunk_id not in old_ids]
+            self._refresh_metadata([(chunk_id, chunk) for chunk_id, chunk in zip(batch_ids, chunks)
+                                    if chunk_id in old_ids])
+            if added:
+                ids = [chunk_id for chunk_id, _ in added]
+                docs = [chunk for _, chunk in added]
+                db = self._load_db()
+                if db is None:
+                    self.db = FAISS.from_documents(docs, self.embeddings, ids=ids)
+                else:
+                    db.add_documents(docs, ids=ids)
+            self.stats['embedded'] += len(added)
+            self.stats['reused'] += len(batch_ids) - len(added)
+
+        new_id_set = set(new_ids)
+        stale_ids = [chunk_id for chunk_id in old_ids if chunk_id not in new_id_set]
+        if stale_ids:
+            self._load_db().delete(stale_ids)
+        self.stats['deleted'] += len(stale_ids)
+
+        self.manifest['sources'][source] = {'hash': source_hash, 'chunks': new_ids}
+        self._dirty = True
+        return len(new_ids)
+
+    def _refresh_metadata(self, reused: list):
+        """
+        再利用するチャンクのメタデータを今回の分割結果で書き換える。
+        チャンクIDは内容だけで決まるため、見出しの位置が変わると親セクションのIDやページ番号が古いまま残る。
+        """
+        if not reused:
+            return
+        db = self._load_db()
+        for chunk_id, chunk in reused:
+            doc = db.docstore.search(chunk_id)
+            if isinstance(doc, Document) and doc.metadata != chunk.metadata:
+                doc.metadata = dict(chunk.metadata)
+
+    def remove_source(self, source: str):
+        if source not in self.manifest['sources']:
+            return
+        db = self._load_db()
+        entry = self.manifest['sources'].pop(source)
+        if entry['chunks']:
+            db.delete(entry['chunks'])
+            self.stats['deleted'] += len(entry['chunks'])
+        self._dirty = True
+
+    def save(self) -> bool:
+        """
+        ベクトルストアとマニフェストを保存する。保存した場合はTrueを返す。
+        ベクトルストアを読み込まずに済んだ(全てのチャンクを再利用した)場合は、マニフェストだけを書き換える。
+        変更が無い場合と、保存するベクトルストアが無い場合はFalseを返す。
+        """
+        if not self._dirty:
+            return False
+        if self.db is not None:
+            os.makedirs(self.vectorstore_dir, exist_ok=True)
+            apply_index_config(self.db, self.index_config, self.embeddings)
+            save_vectorstore(self.db, self.vectorstore_dir)
+            save_index_config(self.vectorstore_dir, self.db)
+            save_sparse_index(self.db, self.vectorstore_dir)
+        elif not os.path.exists(os.path.join(self.vectorstore_dir, 'index.faiss')):
+            return False
+        with open(os.path.join(self.vectorstore_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f)
+        self._dirty = False
+        return True
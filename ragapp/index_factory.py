@@ -0,0 +1,134 @@
+import json
+import math
+import os
+
+import faiss
+import numpy as np
+from django.conf import settings
+
+INDEX_CONFIG_NAME = 'index_config.json'
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def default_index_config() -> dict:
+    return {'type': _setting('RAG_INDEX_TYPE', 'flat'), 'params': dict(_setting('RAG_INDEX_PARAMS', {}))}
+
+
+def build_faiss_index(vectors: np.ndarray, index_type: str, params: dict = None):
+    """
+    ベクトルから指定した種類のFAISSインデックスを作る関数。ベクトルは与えた順に追加する。
+      flat     : 全件の厳密検索
+      ivf_flat : 転置ファイル(nlist個のクラスタ)。検索時は nprobe 個のクラスタだけを見る
+      ivf_pq   : ivf_flat に加えて直積量子化(m個のサブベクトル×nbitsビット)でメモリを削減
+      hnsw     : グラフによる近似検索(M本のリンク)。検索時は efSearch で精度と速度を調整
+    IVF系は訓練用のサンプルが足りない場合、flatで作る。
+    """
+    params = params or {}
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(d, params.get('M', 32))
+        index.hnsw.efConstruction = params.get('ef_construction', 80)
+    elif index_type in ('ivf_flat', 'ivf_pq'):
+        nlist = params.get('nlist') or max(1, int(4 * math.sqrt(n)))
+        # k-meansの訓練にはクラスタ数の数十倍のサンプルが必要
+        if n < nlist * 39 or (index_type == 'ivf_pq' and n < 2 ** params.get('nbits', 8) * 39):
+            print(f"--- Warning: {n} vectors are not enough to train {index_type}. Using flat index. ---")
+            return faiss.IndexFlatL2(d)
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == 'ivf_flat':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            m = params.get('m') or _default_pq_m(d)
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, params.get('nbits', 8))
+        sample_size = min(n, params.get('train_size', max(nlist * 256, 10000)))
+        sample = vectors[np.random.default_rng(0).choice(n, sample_size, replace=False)]
+        index.train(sample)
+        index.nprobe = params.get('nprobe', _setting('RAG_INDEX_NPROBE', 8))
+    elif index_type == 'flat':
+        index = faiss.IndexFlatL2(d)
+    else:
+        raise ValueError(f"Unknown index type: {index_type} (choose from {', '.join(INDEX_TYPES)})")
+
+    index.add(vectors)
+    return index
+
+
+def _default_pq_m(d: int) -> int:
+    # 次元数を割り切れる範囲で、1サブベクトルあたり16次元前後にする
+    for m in (d // 16, 64, 48, 32, 24, 16, 8, 4, 2, 1):
+        if m and d % m == 0:
+            return m
+    return 1
+
+
+def get_index_type(index) -> str:
+    if isinstance(index, faiss.IndexHNSWFlat):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def reconstruct_vectors(db, embeddings=None) -> np.ndarray:
+    """
+    ベクトルストアの全ベクトルを index_to_docstore_id の順に取り出す関数。
+    ivf_pq は量子化されていて元のベクトルに戻せないため、チャンクのテキストを embeddings で
+    ベクトル化し直す(埋め込みキャッシュがあればAPIは呼ばれない)。
+    """
+    index = db.index
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    if get_index_type(index) == 'ivf_pq':
+        if embeddings is None:
+            raise ValueError("ivf_pq index cannot be reconstructed without embeddings")
+        texts = [db.docstore.search(db.index_to_docstore_id[i]).page_content for i in range(index.ntotal)]
+        return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    if get_index_type(index) == 'ivf_flat':
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def to_flat(db, embeddings=None):
+    """
+    ベクトルストアのインデックスをflatに戻す関数。差分更新(削除を含む)はflatの状態で行う。
+    """
+    if get_index_type(db.index) != 'flat':
+        vectors = reconstruct_vectors(db, embeddings)
+        db.index = build_faiss_index(vectors, 'flat')
+    return db
+
+
+def apply_index_config(db, config: dict, embeddings=None):
+    """
+    ベクトルストアのインデックスを config({'type': ..., 'params': {...}})の種類に作り直す関数。
+    """
+    if get_index_type(db.index) == config['type'] == 'flat':
+        return db
+    vectors = reconstruct_vectors(db, embeddings)
+    db.index = build_faiss_index(vectors, config['type'], config.get('params'))
+    return db
+
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """
+    検索時のパラメータ(IVF系の nprobe、HNSWの efSearch)を設定する関数。
+    """
+    index_type = get_index_type(index)
+    if nprobe and index_type in ('ivf_flat', 'ivf_pq'):
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    if ef_search and index_type == 'hnsw':
+        index.hnsw.efSearch = ef_search
+
+
+def save_index_config(vectorstore_dir: str, db):
+    config = {'type': get_index_type(db.index)}
+    with open(os.path.join(vectorstore_dir, INDEX_CONFIG_NAME), 'w', encoding='utf-8') as f:
+        json.dump(config, f)
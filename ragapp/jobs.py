@@ -0,0 +1,367 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import ProcessedManual
+
+
+class IngestError(Exception):
+    """
+    取り込み処理の失敗。メッセージはそのまま画面に表示される。
+    """
+
+
+def _temp_dir():
+    temp_dir = os.path.join(settings.BASE_DIR, 'temp_manuals')
+    os.makedirs(temp_dir, exist_ok=True)
+    return temp_dir
+
+
+def enqueue_product(product_name_raw: str) -> ProcessedManual:
+    """
+    製品名で検索する取り込みジョブを登録する関数。
+    同じ製品のジョブが待機中・処理中であれば、新しく作らずにそのジョブを返す。
+    失敗したものと、容量の上限のためにベクトルストアを削除したものは取り込み直す。
+    """
+    product_name = product_name_raw.lower()
+    with transaction.atomic():
+        manual, created = ProcessedManual.objects.select_for_update().get_or_create(
+            product_name=product_name,
+            defaults={'display_name': product_name_raw, 'status': 'PENDING'},
+        )
+        if manual.status in ('FAILED', 'EVICTED'):
+            manual.status = 'PENDING'
+            manual.progress = 0
+            manual.progress_message = ''
+            manual.error_message = ''
+            manual.save()
+    return manual
+
+
+def enqueue_upload(pdf_file) -> ProcessedManual:
+    """
+    アップロードされたPDFを保存し、取り込みジョブを登録する関数。
+    同じ内容のPDFを取り込み済みであれば、そのベクトルストアを使う完了済みのマニュアルを作る。
+    同じ内容のPDFの取り込みが待機中・処理中であれば、新しく作らずにそのジョブを返す。
+    同じ内容のPDFのベクトルストアを容量の上限のために削除していれば、そのマニュアルで取り込み直す。
+    """
+    upload_id = uuid.uuid4()
+    pdf_path = os.path.join(_temp_dir(), f"{upload_id}_{os.path.basename(pdf_file.name)}")
+    h = hashlib.sha256()
+    with open(pdf_path, 'wb+') as f:
+        for chunk in pdf_file.chunks():
+            f.write(chunk)
+            h.update(chunk)
+    content_hash = h.hexdigest()
+    display_name = f"アップロードされたファイル: {pdf_file.name}"
+
+    existing = find_indexed_manual(content_hash)
+    if existing is not None:
+        os.remove(pdf_path)
+        return ProcessedManual.objects.create(
+            product_name=f"upload:{upload_id}", display_name=display_name, status='COMPLETED',
+            vectorstore_path=existing.vectorstore_path, content_hash=content_hash, size_bytes=existing.size_bytes,
+            progress=100, progress_message='取り込み済みのマニュアルを使います',
+        )
+    pending = ProcessedManual.objects.filter(content_hash=content_hash, status__in=('PENDING', 'RUNNING')).first()
+    if pending is not None:
+        os.remove(pdf_path)
+        return pending
+    evicted = (ProcessedManual.objects.filter(content_hash=content_hash, status='EVICTED', product_name__startswith='upload:')
+               .order_by('-updated_at').first())
+    if evicted is not None:
+        evicted.source_path = pdf_path
+        evicted.status = 'PENDING'
+        evicted.progress = 0
+        evicted.progress_message = ''
+        evicted.error_message = ''
+        evicted.save()
+        return evicted
+    return ProcessedManual.objects.create(
+        product_name=f"upload:{upload_id}",
+        display_name=display_name,
+        source_path=pdf_path,
+        content_hash=content_hash,
+        status='PENDING',
+    )
+
+
+def _lease_seconds() -> float:
+    return getattr(settings, 'RAG_INGEST_LEASE_SECONDS', 300)
+
+
+def claim_next_job():
+    """
+    最も古い待機中のジョブを処理中に変えて返す関数。無ければNoneを返す。
+    状態の更新は条件付きUPDATEで行うため、複数のワーカーが同じジョブを取ることはない。
+    処理中のまま一定時間(RAG_INGEST_LEASE_SECONDS)ハートビートが無いジョブは、
+    ワーカーが落ちたものとみなして取り直す。
+    """
+    now = timezone.now()
+    expired = now - timedelta(seconds=_lease_seconds())
+    candidates = (
+        ProcessedManual.objects.filter(status='PENDING')
+        | ProcessedManual.objects.filter(status='RUNNING', updated_at__lt=expired)
+    )
+    for manual_id, status, updated_at in candidates.order_by('created_at').values_list('id', 'status', 'updated_at')[:10]:
+        # 状態と更新時刻が読んだときのままの場合だけ取る
+        claimed = ProcessedManual.objects.filter(id=manual_id, status=status, updated_at=updated_at).update(
+            status='RUNNING', started_at=now, updated_at=now, progress=0, progress_message='処理を開始しました',
+        )
+        if claimed:
+            if status == 'RUNNING':
+                print(f"--- Ingest job {manual_id}: lease expired, taking over ---")
+            return ProcessedManual.objects.get(id=manual_id)
+    return None
+
+
+def _owned(manual: ProcessedManual):
+    """
+    このワーカーが取ったジョブだけに一致するクエリセット。
+    リースが切れて他のワーカーに取り直された後は、古いワーカーからの更新は反映されない。
+    """
+    return ProcessedManual.objects.filter(id=manual.id, status='RUNNING', started_at=manual.started_at)
+
+
+def update_progress(manual: ProcessedManual, percent: int, message: str):
+    _owned(manual).update(progress=percent, progress_message=message[:255], updated_at=timezone.now())
+
+
+class _Heartbeat:
+    """
+    処理中のジョブの updated_at を定期的に更新し、リースを延長するスレッド。
+    """
+
+    def __init__(self, manual: ProcessedManual):
+        self.manual = manual
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"ingest-heartbeat-{manual.id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(_lease_seconds() / 3):
+            try:
+                _owned(self.manual).update(updated_at=timezone.now())
+            except Exception as e:
+                print(f"--- Ingest job {self.manual.id}: heartbeat failed: {e} ---")
+            finally:
+                close_old_connections()
+
+
+def prepare_build_dir(vectorstore_path: str) -> str:
+    """
+    ベクトルストアを作成するための新しいディレクトリを作って返す関数。
+    公開中のベクトルストアがあれば複製し、差分更新の対象にする。
+    """
+    build_dir = f"{vectorstore_path}.{uuid.uuid4().hex}"
+    if os.path.exists(vectorstore_path):
+        shutil.copytree(os.path.realpath(vectorstore_path), build_dir)
+    return build_dir
+
+
+def publish_build_dir(build_dir: str, vectorstore_path: str):
+    """
+    作成し終わったディレクトリを vectorstore_path として公開する関数。
+    vectorstore_path はシンボリックリンクで、一時的なリンクを os.replace で置き換えるため、
+    読み出し側が作成途中のインデックスを見ることはない。
+    古いディレクトリは、既にそれを開いている検索が読み終えられるよう、すぐには削除しない。
+    更新時刻を公開した時刻にしておき、RAG_GC_GRACE_SECONDS が過ぎた後に gc_vectorstores が削除する。
+    """
+    old_target = os.path.realpath(vectorstore_path) if os.path.islink(vectorstore_path) else None
+    if os.path.isdir(vectorstore_path) and not os.path.islink(vectorstore_path):
+        # 以前の形式(実体のディレクトリ)はリンクに置き換えられないため、先に退避する
+        old_target = f"{vectorstore_path}.{uuid.uuid4().hex}"
+        os.rename(vectorstore_path, old_target)
+
+    tmp_link = f"{vectorstore_path}.link-{uuid.uuid4().hex}"
+    os.symlink(os.path.basename(build_dir), tmp_link)
+    os.replace(tmp_link, vectorstore_path)
+    if old_target and old_target != os.path.realpath(build_dir):
+        os.utime(old_target)
+
+
+def find_manual_pdf_urls(product_name_raw: str) -> list:
+    """
+    取扱説明書のPDFのURLの候補を良い順に返す関数。
+    """
+    from .discovery import discover_pdf_candidates
+
+    try:
+        with metrics.span('discovery'):
+            candidates = discover_pdf_candidates(product_name_raw)
+    except Exception as e:
+        raise IngestError(f'PDFの検索中にエラーが発生: {e}')
+    if not candidates:
+        raise IngestError('取扱説明書のPDFが見つかりませんでした。')
+    return [candidate.url for candidate in candidates]
+
+
+def download_pdf(pdf_url: str):
+    """
+    PDFをダウンロードキャッシュ経由で取得し、(保存先のパス, 内容のSHA-256) を返す関数。
+    取得済みのURLは条件付きリクエストで確認し、変更が無ければダウンロードしない。
+    返したファイルはキャッシュの一部なので削除しないこと。
+    """
+    from .download_cache import get_download_cache
+
+    try:
+        with metrics.span('download'):
+            return get_download_cache().fetch(pdf_url)
+    except requests.exceptions.RequestException as e:
+        raise IngestError(f'PDFのダウンロードに失敗: {e}')
+
+
+def find_indexed_manual(content_hash: str, exclude_id: int = None):
+    """
+    同じ内容のPDFから作成済みのマニュアルを返す関数。無ければNoneを返す。
+    """
+    manuals = ProcessedManual.objects.filter(status='COMPLETED', content_hash=content_hash).exclude(vectorstore_path='')
+    if exclude_id is not None:
+        manuals = manuals.exclude(id=exclude_id)
+    return manuals.order_by('-updated_at').first()
+
+
+def import_to_shared_store(manual_id: int, vectorstore_dir: str) -> str:
+    """
+    作成したベクトルストアを共有インデックスに移し、元のディレクトリを削除する関数。
+    ProcessedManual.vectorstore_path に保存するパスを返す。
+    """
+    from .embeddings import get_embeddings
+    from .shared_store import get_shared_store, make_shared_path
+
+    get_shared_store().import_directory(manual_id, vectorstore_dir, get_embeddings())
+    shutil.rmtree(vectorstore_dir, ignore_errors=True)
+    return make_shared_path(manual_id)
+
+
+def run_job(manual: ProcessedManual):
+    """
+    1件の取り込みジョブを実行する関数。結果はProcessedManualの状態として保存する。
+    """
+    from .incremental import file_sha256
+    from .rag_handler import create_vectorstore_from_vision_pdf
+    from .vectorstore_cache import get_store_size
+
+    def progress(percent, message):
+        update_progress(manual, percent, message)
+
+    pdf_path = manual.source_path
+    build_dir = None
+    finished = False
+    try:
+        if pdf_path:
+            content_hash = file_sha256(pdf_path)
+        else:
+            progress(2, '取扱説明書のPDFを検索しています')
+            pdf_urls = find_manual_pdf_urls(manual.display_name or manual.product_name)
+            progress(5, 'PDFをダウンロードしています')
+            # ダウンロードに失敗した場合は次の候補を試す
+            attempts = pdf_urls[:getattr(settings, 'RAG_DISCOVERY_MAX_ATTEMPTS', 3)]
+            for i, pdf_url in enumerate(attempts):
+                try:
+                    pdf_path, content_hash = download_pdf(pdf_url)
+                    break
+                except IngestError as e:
+                    print(f"--- Ingest job {manual.id}: {e} ({pdf_url}) ---")
+                    if i == len(attempts) - 1:
+                        raise
+            _owned(manual).update(source_url=pdf_url)
+
+        # 同じ内容のPDFを取り込み済みであれば、そのベクトルストアを使う
+        existing = find_indexed_manual(content_hash, exclude_id=manual.id)
+        if existing is not None:
+            print(f"--- Ingest job {manual.id}: reusing the vector store of {existing.product_name} ---")
+            finished = bool(_owned(manual).update(
+                status='COMPLETED', vectorstore_path=existing.vectorstore_path, content_hash=content_hash,
+                size_bytes=existing.size_bytes, source_path='', updated_at=timezone.now(),
+                progress=100, progress_message='取り込み済みのマニュアルを使います', error_message='',
+            ))
+            return
+
+        vectorstore_path = os.path.join(settings.BASE_DIR, 'vectorstores', str(manual.id))
+        build_dir = prepare_build_dir(vectorstore_path)
+        success = create_vectorstore_from_vision_pdf(pdf_path, build_dir, progress_callback=progress)
+        if not success:
+            raise IngestError('PDFの解析に失敗しました。(Popplerはインストールされていますか？)')
+
+        if not _owned(manual).exists():
+            raise IngestError('ジョブが他のワーカーに引き継がれたため、結果を破棄しました。')
+        if getattr(settings, 'RAG_SHARED_INDEX_ENABLED', False):
+            vectorstore_path = import_to_shared_store(manual.id, build_dir)
+        else:
+            publish_build_dir(build_dir, vectorstore_path)
+        build_dir = None
+
+        finished = bool(_owned(manual).update(
+            status='COMPLETED', vectorstore_path=vectorstore_path, content_hash=content_hash,
+            size_bytes=get_store_size(vectorstore_path), source_path='', updated_at=timezone.now(),
+            progress=100, progress_message='完了しました', error_message='',
+        ))
+    except Exception as e:
+        message = str(e) if isinstance(e, IngestError) else f'取り込み中にエラーが発生: {e}'
+        print(f"--- Ingest job {manual.id} failed: {message} ---")
+        finished = bool(_owned(manual).update(
+            status='FAILED', source_path='', error_message=message, progress_message='失敗しました',
+            updated_at=timezone.now(),
+        ))
+    finally:
+        if build_dir: shutil.rmtree(build_dir, ignore_errors=True)
+        # アップロードされたPDFは、ジョブが他のワーカーに引き継がれた場合はそちらで使うため残す
+        # (ダウンロードしたPDFはダウンロードキャッシュが管理する)
+        if manual.source_path and finished and os.path.exists(manual.source_path):
+            os.remove(manual.source_path)
+
+
+class IngestWorkerPool:
+    """
+    待機中のジョブをポーリングして処理するワーカースレッドの集まり。
+    """
+
+    def __init__(self, workers: int, poll_interval: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                manual = claim_next_job()
+            except Exception as e:
+                print(f"--- Ingest worker: failed to claim a job: {e} ---")
+                manual = None
+            if manual is None:
+                self._stop.wait(self.poll_interval)
+                continue
+            print(f"--- Ingest worker {threading.current_thread().name}: processing {manual.product_name} ---")
+            with _Heartbeat(manual):
+                run_job(manual)
+        close_old_connections()
@@ -0,0 +1,223 @@
+import os
+import re
+import shutil
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ProcessedManual
+from .shared_store import is_shared_path
+from .vectorstore_cache import get_store_size, get_vectorstore_cache
+
+# 作成中のディレクトリ(<マニュアルID>.<uuid>)と、公開時の一時的なリンク(<マニュアルID>.link-<uuid>)
+_BUILD_NAME = re.compile(r'^(\d+)\.(?:link-)?[0-9a-f]{32}$')
+
+_touched = {}
+_touched_lock = threading.Lock()
+
+
+def vectorstore_root() -> str:
+    return os.path.join(settings.BASE_DIR, 'vectorstores')
+
+
+def temp_manuals_dir() -> str:
+    return os.path.join(settings.BASE_DIR, 'temp_manuals')
+
+
+def touch(vectorstore_path: str):
+    """
+    ベクトルストアが使われた時刻を記録する関数。
+    チャットのたびにDBへ書き込まないよう、同じベクトルストアはプロセス内で RAG_ACCESS_TOUCH_INTERVAL 秒に1回だけ更新する。
+    """
+    interval = getattr(settings, 'RAG_ACCESS_TOUCH_INTERVAL', 60)
+    now = time.monotonic()
+    with _touched_lock:
+        last = _touched.get(vectorstore_path)
+        if last is not None and now - last < interval:
+            return
+        _touched[vectorstore_path] = now
+    ProcessedManual.objects.filter(vectorstore_path=vectorstore_path).update(last_accessed_at=timezone.now())
+
+
+def remove_vectorstore(path: str):
+    """
+    ベクトルストアを削除する関数。シンボリックリンクの場合はリンク先のディレクトリも削除する。
+    """
+    if os.path.islink(path):
+        target = os.path.realpath(path)
+        os.unlink(path)
+        if target.startswith(os.path.realpath(vectorstore_root()) + os.sep):
+            shutil.rmtree(target, ignore_errors=True)
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+    get_vectorstore_cache().invalidate(path)
+
+
+def _disk_size(path: str) -> int:
+    if os.path.isdir(path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, filename)).st_size
+                except OSError:
+                    pass
+        return total
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def find_orphans(grace_seconds: float) -> list:
+    """
+    どのマニュアルからも参照されていないベクトルストアと、アップロードされたPDFの一時ファイルを返す関数。
+    中断された取り込みの作成中のディレクトリも含む。処理中のジョブのものと、grace_seconds 秒以内に更新されたものは除く。
+    """
+    referenced = set()
+    sources = set()
+    active_ids = set(ProcessedManual.objects.filter(status__in=('PENDING', 'RUNNING')).values_list('id', flat=True))
+    for path, source_path in ProcessedManual.objects.values_list('vectorstore_path', 'source_path'):
+        if path and not is_shared_path(path):
+            referenced.add(os.path.abspath(path))
+            referenced.add(os.path.realpath(path))
+        if source_path:
+            sources.add(os.path.abspath(source_path))
+    shared_dir = os.path.abspath(str(getattr(settings, 'RAG_SHARED_INDEX_DIR',
+                                             os.path.join(vectorstore_root(), 'shared'))))
+    deadline = time.time() - grace_seconds
+
+    orphans = []
+    for directory, keep in ((vectorstore_root(), referenced), (temp_manuals_dir(), sources)):
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            path = os.path.abspath(entry.path)
+            if path in keep or path == shared_dir:
+                continue
+            match = _BUILD_NAME.match(entry.name)
+            if match and int(match.group(1)) in active_ids:
+                continue
+            if entry.stat(follow_symlinks=False).st_mtime > deadline:
+                continue
+            orphans.append(path)
+    return orphans
+
+
+def refresh_sizes():
+    """
+    サイズが未記録の取り込み済みマニュアルについて、ベクトルストアのサイズを記録する関数。
+    """
+    manuals = ProcessedManual.objects.filter(status='COMPLETED', size_bytes=0).exclude(vectorstore_path='')
+    for manual in manuals:
+        if is_shared_path(manual.vectorstore_path) or not os.path.isdir(manual.vectorstore_path):
+            continue
+        ProcessedManual.objects.filter(vectorstore_path=manual.vectorstore_path).update(
+            size_bytes=get_store_size(manual.vectorstore_path))
+
+
+def plan_eviction(quota_bytes: int) -> tuple:
+    """
+    ディスク上のベクトルストアの合計が quota_bytes に収まるよう、最後に使われた時刻が古い順に削除するものを選ぶ関数。
+    同じ内容のPDFで共有しているベクトルストアは1つとして数え、最後に使った時刻はその中で最も新しいものとする。
+    戻り値は (合計サイズ, [(パス, サイズ), ...])。共有インデックス上のマニュアルは対象外。
+    """
+    stores = {}
+    manuals = ProcessedManual.objects.filter(status='COMPLETED').exclude(vectorstore_path='')
+    for path, size, last_accessed_at, updated_at in manuals.values_list(
+            'vectorstore_path', 'size_bytes', 'last_accessed_at', 'updated_at'):
+        if is_shared_path(path):
+            continue
+        used_at = last_accessed_at or updated_at
+        size_before, used_before = stores.get(path, (0, used_at))
+        stores[path] = (max(size, size_before), max(used_at, used_before))
+
+    total = sum(size for size, _ in stores.values())
+    evictions = []
+    remaining = total
+    for path, (size, _) in sorted(stores.items(), key=lambda item: item[1][1]):
+        if remaining <= quota_bytes:
+            break
+        evictions.append((path, size))
+        remaining -= size
+    return total, evictions
+
+
+def evict(vectorstore_path: str):
+    """
+    ベクトルストアを削除し、それを使うマニュアルを削除済み(EVICTED)にする。
+    マニュアルの行(パスと内容のハッシュ)は残し、次に開かれたときや同じPDFがアップロードされたときに取り込み直す。
+    """
+    ProcessedManual.objects.filter(vectorstore_path=vectorstore_path, status='COMPLETED').update(
+        status='EVICTED', size_bytes=0, progress=0, progress_message='容量の上限のためベクトルストアを削除しました',
+        updated_at=timezone.now(),
+    )
+    if not ProcessedManual.objects.filter(vectorstore_path=vectorstore_path).exclude(status='EVICTED').exists():
+        remove_vectorstore(vectorstore_path)
+
+
+def find_evicted_manual(vectorstore_path: str):
+    """
+    セッションのベクトルストアが容量の上限のために削除されていれば、そのマニュアルを返す関数。それ以外はNoneを返す。
+    """
+    if is_shared_path(vectorstore_path) or os.path.exists(vectorstore_path):
+        return None
+    return (ProcessedManual.objects.filter(vectorstore_path=vectorstore_path, status='EVICTED')
+            .order_by('-updated_at').first())
+
+
+def sweep(quota_bytes: int = None, grace_seconds: float = None, dry_run: bool = False) -> dict:
+    """
+    参照されていないファイルを削除し、ベクトルストアの合計が容量の上限を超えていれば古いものから削除する関数。
+    dry_run の場合は削除せず、削除するものだけを返す。
+    """
+    quota_bytes = quota_bytes if quota_bytes is not None else getattr(settings, 'RAG_VECTORSTORE_QUOTA_BYTES', None)
+    grace_seconds = grace_seconds if grace_seconds is not None else getattr(settings, 'RAG_GC_GRACE_SECONDS', 60 * 60)
+
+    orphans = [(path, _disk_size(path)) for path in find_orphans(grace_seconds)]
+    if not dry_run:
+        refresh_sizes()
+    total, evictions = plan_eviction(quota_bytes) if quota_bytes is not None else (None, [])
+    if not dry_run:
+        for path, _ in orphans:
+            remove_vectorstore(path)
+        for path, _ in evictions:
+            evict(path)
+    freed = sum(size for _, size in orphans) + sum(size for _, size in evictions)
+    print(f"--- Vectorstore GC: {len(orphans)} orphans, {len(evictions)} evictions, "
+          f"{freed} bytes {'reclaimable' if dry_run else 'freed'} ---")
+    return {'orphans': orphans, 'evictions': evictions, 'total_bytes': total, 'freed_bytes': freed}
+
+
+class LifecycleSweeper:
+    """
+    一定の間隔で sweep() を実行するバックグラウンドのスレッド。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='vectorstore-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            close_old_connections()
+            try:
+                sweep()
+            except Exception as e:
+                print(f"--- Vectorstore sweeper failed: {e} ---")
+        close_old_connections()
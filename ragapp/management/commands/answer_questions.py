@@ -0,0 +1,73 @@
+import json
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ragapp.models import ProcessedManual
+
+
+def _read_questions(path: str) -> list:
+    """
+    質問のファイルを読む。1行1問のテキスト、または "question" を持つJSON Lines。
+    """
+    with (sys.stdin if path == '-' else open(path, encoding='utf-8')) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    questions = []
+    for line in lines:
+        if line.startswith('{'):
+            questions.append(json.loads(line)['question'])
+        else:
+            questions.append(line)
+    return questions
+
+
+class Command(BaseCommand):
+    help = ('1つのマニュアルに対する複数の質問にまとめて回答し、結果をJSON Lines(1行1件)で出力します。'
+            '質問のベクトル化と検索はまとめて行い、回答の生成は並列に行います。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('manual', help='マニュアルのID、または製品名')
+        parser.add_argument('questions', help="質問のファイル(1行1問、または JSON Lines。'-' で標準入力)")
+        parser.add_argument('--output', '-o', help='出力先のファイル(省略時は標準出力)')
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'RAG_BATCH_LLM_CONCURRENCY', 8),
+                            help='同時に生成する回答数')
+        parser.add_argument('--k', type=int, help='検索するチャンク数')
+
+    def handle(self, *args, **options):
+        manual = self.get_manual(options['manual'])
+        questions = _read_questions(options['questions'])
+        if not questions:
+            raise CommandError('質問がありません。')
+
+        from ragapp.rag_handler import answer_questions
+
+        output = open(options['output'], 'w', encoding='utf-8') if options['output'] else self.stdout
+        started = time.perf_counter()
+        errors = cached = 0
+        try:
+            for item in answer_questions(questions, manual.vectorstore_path, k=options['k'],
+                                         concurrency=options['concurrency']):
+                errors += 'error' in item
+                cached += item['cached']
+                output.write(json.dumps(item, ensure_ascii=False) + "\n")
+                output.flush()
+        finally:
+            if options['output']:
+                output.close()
+        elapsed = time.perf_counter() - started
+        self.stderr.write(self.style.SUCCESS(
+            f"{len(questions)}問に{elapsed:.1f}秒で回答しました({len(questions) / elapsed:.2f}問/秒, "
+            f"キャッシュ {cached}件, 失敗 {errors}件)。"))
+
+    def get_manual(self, value: str) -> ProcessedManual:
+        if value.isdigit():
+            manual = ProcessedManual.objects.filter(id=int(value)).first()
+        else:
+            manual = ProcessedManual.objects.filter(product_name=value.lower()).first()
+        if manual is None:
+            raise CommandError(f"マニュアル '{value}' が見つかりません。")
+        if manual.status != 'COMPLETED':
+            raise CommandError(f"マニュアル '{value}' はまだ取り込みが完了していません({manual.get_status_display()})。")
+        return manual
@@ -0,0 +1,109 @@
+import os
+import shutil
+import statistics
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from ragapp.devtools.fake_openai import run_server
+from ragapp.devtools.synthetic_manual import generate_manual
+from ragapp.devtools.tokenizer import prepare_tokenizer
+
+# (質問, 正しい検索結果に含まれるはずの語句)
+QUESTIONS = [
+    ('フィルターの掃除はどのくらいの頻度で行いますか？', '2週間に1回'),
+    ('タイマーは何時間まで設定できますか？', '最大12時間'),
+    ('長期間使わないときの注意点は？', '電源プラグを抜いて'),
+    ('本体が汚れたときはどうすればよいですか？', '乾拭き'),
+    ('設置場所はどこがよいですか？', '風通しのよい場所'),
+]
+STRATEGIES = ['recursive', 'structured']
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class Command(BaseCommand):
+    help = ('同じPDFを従来の分割(recursive)と構造化チャンク(structured)で取り込み、'
+            '質問ごとのプロンプトのトークン数と、検索結果に答えが含まれる割合を比べます。'
+            'tiktoken のトークナイザーは初回だけダウンロードし、TIKTOKEN_CACHE_DIR にキャッシュします。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pdf', help='使うPDF(省略時は架空のマニュアルを作る)')
+        parser.add_argument('--pages', type=int, default=30, help='架空のマニュアルのページ数')
+        parser.add_argument('--openai', action='store_true', help='フェイクサーバーではなく本物のOpenAI APIを使う')
+        parser.add_argument('--port', type=int, default=8767, help='フェイクサーバーのポート')
+
+    def handle(self, *args, **options):
+        try:
+            prepare_tokenizer()
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        fake_server = None
+        if not options['openai']:
+            fake_server = run_server(port=options['port'], latency=0)
+            base_url = f"http://127.0.0.1:{options['port']}/v1"
+            os.environ.update(OPENAI_BASE_URL=base_url, OPENAI_API_BASE=base_url, OPENAI_API_KEY='fake')
+        work_dir = tempfile.mkdtemp(prefix='benchmark-chunking-')
+        pdf_path = options['pdf']
+        results = {}
+        try:
+            if pdf_path is None:
+                pdf_path = os.path.join(work_dir, 'manual.pdf')
+                generate_manual(pdf_path, options['pages'])
+            elif not os.path.exists(pdf_path):
+                raise CommandError(f"PDF '{pdf_path}' が見つかりません。")
+            # 本番のキャッシュを汚さないよう、キャッシュは作業ディレクトリに置く
+            cache_overrides = dict(
+                RAG_CAPTION_CACHE_PATH=os.path.join(work_dir, 'cache', 'captions.sqlite3'),
+                RAG_EMBEDDING_CACHE_DIR=os.path.join(work_dir, 'cache', 'embeddings'),
+                RAG_ANSWER_CACHE_ENABLED=False,
+            )
+            for strategy in STRATEGIES:
+                with override_settings(RAG_CHUNKING=strategy, **cache_overrides):
+                    results[strategy] = self.run_strategy(work_dir, pdf_path, strategy)
+        finally:
+            if fake_server is not None:
+                fake_server.shutdown()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.report(results)
+
+    def run_strategy(self, work_dir: str, pdf_path: str, strategy: str) -> dict:
+        from ragapp.rag_handler import (QA_PROMPT, create_vectorstore_from_vision_pdf, get_query_embeddings,
+                                        load_vectorstore, retrieve_documents)
+        from ragapp.tokens import count_tokens
+
+        vectorstore_dir = os.path.join(work_dir, f"{strategy}-vectorstore")
+        if not create_vectorstore_from_vision_pdf(pdf_path, vectorstore_dir):
+            raise CommandError(f"'{strategy}' の取り込みに失敗しました。")
+        store = load_vectorstore(vectorstore_dir)
+
+        prompt_tokens = []
+        hits = 0
+        for question, expected in QUESTIONS:
+            vector = get_query_embeddings().embed_query(question)
+            docs = retrieve_documents(store, question, vector)
+            context = "\n\n".join(doc.page_content for doc in docs)
+            prompt_tokens.append(count_tokens(QA_PROMPT.format(context=context, question=question)))
+            hits += expected in context
+        return {
+            'chunks': store.vectorstore.index.ntotal,
+            'prompt_tokens_mean': statistics.mean(prompt_tokens),
+            'prompt_tokens_p95': _percentile(prompt_tokens, 0.95),
+            'hit_rate': hits / len(QUESTIONS),
+        }
+
+    def report(self, results: dict):
+        self.stdout.write(f"{'分割':<12} {'チャンク':>8} {'平均トークン':>12} {'p95トークン':>12} {'正答を含む割合':>14}")
+        for strategy, r in results.items():
+            self.stdout.write(
+                f"{strategy:<12} {r['chunks']:>8} {r['prompt_tokens_mean']:>12.0f} {r['prompt_tokens_p95']:>12} "
+                f"{r['hit_rate']:>14.0%}"
+            )
+        base, new = results['recursive'], results['structured']
+        change = (new['prompt_tokens_mean'] - base['prompt_tokens_mean']) / base['prompt_tokens_mean']
+        self.stdout.write(f"構造化チャンクでの平均プロンプトトークン数の変化: {change:+.1%}")
@@ -0,0 +1,72 @@
+import time
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from ragapp.docstore import load_vectorstore_dir
+from ragapp.embeddings import get_embeddings
+from ragapp.index_factory import INDEX_TYPES, build_faiss_index, reconstruct_vectors, set_search_params
+
+
+def _parse_ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+class Command(BaseCommand):
+    help = 'ベクトルストアのベクトルで各種FAISSインデックスを作り、厳密検索に対する recall@k と検索時間を比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('vectorstore', help='比較に使うベクトルストアのディレクトリ')
+        parser.add_argument('--types', default=','.join(INDEX_TYPES), help='比較するインデックスの種類(カンマ区切り)')
+        parser.add_argument('--k', type=int, default=4)
+        parser.add_argument('--queries', type=int, default=200, help='クエリ数(ストア内のベクトルにノイズを加えて作る)')
+        parser.add_argument('--nprobe', default='1,4,8,16,32', help='IVF系で試す nprobe(カンマ区切り)')
+        parser.add_argument('--ef-search', default='16,32,64,128,256', help='hnsw で試す efSearch(カンマ区切り)')
+        parser.add_argument('--nlist', type=int)
+        parser.add_argument('--pq-m', type=int)
+
+    def handle(self, *args, **options):
+        db = load_vectorstore_dir(options['vectorstore'], get_embeddings())
+        vectors = reconstruct_vectors(db, db.embedding_function)
+        n, d = vectors.shape
+        if n == 0:
+            raise CommandError('ベクトルストアが空です。')
+        k = min(options['k'], n)
+
+        rng = np.random.default_rng(0)
+        queries = vectors[rng.choice(n, min(options['queries'], n), replace=False)].copy()
+        queries += rng.normal(0, queries.std() * 0.05, queries.shape).astype(np.float32)
+
+        exact = faiss.IndexFlatL2(d)
+        exact.add(vectors)
+        _, truth = exact.search(queries, k)
+        self.stdout.write(f"{n}ベクトル / {d}次元 / {len(queries)}クエリ / k={k}")
+        self.stdout.write(f"{'type':<10}{'param':>16}{'recall@k':>10}{'ms/query':>10}{'size(MB)':>10}{'build(s)':>10}")
+
+        params = {}
+        if options['nlist']: params['nlist'] = options['nlist']
+        if options['pq_m']: params['m'] = options['pq_m']
+
+        for index_type in options['types'].split(','):
+            started = time.perf_counter()
+            index = build_faiss_index(vectors, index_type, params)
+            build_time = time.perf_counter() - started
+            size_mb = faiss.serialize_index(index).nbytes / (1024 * 1024)
+
+            if index_type in ('ivf_flat', 'ivf_pq') and hasattr(index, 'nprobe'):
+                settings_to_try = [('nprobe', v) for v in _parse_ints(options['nprobe'])]
+            elif index_type == 'hnsw':
+                settings_to_try = [('efSearch', v) for v in _parse_ints(options['ef_search'])]
+            else:
+                settings_to_try = [('-', None)]
+
+            for name, value in settings_to_try:
+                if name == 'nprobe': set_search_params(index, nprobe=value)
+                if name == 'efSearch': set_search_params(index, ef_search=value)
+                started = time.perf_counter()
+                found = np.vstack([index.search(query[None, :], k)[1] for query in queries])
+                ms_per_query = (time.perf_counter() - started) * 1000 / len(queries)
+                recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+                param = f"{name}={value}" if value is not None else '-'
+                self.stdout.write(f"{index_type:<10}{param:>16}{recall:>10.3f}{ms_per_query:>10.3f}"
+                                  f"{size_mb:>10.2f}{build_time:>10.2f}")
@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from ragapp.devtools.fake_openai import run_server
+from ragapp.devtools.synthetic_manual import generate_manual
+from ragapp.devtools.tokenizer import prepare_tokenizer
+
+SIZES = {'small': 10, 'medium': 50, 'large': 200}
+QUESTIONS = [
+    'フィルターの掃除はどのくらいの頻度で行いますか？',
+    'エラーコード E-07 が表示されたらどうすればよいですか？',
+    'タイマーは何時間まで設定できますか？',
+    '長期間使わないときの注意点は？',
+    'お手入れの前にすることは何ですか？',
+]
+
+
+def _current_rss_mb() -> float:
+    # /proc/self/statm の2番目の値が常駐ページ数(Linuxのみ)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RssMonitor:
+    """
+    with ブロックの間、現在のRSSを一定間隔で読み、開始時からの最大の増加量(MB)を記録する。
+    ru_maxrss はプロセス全体の単調な最大値で、大きさや処理ごとの値にならないため使わない。
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.growth_mb = 0.0
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._start = _current_rss_mb()
+        self._thread = threading.Thread(target=self._run, name='rss-monitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        self.growth_mb = max(self.growth_mb, _current_rss_mb() - self._start)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def _baseline_dir() -> str:
+    return str(getattr(settings, 'RAG_BENCHMARK_BASELINE_DIR', os.path.join(settings.BASE_DIR, 'benchmarks')))
+
+
+class Command(BaseCommand):
+    help = ('OpenAIの代わりにローカルのフェイクサーバーを使い、架空のマニュアルで取り込みとチャットの性能を計測します。'
+            '結果はベースラインとして保存し、後で比較できます。'
+            'tiktoken のトークナイザーは初回だけダウンロードし、TIKTOKEN_CACHE_DIR にキャッシュします。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='small,medium', help=f"マニュアルの大きさ({', '.join(SIZES)}、カンマ区切り)")
+        parser.add_argument('--images-per-page', type=int, default=1)
+        parser.add_argument('--questions', type=int, default=50, help='大きさごとのチャットの質問数')
+        parser.add_argument('--latency', type=float, default=0.05, help='フェイクサーバーの応答までの秒数')
+        parser.add_argument('--port', type=int, default=8766, help='フェイクサーバーのポート')
+        parser.add_argument('--save-baseline', metavar='NAME', help='結果をベースラインとして保存する')
+        parser.add_argument('--compare', metavar='NAME', help='保存済みのベースラインと比較する')
+        parser.add_argument('--tolerance', type=float, default=0.1, help='悪化とみなす割合(0.1で10%%)')
+
+    def handle(self, *args, **options):
+        sizes = [size for size in options['sizes'].split(',') if size]
+        unknown = [size for size in sizes if size not in SIZES]
+        if unknown:
+            raise CommandError(f"不明な大きさです: {', '.join(unknown)}")
+        try:
+            prepare_tokenizer()
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        fake_server = run_server(port=options['port'], latency=options['latency'])
+        base_url = f"http://127.0.0.1:{options['port']}/v1"
+        os.environ.update(OPENAI_BASE_URL=base_url, OPENAI_API_BASE=base_url, OPENAI_API_KEY='fake')
+        work_dir = tempfile.mkdtemp(prefix='benchmark-')
+        # 本番のキャッシュを汚さないよう、キャッシュは作業ディレクトリに置く。回答キャッシュは使わない
+        overrides = override_settings(
+            RAG_CAPTION_CACHE_PATH=os.path.join(work_dir, 'cache', 'captions.sqlite3'),
+            RAG_EMBEDDING_CACHE_DIR=os.path.join(work_dir, 'cache', 'embeddings'),
+            RAG_ANSWER_CACHE_ENABLED=False,
+        )
+        results = {'latency': options['latency'], 'images_per_page': options['images_per_page'], 'sizes': {}}
+        try:
+            with overrides:
+                for size in sizes:
+                    results['sizes'][size] = self.run_size(work_dir, size, options)
+        finally:
+            fake_server.shutdown()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        self.report(results)
+        if options['compare']:
+            self.compare(results, options['compare'], options['tolerance'])
+        if options['save_baseline']:
+            os.makedirs(_baseline_dir(), exist_ok=True)
+            path = os.path.join(_baseline_dir(), f"{options['save_baseline']}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"ベースラインを '{path}' に保存しました。"))
+
+    def run_size(self, work_dir: str, size: str, options) -> dict:
+        from ragapp.rag_handler import ask_question, create_vectorstore_from_vision_pdf
+
+        pages = SIZES[size]
+        pdf_path = os.path.join(work_dir, f"{size}.pdf")
+        vectorstore_dir = os.path.join(work_dir, f"{size}-vectorstore")
+        # 前の大きさの図や本文がキャッシュに当たらないよう、大きさごとに別の内容にする
+        generate_manual(pdf_path, pages, options['images_per_page'], seed=pages)
+
+        started = time.perf_counter()
+        with RssMonitor() as ingest_rss:
+            if not create_vectorstore_from_vision_pdf(pdf_path, vectorstore_dir):
+                raise CommandError(f"'{size}' の取り込みに失敗しました。")
+        ingest_seconds = time.perf_counter() - started
+
+        latencies = []
+        started = time.perf_counter()
+        with RssMonitor() as chat_rss:
+            for i in range(options['questions']):
+                # 同じ質問が続かないよう番号を付ける
+                question = f"{QUESTIONS[i % len(QUESTIONS)]} ({i})"
+                asked = time.perf_counter()
+                ask_question(question, vectorstore_dir)
+                latencies.append(time.perf_counter() - asked)
+        chat_seconds = time.perf_counter() - started
+
+        return {
+            'pages': pages,
+            'ingest_seconds': ingest_seconds,
+            'ingest_pages_per_second': pages / ingest_seconds,
+            'ingest_rss_growth_mb': ingest_rss.growth_mb,
+            'chat_questions_per_second': len(latencies) / chat_seconds,
+            'chat_p50_ms': statistics.median(latencies) * 1000,
+            'chat_p95_ms': _percentile(latencies, 0.95) * 1000,
+            'chat_rss_growth_mb': chat_rss.growth_mb,
+        }
+
+    def report(self, results: dict):
+        self.stdout.write(f"フェイクサーバーの遅延: {results['latency']}秒, 1ページあたりの図: {results['images_per_page']}")
+        self.stdout.write(f"{'大きさ':<8} {'ページ':>6} {'取込(秒)':>9} {'ページ/秒':>9} {'取込RSS+':>8} "
+                          f"{'質問/秒':>8} {'p50(ms)':>8} {'p95(ms)':>8} {'RSS+(MB)':>8}")
+        for size, r in results['sizes'].items():
+            self.stdout.write(
+                f"{size:<8} {r['pages']:>6} {r['ingest_seconds']:>9.2f} {r['ingest_pages_per_second']:>9.2f} "
+                f"{r['ingest_rss_growth_mb']:>8.0f} {r['chat_questions_per_second']:>8.2f} {r['chat_p50_ms']:>8.1f} "
+                f"{r['chat_p95_ms']:>8.1f} {r['chat_rss_growth_mb']:>8.0f}"
+            )
+
+    def compare(self, results: dict, name: str, tolerance: float):
+        """
+        ベースラインとの差を表示する。時間とメモリは増加、スループットは減少を悪化とみなす。
+        """
+        path = os.path.join(_baseline_dir(), f"{name}.json")
+        if not os.path.exists(path):
+            raise CommandError(f"ベースライン '{path}' が見つかりません。")
+        with open(path, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+        regressions = 0
+        for size, r in results['sizes'].items():
+            base = baseline['sizes'].get(size)
+            if base is None:
+                continue
+            for key, value in r.items():
+                if key == 'pages' or not base.get(key):
+                    continue
+                change = (value - base[key]) / base[key]
+                worse = -change if key.endswith('per_second') else change
+                line = f"  {size}.{key}: {base[key]:.2f} -> {value:.2f} ({change:+.1%})"
+                if worse > tolerance:
+                    regressions += 1
+                    self.stdout.write(self.style.ERROR(line))
+                else:
+                    self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"{regressions}個の指標が {tolerance:.0%} 以上悪化しました。")
+        else:
+            self.stdout.write(self.style.SUCCESS("ベースラインからの悪化はありません。"))
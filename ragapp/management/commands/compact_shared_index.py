@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ragapp.shared_store import get_shared_store
+
+
+class Command(BaseCommand):
+    help = '共有インデックスから削除されたマニュアルの行を取り除き、インデックスを詰め直します。'
+
+    def handle(self, *args, **options):
+        store = get_shared_store()
+        store.refresh()
+        self.stdout.write(f"マニュアル数: {len(store.state['ranges'])}, 削除済みの行: {store.state['dead_rows']}")
+        reclaimed = store.compact()
+        self.stdout.write(self.style.SUCCESS(f"{reclaimed}行を回収しました。"))
@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand
+from langchain_community.vectorstores import FAISS
+
+from ragapp.docstore import DOCSTORE_NAME, PICKLE_NAME, write_docstore
+from ragapp.embeddings import get_embeddings
+from ragapp.management.commands.create_vectorstore import VECTORSTORE_PATH
+from ragapp.models import ProcessedManual
+from ragapp.shared_store import is_shared_path
+
+
+class Command(BaseCommand):
+    help = 'pickle形式(index.pkl)のベクトルストアのdocstoreをSQLite形式(docstore.sqlite3)に変換します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*',
+                            help='変換するベクトルストアのディレクトリ(省略時は登録済みのマニュアルと faiss_index)')
+        parser.add_argument('--keep-pickle', action='store_true', help='変換後も index.pkl を残す')
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or self.default_paths()
+        converted = 0
+        for path in paths:
+            pickle_path = os.path.join(path, PICKLE_NAME)
+            if not os.path.exists(pickle_path):
+                continue
+            db = FAISS.load_local(path, get_embeddings(), allow_dangerous_deserialization=True)
+            write_docstore(db, os.path.join(path, DOCSTORE_NAME))
+            if not options['keep_pickle']:
+                os.remove(pickle_path)
+            converted += 1
+            self.stdout.write(f"'{path}' を変換しました({len(db.index_to_docstore_id)}チャンク)。")
+        self.stdout.write(self.style.SUCCESS(f"{converted}個のベクトルストアを変換しました。"))
+
+    def default_paths(self):
+        paths = [
+            manual.vectorstore_path
+            for manual in ProcessedManual.objects.exclude(vectorstore_path='')
+            if not is_shared_path(manual.vectorstore_path)
+        ]
+        paths.append(VECTORSTORE_PATH)
+        return paths
@@ -1,11 +1,15 @@
 import os
+import time
 from django.core.management.base import BaseCommand
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
 from dotenv import load_dotenv
 
+from ragapp.embeddings import format_embedding_stats, get_embeddings
+from ragapp.incremental import IncrementalIndex, file_sha256
+from ragapp.index_factory import INDEX_TYPES, default_index_config
+from ragapp.parallel_build import ShardedBuilder
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
@@ -16,6 +20,26 @@ MANUALS_PATH = "manuals"
 class Command(BaseCommand):
     help = '製品マニュアルを読み込み、ベクトルストアを構築します。'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='変更・追加・削除されたPDFだけを反映します(変更の無いPDFはベクトル化しません)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='PDFの読み込みとベクトル化の並列数')
+        parser.add_argument('--index-type', choices=INDEX_TYPES,
+                            help='FAISSインデックスの種類(省略時は設定の RAG_INDEX_TYPE)')
+        parser.add_argument('--nlist', type=int, help='IVF系のクラスタ数')
+        parser.add_argument('--pq-m', type=int, help='ivf_pq のサブベクトル数')
+        parser.add_argument('--hnsw-m', type=int, help='hnsw のリンク数')
+
+    def index_config(self, options):
+        config = default_index_config()
+        if options['index_type']:
+            config = {'type': options['index_type'], 'params': {}}
+        for option, param in (('nlist', 'nlist'), ('pq_m', 'm'), ('hnsw_m', 'M')):
+            if options[option]:
+                config['params'][param] = options[option]
+        return config
+
     def handle(self, *args, **options):
         self.stdout.write("ベクトルストアの構築を開始します...")
 
@@ -23,24 +47,65 @@ class Command(BaseCommand):
         if not os.path.exists(MANUALS_PATH) or not os.listdir(MANUALS_PATH):
             self.stdout.write(self.style.ERROR(f"'{MANUALS_PATH}' ディレクトリが見つからないか、空です。PDFファイルを配置してください。"))
             return
+
+        if options['incremental']:
+            self.handle_incremental(self.index_config(options))
+            return
             
-        loader = PyPDFDirectoryLoader(MANUALS_PATH)
-        documents = loader.load()
-        self.stdout.write(f"{len(documents)}個のドキュメントを読み込みました。")
+        # 2. PDFごとに読み込み・分割(プロセスプール)とベクトル化(スレッドプール)を並列に行い、
+        #    PDFごとのシャードを作ってから1つのベクトルストアに統合する
+        started = time.perf_counter()
+        builder = ShardedBuilder(VECTORSTORE_PATH, workers=options['workers'], chunk_size=1000, chunk_overlap=200,
+                                 log=self.stdout.write, index_config=self.index_config(options))
+        pdf_paths = {os.path.relpath(path, MANUALS_PATH): path for path in self.find_pdfs()}
+        self.stdout.write(f"{len(pdf_paths)}個のPDFを{options['workers']}並列で処理します。")
+        if not builder.build(pdf_paths):
+            self.stdout.write(self.style.ERROR("PDFからテキストを読み込めませんでした。"))
+            return
 
-        # 2. テキストの分割（チャンキング）
+        # 3. スループットの表示
+        elapsed = time.perf_counter() - started
+        stats = builder.stats
+        self.stdout.write(
+            f"{stats['files']}ファイル(再開: {stats['resumed']}) / {stats['chunks']}チャンク / {elapsed:.1f}秒 "
+            f"({stats['files'] / elapsed:.2f}ファイル/秒, {stats['chunks'] / elapsed:.1f}チャンク/秒) / "
+            f"embedding cache: {stats['embedding_hits']}/{stats['embedding_texts']} hits"
+        )
+        self.stdout.write(self.style.SUCCESS(f"ベクトルストアを '{VECTORSTORE_PATH}' に正常に保存しました。"))
+
+    def find_pdfs(self):
+        pdf_paths = []
+        for root, _, files in os.walk(MANUALS_PATH):
+            pdf_paths.extend(os.path.join(root, name) for name in files if name.lower().endswith('.pdf'))
+        return sorted(pdf_paths)
+
+    def handle_incremental(self, index_config):
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        texts = text_splitter.split_documents(documents)
-        self.stdout.write(f"ドキュメントを{len(texts)}個のチャンクに分割しました。")
-
-        # 3. テキストのベクトル化とベクトルストアの作成
-        # OpenAIのEmbeddingモデルを使用
-        embeddings = OpenAIEmbeddings()
-        
-        # FAISSベクトルストアを作成し、チャンクとEmbeddingを保存
-        db = FAISS.from_documents(texts, embeddings)
-        
-        # 作成したベクトルストアをローカルに保存
-        db.save_local(VECTORSTORE_PATH)
-
-        self.stdout.write(self.style.SUCCESS(f"ベクトルストアを '{VECTORSTORE_PATH}' に正常に保存しました。"))
\ No newline at end of file
+        index = IncrementalIndex(VECTORSTORE_PATH, get_embeddings(), index_config)
+
+        sources = set()
+        for pdf_path in self.find_pdfs():
+            source = os.path.relpath(pdf_path, MANUALS_PATH)
+            sources.add(source)
+            pdf_hash = file_sha256(pdf_path)
+            if index.is_current(source, pdf_hash):
+                continue
+            texts = text_splitter.split_documents(PyPDFLoader(pdf_path).load())
+            index.update_source(source, pdf_hash, texts)
+            self.stdout.write(f"'{source}' を更新しました({len(texts)}個のチャンク)。")
+
+        for source in index.sources:
+            if source not in sources:
+                index.remove_source(source)
+                self.stdout.write(f"'{source}' を削除しました。")
+
+        stats = index.stats
+        self.stdout.write(
+            f"変更なし: {stats['skipped_sources']}ファイル / ベクトル化: {stats['embedded']}チャンク / "
+            f"再利用: {stats['reused']}チャンク / 削除: {stats['deleted']}チャンク"
+        )
+        self.stdout.write(format_embedding_stats(index.embeddings))
+        if index.save():
+            self.stdout.write(self.style.SUCCESS(f"ベクトルストアを '{VECTORSTORE_PATH}' に正常に保存しました。"))
+        else:
+            self.stdout.write(self.style.SUCCESS("変更はありませんでした。"))
\ No newline at end of file
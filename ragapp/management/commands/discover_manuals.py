@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from ragapp.discovery import (
+    DiscoveryBackend, FixtureSearchBackend, discover_pdf_candidates, get_discovery_backend,
+)
+
+
+class RecordingBackend(DiscoveryBackend):
+    """
+    検索とHEADの結果を、絞り込みや並べ替えの前のまま記録するバックエンド。記録は --fixture の入力になる。
+    """
+
+    def __init__(self, backend: DiscoveryBackend):
+        self.backend = backend
+        self.recorded = {'searches': {}, 'probes': {}}
+        self._lock = threading.Lock()
+
+    def search(self, query: str, num_results: int) -> list:
+        urls = self.backend.search(query, num_results)
+        with self._lock:
+            self.recorded['searches'][query] = list(urls)
+        return urls
+
+    def probe(self, url: str, rank: int):
+        candidate = self.backend.probe(url, rank)
+        with self._lock:
+            self.recorded['probes'][url] = {
+                'status': candidate.status, 'content_type': candidate.content_type, 'size': candidate.size,
+                'error': candidate.error,
+            }
+        return candidate
+
+
+class Command(BaseCommand):
+    help = '製品名から取扱説明書のPDFの候補を探し、順位と所要時間を表示します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('products', nargs='+', help='製品名')
+        parser.add_argument('--fixture', help='記録済みの検索結果(JSON)を使い、ネットワークにアクセスしない')
+        parser.add_argument('--latency', type=float, default=0.0, help='--fixture 使用時に検索とHEADごとに待つ秒数')
+        parser.add_argument('--no-cache', action='store_true', help='検索結果のキャッシュを使わない')
+        parser.add_argument('--record', help='検索結果とHEADの結果をこのファイルに記録する(--fixture の入力になる)')
+
+    def handle(self, *args, **options):
+        if options['fixture']:
+            backend = FixtureSearchBackend(options['fixture'], latency=options['latency'])
+        else:
+            backend = get_discovery_backend()
+        if options['record']:
+            backend = RecordingBackend(backend)
+        # 記録済みの結果で本番のキャッシュを読み書きしないよう、--fixture と --record ではキャッシュを使わない
+        use_cache = not (options['no_cache'] or options['fixture'] or options['record'])
+        total = 0.0
+
+        for product in options['products']:
+            started = time.perf_counter()
+            candidates = discover_pdf_candidates(product, backend=backend, use_cache=use_cache)
+            elapsed = time.perf_counter() - started
+            total += elapsed
+            self.stdout.write(f"'{product}': {len(candidates)}件 ({elapsed * 1000:.0f}ms)")
+            for candidate in candidates:
+                size = f"{candidate.size / 1024:.0f}KB" if candidate.size else '-'
+                self.stdout.write(f"  {candidate.score:.2f} {candidate.content_type or '-'} {size} {candidate.url}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(options['products'])}件の製品を {total:.2f}秒 で検索しました "
+            f"(平均 {total / len(options['products']) * 1000:.0f}ms)。"
+        ))
+        if options['record']:
+            with open(options['record'], 'w', encoding='utf-8') as f:
+                json.dump(backend.recorded, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"検索結果を '{options['record']}' に記録しました。")
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ragapp.lifecycle import sweep
+
+
+def _format_bytes(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f}MB"
+
+
+class Command(BaseCommand):
+    help = ('どのマニュアルからも使われていないベクトルストアとアップロードの一時ファイルを削除し、'
+            'ベクトルストアの合計が容量の上限を超えていれば、最後に使われた時刻が古いものから削除します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quota-mb', type=float, help='ベクトルストアの合計の上限(MB)。省略時は RAG_VECTORSTORE_QUOTA_BYTES')
+        parser.add_argument('--grace-seconds', type=float, help='この秒数以内に更新されたファイルは削除しない')
+        parser.add_argument('--dry-run', action='store_true', help='削除せず、削除するものを表示する')
+        parser.add_argument('--compact', action='store_true', help='共有インデックスも詰め直す')
+
+    def handle(self, *args, **options):
+        quota_bytes = int(options['quota_mb'] * 1024 * 1024) if options['quota_mb'] is not None else None
+        result = sweep(quota_bytes, options['grace_seconds'], options['dry_run'])
+
+        verb = '削除対象' if options['dry_run'] else '削除'
+        for path, size in result['orphans']:
+            self.stdout.write(f"  {verb}(未使用): {path} ({_format_bytes(size)})")
+        for path, size in result['evictions']:
+            self.stdout.write(f"  {verb}(容量超過): {path} ({_format_bytes(size)})")
+        if result['total_bytes'] is not None:
+            self.stdout.write(f"ベクトルストアの合計: {_format_bytes(result['total_bytes'])}")
+        if options['dry_run']:
+            self.stdout.write(f"{_format_bytes(result['freed_bytes'])}を削除できます。")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"{_format_bytes(result['freed_bytes'])}を削除しました。"))
+
+        if options['compact'] and not options['dry_run'] and getattr(settings, 'RAG_SHARED_INDEX_ENABLED', False):
+            from ragapp.shared_store import get_shared_store
+
+            reclaimed = get_shared_store().compact()
+            self.stdout.write(self.style.SUCCESS(f"共有インデックスから{reclaimed}行を回収しました。"))
@@ -0,0 +1,68 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 遅延importの対象。Webのワーカーの起動時に読み込まれていないことを確認する
+HEAVY_PACKAGES = ['langchain', 'langchain_community', 'langchain_openai', 'faiss', 'fitz', 'unstructured', 'openai',
+                  'googlesearch', 'tiktoken']
+
+# manage.py のコマンドとして扱い、起動時のウォームアップを行わないようにする
+SCRIPT = """
+import sys
+import time
+sys.argv = ['manage.py', 'import_report']
+started = time.perf_counter()
+import django
+django.setup()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+
+def _parse_importtime(stderr: str) -> list:
+    """
+    python -X importtime の出力を (モジュール名, 自身の時間(μs), 累積時間(μs)) のリストにする。
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+class Command(BaseCommand):
+    help = ('新しいプロセスでDjangoを初期化してモジュールをimportし、所要時間と、時間のかかったパッケージを表示します。'
+            'Webのワーカーの起動時に重いパッケージが読み込まれていないかの確認に使います。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', default=['ragapp.views', 'ragapp.rag_handler'],
+                            help='importするモジュール')
+        parser.add_argument('--top', type=int, default=10, help='表示するパッケージの数')
+
+    def handle(self, *args, **options):
+        for module in options['modules']:
+            result = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', SCRIPT.format(module=module)],
+                cwd=settings.BASE_DIR, env=dict(os.environ), capture_output=True, text=True,
+            )
+            if result.returncode != 0:
+                raise CommandError(f"'{module}' のimportに失敗しました:\n{result.stderr.strip().splitlines()[-1]}")
+
+            rows = _parse_importtime(result.stderr)
+            by_package = {}
+            for name, self_us, _ in rows:
+                package = name.split('.')[0]
+                by_package[package] = by_package.get(package, 0) + self_us
+            loaded = {name.split('.')[0] for name, _, _ in rows}
+
+            self.stdout.write(self.style.SUCCESS(
+                f"{module}: {float(result.stdout.strip().splitlines()[-1]):.2f}秒 (モジュール数 {len(rows)})"))
+            for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:options['top']]:
+                self.stdout.write(f"  {package:<28} {self_us / 1000:>9.1f}ms")
+            heavy = [package for package in HEAVY_PACKAGES if package in loaded]
+            self.stdout.write(f"  読み込まれた重いパッケージ: {', '.join(heavy) if heavy else 'なし'}")
@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from ragapp.embeddings import get_embeddings
+from ragapp.lifecycle import remove_vectorstore
+from ragapp.models import ProcessedManual
+from ragapp.shared_store import get_shared_store, is_shared_path, make_shared_path
+
+
+class Command(BaseCommand):
+    help = 'マニュアルごとのベクトルストアを共有インデックスに移行します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='移行したベクトルストアのディレクトリを削除する')
+
+    def handle(self, *args, **options):
+        store = get_shared_store()
+        embeddings = get_embeddings()
+        manuals = ProcessedManual.objects.filter(status='COMPLETED').exclude(vectorstore_path='').order_by('id')
+
+        # 同じ内容のPDFのマニュアルは1つのベクトルストアを共有しているため、パスごとに1回だけ移行する
+        groups = {}
+        for manual in manuals:
+            if not is_shared_path(manual.vectorstore_path):
+                groups.setdefault(manual.vectorstore_path, []).append(manual)
+
+        imported = 0
+        for old_path, group in groups.items():
+            names = ', '.join(manual.product_name for manual in group)
+            if not os.path.exists(old_path):
+                self.stdout.write(self.style.WARNING(f"'{names}' のベクトルストアが見つかりません。スキップします。"))
+                continue
+            # グループの最初のマニュアルのIDで登録し、全てのマニュアルからそれを参照する
+            count = store.import_directory(group[0].id, old_path, embeddings)
+            ProcessedManual.objects.filter(id__in=[manual.id for manual in group]).update(
+                vectorstore_path=make_shared_path(group[0].id))
+            if options['delete']:
+                remove_vectorstore(old_path)
+            imported += len(group)
+            self.stdout.write(f"'{names}' を移行しました({count}チャンク)。")
+
+        self.stdout.write(self.style.SUCCESS(f"{imported}件のマニュアルを共有インデックスに移行しました。"))
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+
+from ragapp.devtools.fake_openai import run_server
+
+
+def _wait_for_port(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return True
+        time.sleep(0.1)
+    return False
+
+
+class Command(BaseCommand):
+    help = ('フェイクのOpenAIサーバーに対してuvicornでアプリを起動し、/api/chat/ に同時にリクエストを送って'
+            'スループットと応答時間を計測します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,4,16,64', help='同時リクエスト数(カンマ区切り)')
+        parser.add_argument('--requests', type=int, default=64, help='同時リクエスト数ごとの総リクエスト数')
+        parser.add_argument('--latency', type=float, default=0.5, help='フェイクサーバーの応答までの秒数')
+        parser.add_argument('--port', type=int, default=8800, help='uvicornのポート')
+        parser.add_argument('--fake-port', type=int, default=8765, help='フェイクサーバーのポート')
+
+    def handle(self, *args, **options):
+        fake_server = run_server(port=options['fake_port'], latency=options['latency'])
+        env = dict(os.environ, OPENAI_BASE_URL=f"http://127.0.0.1:{options['fake_port']}/v1", OPENAI_API_KEY='fake')
+        os.environ.update(OPENAI_BASE_URL=env['OPENAI_BASE_URL'], OPENAI_API_KEY='fake')
+        work_dir = tempfile.mkdtemp(prefix='loadtest-')
+        session = None
+        server = None
+        try:
+            vectorstore_path = self.build_vectorstore(work_dir)
+            session = SessionStore()
+            session['vectorstore_path'] = vectorstore_path
+            session.create()
+
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'config.asgi:application', '--port', str(options['port']),
+                 '--log-level', 'warning'],
+                cwd=settings.BASE_DIR, env=env,
+            )
+            if not _wait_for_port(options['port'], 30):
+                raise CommandError('uvicornが起動しませんでした。')
+
+            self.stdout.write(f"フェイクサーバーの遅延: {options['latency']}秒(ベクトル化とLLMで1リクエストあたり2回)")
+            self.stdout.write(f"{'同時数':>6} {'件数':>6} {'req/s':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'失敗':>5}")
+            for concurrency in [int(v) for v in options['concurrency'].split(',') if v]:
+                result = asyncio.run(self.run_level(options['port'], session.session_key, concurrency,
+                                                    options['requests']))
+                self.stdout.write(
+                    f"{concurrency:>6} {options['requests']:>6} {result['throughput']:>8.2f} "
+                    f"{result['p50'] * 1000:>9.0f} {result['p95'] * 1000:>9.0f} {result['errors']:>5}"
+                )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            if session is not None:
+                session.delete()
+            fake_server.shutdown()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def build_vectorstore(self, work_dir: str) -> str:
+        """
+        フェイクのベクトルで小さなベクトルストアを作る。埋め込みキャッシュを汚さないよう、キャッシュは使わない。
+        """
+        from langchain_community.vectorstores import FAISS
+        from langchain_openai import OpenAIEmbeddings
+
+        from ragapp.docstore import save_vectorstore
+
+        texts = [f"負荷試験用のチャンク {i}。フィルターの掃除は2週間に1回行ってください。" for i in range(200)]
+        path = os.path.join(work_dir, 'vectorstore')
+        save_vectorstore(FAISS.from_texts(texts, OpenAIEmbeddings()), path)
+        return path
+
+    async def run_level(self, port: int, session_key: str, concurrency: int, total: int) -> dict:
+        import httpx
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+        cookies = {settings.SESSION_COOKIE_NAME: session_key}
+
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", cookies=cookies, timeout=120,
+                                     limits=httpx.Limits(max_connections=concurrency)) as client:
+            async def one(i):
+                nonlocal errors
+                async with semaphore:
+                    started = time.perf_counter()
+                    # 回答キャッシュに当たらないよう、毎回違う質問にする
+                    response = await client.post('/api/chat/', data={'question': f"負荷試験の質問 {concurrency}-{i}"})
+                    latencies.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        errors += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(total)))
+            elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        return {
+            'throughput': total / elapsed,
+            'p50': statistics.median(latencies),
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'errors': errors,
+        }
@@ -0,0 +1,44 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ragapp.jobs import IngestWorkerPool
+from ragapp.lifecycle import LifecycleSweeper
+
+
+class Command(BaseCommand):
+    help = '取扱説明書の取り込みジョブを処理するワーカーを起動します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'RAG_INGEST_WORKERS', 2),
+                            help='同時に処理するジョブ数')
+        parser.add_argument('--poll-interval', type=float, default=getattr(settings, 'RAG_INGEST_POLL_INTERVAL', 2.0),
+                            help='待機中のジョブを確認する間隔(秒)')
+        parser.add_argument('--gc-interval', type=float, default=getattr(settings, 'RAG_GC_INTERVAL', 0),
+                            help='使われていないベクトルストアと一時ファイルを削除する間隔(秒)。0で無効')
+
+    def handle(self, *args, **options):
+        pool = IngestWorkerPool(options['workers'], options['poll_interval'])
+        stopped = threading.Event()
+
+        def shutdown(signum, frame):
+            stopped.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f"{options['workers']}個のワーカーでジョブの処理を開始しました。"))
+        sweeper = None
+        if options['gc_interval'] > 0:
+            sweeper = LifecycleSweeper(options['gc_interval'])
+            sweeper.start()
+            self.stdout.write(f"{options['gc_interval']:.0f}秒ごとにベクトルストアの掃除を行います。")
+        stopped.wait()
+        self.stdout.write("停止しています。処理中のジョブの完了を待ちます...")
+        if sweeper is not None:
+            sweeper.stop()
+        pool.stop()
+        self.stdout.write(self.style.SUCCESS("ワーカーを停止しました。"))
@@ -0,0 +1,207 @@
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger('ragapp.metrics')
+
+# 処理時間のヒストグラムのバケット(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class MetricsRegistry:
+    """
+    カウンターとヒストグラムをプロセス内に保持し、Prometheusのテキスト形式で出力するレジストリ。
+    メトリクスは (名前, ラベル) ごとに保持する。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(DEFAULT_BUCKETS)
+            histogram.observe(value)
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def register_collector(self, collector):
+        """
+        出力のたびに呼ばれ、(名前, ラベルの辞書, 値) のリストを返す関数を登録する。キャッシュの状態などに使う。
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.count, h.sum, h.buckets) for key, h in self._histograms.items()}
+
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def format_labels(label_key, extra=()):
+            items = list(label_key) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in items) + '}'
+
+        for (name, label_key), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{format_labels(label_key)} {value}")
+
+        for (name, label_key), (counts, count, total, buckets) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(label_key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(label_key, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{format_labels(label_key)} {total}")
+            lines.append(f"{name}_count{format_labels(label_key)} {count}")
+
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logger.warning("metrics collector failed: %s", e)
+                continue
+            for name, labels, value in samples:
+                header(name, 'gauge')
+                lines.append(f"{name}{format_labels(_label_key(labels))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+registry.describe('rag_stage_seconds', 'Time spent in each stage of the RAG pipeline')
+
+
+def enabled() -> bool:
+    return getattr(settings, 'RAG_METRICS_ENABLED', True)
+
+
+def inc(name: str, value: float = 1, **labels):
+    if enabled():
+        registry.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels):
+    if enabled():
+        registry.observe(name, value, **labels)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, stage: str, labels: dict):
+        self.stage = stage
+        self.labels = labels
+        self.fields = {}
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        outcome = 'error' if exc_type is not None else 'ok'
+        registry.observe('rag_stage_seconds', elapsed, stage=self.stage, outcome=outcome, **self.labels)
+        if getattr(settings, 'RAG_METRICS_LOG', False):
+            record = {'stage': self.stage, 'seconds': round(elapsed, 6), 'outcome': outcome}
+            record.update(self.labels)
+            record.update(self.fields)
+            logger.info(json.dumps(record, ensure_ascii=False, default=str))
+        return False
+
+    def set(self, **fields):
+        """
+        構造化ログに出力する項目を追加する(メトリクスのラベルにはしない)。
+        """
+        self.fields.update(fields)
+
+
+def span(stage: str, **labels):
+    """
+    処理の段階の所要時間を計測するコンテキストマネージャ。
+    rag_stage_seconds{stage=...} のヒストグラムに記録し、RAG_METRICS_LOG が有効であれば1行のJSONでログに出す。
+    計測が無効な場合は何もしないオブジェクトを返す。
+    """
+    if not enabled():
+        return _NULL_SPAN
+    return _Span(stage, labels)
+
+
+def _collect_cache_stats():
+    from .answer_cache import get_answer_cache
+    from .vectorstore_cache import get_vectorstore_cache
+
+    samples = []
+    for name, value in get_vectorstore_cache().stats().items():
+        samples.append((f'rag_vectorstore_cache_{name}', {}, value))
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        for name, value in answer_cache.stats().items():
+            if isinstance(value, (int, float)):
+                samples.append((f'rag_answer_cache_{name}', {}, value))
+    return samples
+
+
+registry.register_collector(_collect_cache_stats)
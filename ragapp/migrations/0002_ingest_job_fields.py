@@ -0,0 +1,51 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ragapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedmanual',
+            name='display_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='source_path',
+            field=models.CharField(blank=True, max_length=512),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='source_url',
+            field=models.URLField(blank=True, max_length=1024),
+        ),
+        migrations.AlterField(
+            model_name='processedmanual',
+            name='status',
+            field=models.CharField(choices=[('PENDING', '待機中'), ('RUNNING', '処理中'), ('COMPLETED', '完了'), ('FAILED', '失敗')], db_index=True, default='PENDING', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='progress_message',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='error_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ragapp', '0002_ingest_job_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedmanual',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
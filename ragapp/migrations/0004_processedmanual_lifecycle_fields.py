@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ragapp', '0003_processedmanual_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processedmanual',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='processedmanual',
+            name='last_accessed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ragapp', '0004_processedmanual_lifecycle_fields'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='processedmanual',
+            name='status',
+            field=models.CharField(choices=[('PENDING', '待機中'), ('RUNNING', '処理中'), ('COMPLETED', '完了'), ('FAILED', '失敗'), ('EVICTED', '削除済み')], db_index=True, default='PENDING', max_length=10),
+        ),
+    ]
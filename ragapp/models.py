@@ -2,19 +2,41 @@ from django.db import models
 
 class ProcessedManual(models.Model):
     """
-    処理済みの取扱説明書の情報を格納するモデル
+    処理済みの取扱説明書の情報を格納するモデル。
+    取り込み処理のジョブの状態と進捗もここで管理する。
     """
     product_name = models.CharField(max_length=255, unique=True, db_index=True)
+    display_name = models.CharField(max_length=255, blank=True)
     vectorstore_path = models.CharField(max_length=512, blank=True)
+    # アップロードされたPDFの保存先(検索で見つける場合は空)
+    source_path = models.CharField(max_length=512, blank=True)
+    source_url = models.URLField(max_length=1024, blank=True)
+    # 取り込んだPDFの内容のSHA-256。同じ内容のPDFはベクトルストアを共有する
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # ベクトルストアのディスク上のサイズと、最後にチャットで使われた時刻(容量の上限を超えた場合に古いものから削除する)
+    size_bytes = models.BigIntegerField(default=0)
+    last_accessed_at = models.DateTimeField(null=True, blank=True, db_index=True)
     
     STATUS_CHOICES = [
+        ('PENDING', '待機中'),
+        ('RUNNING', '処理中'),
         ('COMPLETED', '完了'),
         ('FAILED', '失敗'),
+        # ディスクの容量の上限のためにベクトルストアを削除した。次に開かれたときに取り込み直す
+        ('EVICTED', '削除済み'),
     ]
-    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='COMPLETED')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING', db_index=True)
+    progress = models.PositiveSmallIntegerField(default=0)
+    progress_message = models.CharField(max_length=255, blank=True)
+    error_message = models.TextField(blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    started_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
-        return f"{self.product_name} ({self.get_status_display()})"
\ No newline at end of file
+        return f"{self.product_name} ({self.get_status_display()})"
+
+    @property
+    def is_active(self):
+        return self.status in ('PENDING', 'RUNNING')
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.vectorstores import FAISS
+
+from .docstore import load_vectorstore_dir, save_vectorstore
+from .embeddings import get_embeddings
+from .index_factory import apply_index_config, default_index_config, save_index_config
+from .incremental import MANIFEST_NAME, file_sha256, make_chunk_ids
+from .sparse_index import save_sparse_index
+
+SHARD_INFO_NAME = 'shard.json'
+
+
+def parse_pdf(pdf_path: str, chunk_size: int, chunk_overlap: int) -> list:
+    """
+    PDFを読み込んでチャンクに分割する関数。プロセスプールのワーカーで実行される。
+    """
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_documents(PyPDFLoader(pdf_path).load())
+
+
+class ShardedBuilder:
+    """
+    複数のPDFからベクトルストアを並列に作成するビルダー。
+    PDFごとにシャード(小さなFAISSインデックス)を作って <vectorstore_dir>.shards/ に保存し、最後に1つに統合する。
+    作成済みのシャードは再利用されるため、中断した場合も続きから再開できる。
+    """
+
+    def __init__(self, vectorstore_dir: str, workers: int, chunk_size=1000, chunk_overlap=200, log=print,
+                 index_config: dict = None):
+        self.vectorstore_dir = vectorstore_dir
+        self.index_config = index_config or default_index_config()
+        self.shards_dir = f"{vectorstore_dir.rstrip(os.sep)}.shards"
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.log = log
+        self.stats = {'files': 0, 'resumed': 0, 'chunks': 0, 'embedding_hits': 0, 'embedding_texts': 0}
+
+    @staticmethod
+    def _shard_key(source, pdf_hash):
+        return hashlib.sha256(f"{source}\0{pdf_hash}".encode('utf-8')).hexdigest()
+
+    def _shard_path(self, shard_key):
+        return os.path.join(self.shards_dir, shard_key)
+
+    def _read_shard_info(self, shard_key):
+        info_path = os.path.join(self._shard_path(shard_key), SHARD_INFO_NAME)
+        if not os.path.exists(info_path):
+            return None
+        with open(info_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _build_shard(self, source, pdf_hash, chunks):
+        """
+        チャンクをベクトル化してシャードとして保存する。一時ディレクトリに書いてから名前を変えるため、
+        途中で中断しても中途半端なシャードは残らない。
+        """
+        ids = make_chunk_ids(source, [chunk.page_content for chunk in chunks])
+        tmp_path = os.path.join(self.shards_dir, f".tmp-{uuid.uuid4()}")
+        os.makedirs(tmp_path)
+        embeddings = get_embeddings()
+        if chunks:
+            save_vectorstore(FAISS.from_documents(chunks, embeddings, ids=ids), tmp_path)
+        info = {'source': source, 'hash': pdf_hash, 'key': self._shard_key(source, pdf_hash), 'chunks': ids}
+        with open(os.path.join(tmp_path, SHARD_INFO_NAME), 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        shard_path = self._shard_path(info['key'])
+        if os.path.exists(shard_path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.replace(tmp_path, shard_path)
+        return info, embeddings.stats
+
+    def build(self, pdf_paths: dict) -> bool:
+        """
+        {source: PDFのパス} からベクトルストアを作成する。チャンクが1つも無い場合はFalseを返す。
+        """
+        os.makedirs(self.shards_dir, exist_ok=True)
+        started = time.perf_counter()
+        total = len(pdf_paths)
+        shard_infos = {}
+        pending = {}
+
+        for source, pdf_path in pdf_paths.items():
+            pdf_hash = file_sha256(pdf_path)
+            info = self._read_shard_info(self._shard_key(source, pdf_hash))
+            if info is not None:
+                shard_infos[source] = info
+                self.stats['resumed'] += 1
+            else:
+                pending[source] = (pdf_path, pdf_hash)
+        if self.stats['resumed']:
+            self.log(f"作成済みのシャードを{self.stats['resumed']}個再利用します。")
+
+        # パースはプロセスプール、ベクトル化はスレッドプールで並列に行う
+        with ProcessPoolExecutor(max_workers=self.workers) as parse_pool, \
+                ThreadPoolExecutor(max_workers=self.workers) as embed_pool:
+            parse_futures = {
+                parse_pool.submit(parse_pdf, pdf_path, self.chunk_size, self.chunk_overlap): source
+                for source, (pdf_path, _) in pending.items()
+            }
+            embed_futures = {}
+            for future in as_completed(parse_futures):
+                source = parse_futures[future]
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    self.log(f"'{source}' の読み込みに失敗しました: {e}")
+                    continue
+                embed_futures[embed_pool.submit(self._build_shard, source, pending[source][1], chunks)] = source
+
+            for future in as_completed(embed_futures):
+                source = embed_futures[future]
+                info, embedding_stats = future.result()
+                shard_infos[source] = info
+                self.stats['files'] += 1
+                self.stats['chunks'] += len(info['chunks'])
+                self.stats['embedding_hits'] += embedding_stats['hits']
+                self.stats['embedding_texts'] += embedding_stats['texts']
+                elapsed = time.perf_counter() - started
+                self.log(f"[{len(shard_infos)}/{total}] '{source}' ({len(info['chunks'])}チャンク) "
+                         f"{self.stats['chunks'] / elapsed:.1f}チャンク/秒")
+
+        return self._merge(shard_infos)
+
+    def _merge(self, shard_infos: dict) -> bool:
+        db = None
+        manifest = {'version': 1, 'sources': {}}
+        for source in sorted(shard_infos):
+            info = shard_infos[source]
+            manifest['sources'][source] = {'hash': info['hash'], 'chunks': info['chunks']}
+            if not info['chunks']:
+                continue
+            shard = load_vectorstore_dir(self._shard_path(info['key']), get_embeddings(), lazy=False)
+            if db is None:
+                db = shard
+            else:
+                db.merge_from(shard)
+        if db is None:
+            return False
+
+        # シャードはflatで作って統合し、最後に指定された種類のインデックスに作り直す
+        apply_index_config(db, self.index_config, get_embeddings())
+        save_vectorstore(db, self.vectorstore_dir)
+        save_index_config(self.vectorstore_dir, db)
+        save_sparse_index(db, self.vectorstore_dir)
+        with open(os.path.join(self.vectorstore_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+
+        # 今回使わなかった古いシャードを削除する
+        used = {info['key'] for info in shard_infos.values()}
+        for name in os.listdir(self.shards_dir):
+            if name not in used:
+                shutil.rmtree(os.path.join(self.shards_dir, name), ignore_errors=True)
+        return True
@@ -1,119 +1,228 @@
 import os
-from langchain_community.document_loaders import UnstructuredPDFLoader
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from asgiref.sync import sync_to_async
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
+from langchain_core.documents import Document
 from dotenv import load_dotenv
+from django.conf import settings
 
-load_dotenv()
-
-# ファイルの先頭に、以下のライブラリを追加でインポートします
-import fitz  # PyMuPDF
-import base64
-from openai import OpenAI
+from . import metrics
+from .answer_cache import get_answer_cache, normalize_question
+from .chunking import (ParentStore, ParentStoreWriter, StructuredChunker, expand_to_parents, extract_text_blocks,
+                       remove_parent_store)
+from .compression import compress_documents
+from .embeddings import format_embedding_stats, get_embeddings
+from .shared_store import SharedManualView, get_shared_store, is_shared_path, parse_shared_path
+from .sparse_index import BM25Index, reciprocal_rank_fusion
+from .tokens import count_tokens
+from .vectorstore_cache import get_store_version, get_vectorstore_cache
 
-# ... 既存のimport文 ...
-# ... 既存の create_vectorstore_from_pdf と ask_question 関数 ...
+load_dotenv()
 
+# PDFの解析(PyMuPDF, Unstructured)、FAISS、OpenAIのクライアント、回答生成のチェーンなどの重いモジュールは、
+# チャットだけを行うプロセスの起動を速くするため、使う関数の中でimportする
 
-# ▼▼▼ 以下の新しい関数をファイルの末尾に追加 ▼▼▼
 
 def analyze_image_with_vision(image_bytes: bytes) -> str:
     """
     画像データをOpenAIのVisionモデルに渡し、説明文を生成する関数
     """
-    client = OpenAI() # APIキーは.envファイルから自動で読み込まれる
-    base64_image = base64.b64encode(image_bytes).decode('utf-8')
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "これは製品マニュアルに含まれる図やイラストです。この画像が何を示しているか、誰が見てもわかるように詳細に説明してください。専門用語や部品名があればそれも使って説明してください。"},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=300
-        )
-        description = response.choices[0].message.content
+    from .vision import caption_image
+
+    description = caption_image(image_bytes)
+    if description:
         print(f"--- Vision API: Image description generated. ---")
-        return description
-    except Exception as e:
-        print(f"--- Vision API Error: {e} ---")
-        return ""
+    return description
+
+
+def _report_progress(progress_callback, percent: int, message: str):
+    if progress_callback is not None:
+        progress_callback(percent, message)
+
+
+# 単一のPDFから作るベクトルストアでの文書名(マニフェストのキー)
+SINGLE_PDF_SOURCE = 'manual'
+
+
+def _open_incremental_index(pdf_path: str, vectorstore_dir: str, variant: str = ''):
+    """
+    ベクトルストアの差分更新の準備をする関数。
+    前回と同じPDFから(同じ分割方法 variant で)作成済みであれば、(None, ハッシュ) を返す。
+    """
+    from .incremental import IncrementalIndex, file_sha256
+
+    pdf_hash = file_sha256(pdf_path)
+    if variant:
+        pdf_hash = f"{pdf_hash}:{variant}"
+    index = IncrementalIndex(vectorstore_dir, get_embeddings())
+    if index.is_current(SINGLE_PDF_SOURCE, pdf_hash):
+        print(f"--- PDF is unchanged. Reusing vector store: {vectorstore_dir} ---")
+        return None, pdf_hash
+    return index, pdf_hash
+
+
+def _save_incremental_index(index: 'IncrementalIndex', pdf_hash: str, chunk_batches) -> bool:
+    """
+    チャンクをバッチごとにベクトル化してインデックスに反映し、保存する関数。
+    チャンクが1つも無かった場合と、保存できなかった場合はFalseを返す。
+    """
+    for source in index.sources:
+        if source != SINGLE_PDF_SOURCE:
+            index.remove_source(source)
+    chunk_count = index.update_source_batches(SINGLE_PDF_SOURCE, pdf_hash, chunk_batches)
+    if not chunk_count:
+        print("--- Warning: Document could not be split into texts. ---")
+        return False
+    with metrics.span('index_save'):
+        saved = index.save()
+    if not saved:
+        print("--- Warning: Vector store could not be saved. ---")
+        return False
+    metrics.inc('rag_ingest_chunks_total', chunk_count)
+    print(f"--- Split into {chunk_count} chunks. Embedded {index.stats['embedded']} new chunks, "
+          f"reused {index.stats['reused']}, deleted {index.stats['deleted']}. ---")
+    print(f"--- {format_embedding_stats(index.embeddings)} ---")
+    return True
+
+
+def _batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
-def create_vectorstore_from_vision_pdf(pdf_path: str, vectorstore_dir: str):
+def _split_documents(documents, text_splitter):
+    """
+    Documentを1つずつ分割してチャンクを順に返すジェネレータ。
+    """
+    for document in documents:
+        yield from text_splitter.split_documents([document])
+
+
+def iter_vision_pdf_page_blocks(pdf_path: str, caption_stats: dict = None, progress_callback=None):
+    """
+    PDFを数ページずつ読み、(ページ番号, ブロックのリスト) を順に返すジェネレータ。
+    ブロックは見出し・本文({'type': 'heading'/'text', 'text'})と、図の説明({'type': 'figure', 'figure_id', 'number', 'text'})。
+    画像のバイト列は読み込み中のページの分だけ保持し、説明文の生成はその範囲でまとめて並列に行う。
+    同じxrefの画像は文書内で1回だけ取り出して解析する。
+    caption_stats を渡すと、図の数とVisionの呼び出し回数が加算される。
+    """
+    import fitz  # PyMuPDF
+
+    from .vision import caption_images
+
+    window_size = getattr(settings, 'RAG_PDF_PAGE_WINDOW', 16)
+    description_by_xref = {}
+    doc = fitz.open(pdf_path)
+    try:
+        page_count = doc.page_count
+        for start in range(0, page_count, window_size):
+            end = min(start + window_size, page_count)
+            pages = []
+            new_images = {}
+            with metrics.span('pdf_extract'):
+                for page_num in range(start, end):
+                    page = doc.load_page(page_num)
+                    positions = []  # (図番号, xref)
+                    for img_index, img in enumerate(page.get_images(full=True)):
+                        xref = img[0]
+                        if xref not in description_by_xref and xref not in new_images:
+                            new_images[xref] = doc.extract_image(xref)["image"]
+                        positions.append((img_index, xref))
+                    pages.append((page_num, extract_text_blocks(page), positions))
+            metrics.inc('rag_pdf_pages_total', end - start)
+            metrics.inc('rag_pdf_image_bytes_total', sum(len(image) for image in new_images.values()))
+
+            # 画像の説明文をAIが並列に生成
+            _report_progress(progress_callback, 10 + 80 * start // page_count,
+                             f'{start + 1}〜{end}ページ目を解析しています({page_count}ページ中)')
+            with metrics.span('vision'):
+                descriptions, window_stats = caption_images(list(new_images.values()))
+            description_by_xref.update(zip(new_images.keys(), descriptions))
+            del new_images
+            if caption_stats is not None:
+                caption_stats['figures'] = caption_stats.get('figures', 0) + sum(len(p[2]) for p in pages)
+                caption_stats['api_calls'] = caption_stats.get('api_calls', 0) + window_stats['api_calls']
+
+            for page_num, blocks, positions in pages:
+                for img_index, xref in positions:
+                    description = description_by_xref[xref]
+                    if description:
+                        blocks.append({'type': 'figure', 'figure_id': f"p{page_num + 1}-f{img_index + 1}",
+                                       'number': img_index + 1, 'text': description})
+                yield page_num + 1, blocks
+    finally:
+        doc.close()
+
+
+def iter_vision_pdf_pages(pdf_path: str, caption_stats: dict = None, progress_callback=None):
+    """
+    ページごとのDocument(テキストと図の説明)を順に返すジェネレータ。
+    """
+    for page, blocks in iter_vision_pdf_page_blocks(pdf_path, caption_stats, progress_callback):
+        text = "\n".join(block['text'] for block in blocks if block['type'] != 'figure')
+        parts = [f"[ページ {page} のテキスト]\n{text}"] if text.strip() else []
+        for block in blocks:
+            if block['type'] == 'figure':
+                parts.append(f"[ページ {page} の図 {block['number']} の説明]\n{block['text']}")
+        if parts:
+            yield Document(page_content="\n\n".join(parts), metadata={'page': page})
+
+
+def create_vectorstore_from_vision_pdf(pdf_path: str, vectorstore_dir: str, progress_callback=None):
     """
     VisionモデルでPDF内の画像を解析し、テキストと統合してベクトルストアを作成する関数。
+    ページ単位で読み込み・分割・ベクトル化を順に流すため、PDFの大きさによらずメモリ使用量はほぼ一定。
+    progress_callback を渡すと、処理の段階ごとに (進捗率, メッセージ) で呼び出される。
     """
     print(f"--- Starting Vision-Enhanced PDF Processing for: {pdf_path} ---")
-    
-    # 1. PyMuPDFでPDFからテキストと画像を抽出
-    doc = fitz.open(pdf_path)
-    all_content = []
-    
-    for page_num, page in enumerate(doc):
-        # ページのテキストを追加
-        all_content.append(f"[ページ {page_num + 1} のテキスト]\n{page.get_text()}")
-        
-        # ページの画像を取得
-        image_list = page.get_images(full=True)
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
-            base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            
-            # 2. 画像の説明文をAIが生成
-            print(f"--- Analyzing image {img_index + 1} on page {page_num + 1} ---")
-            image_description = analyze_image_with_vision(image_bytes)
-            
-            if image_description:
-                all_content.append(f"[ページ {page_num + 1} の図 {img_index + 1} の説明]\n{image_description}")
-
-    doc.close()
-    
-    # 3. 統合したテキストデータを作成
-    full_text_content = "\n\n".join(all_content)
-    
-    if not full_text_content.strip():
-        print("--- Warning: No text content extracted from PDF. ---")
-        return False
-        
-    # 4. ベクトル化 (既存のロジックを再利用)
+    with metrics.span('ingest', pipeline='vision'):
+        return _create_vectorstore_from_vision_pdf(pdf_path, vectorstore_dir, progress_callback)
+
+
+def _create_vectorstore_from_vision_pdf(pdf_path: str, vectorstore_dir: str, progress_callback):
+    structured = getattr(settings, 'RAG_CHUNKING', 'structured') == 'structured'
+    index, pdf_hash = _open_incremental_index(pdf_path, vectorstore_dir, 'structured' if structured else '')
+    if index is None:
+        return True
+    _report_progress(progress_callback, 10, 'PDFからテキストと画像を抽出しています')
+
+    parents = None
     try:
-        print("--- Splitting combined text into chunks... ---")
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-        # テキストを直接渡すため、Documentオブジェクトに変換
-        from langchain_core.documents import Document
-        docs = [Document(page_content=full_text_content)]
-        texts = text_splitter.split_documents(docs)
-        
-        if not texts:
-            print("--- Warning: Document could not be split into texts. ---")
+        caption_stats = {}
+        if structured:
+            # 見出し単位の親セクションを保存し、検索には小さな子チャンクを使う
+            parents = ParentStoreWriter(vectorstore_dir)
+            page_blocks = iter_vision_pdf_page_blocks(pdf_path, caption_stats, progress_callback)
+            chunks = StructuredChunker().split(page_blocks, parents.add)
+        else:
+            # ページごとのDocument → チャンク → バッチごとにベクトル化
+            remove_parent_store(vectorstore_dir)
+            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+            pages = iter_vision_pdf_pages(pdf_path, caption_stats, progress_callback)
+            chunks = _split_documents(pages, text_splitter)
+        chunk_batches = _batched(chunks, getattr(settings, 'RAG_EMBEDDING_BATCH_SIZE', 256))
+        if not _save_incremental_index(index, pdf_hash, chunk_batches):
+            if parents is not None: parents.abort()
             return False
-            
-        print(f"--- Split into {len(texts)} chunks. Starting embedding... ---")
-        embeddings = OpenAIEmbeddings()
-        db = FAISS.from_documents(texts, embeddings)
-        
-        os.makedirs(vectorstore_dir, exist_ok=True)
-        db.save_local(vectorstore_dir)
+        if parents is not None: parents.commit()
+
+        saved_calls = caption_stats.get('figures', 0) - caption_stats.get('api_calls', 0)
+        print(f"--- Vision API calls saved by caching and deduplication: {saved_calls} ---")
         print(f"--- Vision-Enhanced vector store saved to: {vectorstore_dir} ---")
         return True
     except Exception as e:
         print(f"--- An error occurred during vector store creation: {e} ---")
+        if parents is not None: parents.abort()
         return False
 
 def create_vectorstore_from_pdf(pdf_path: str, vectorstore_dir: str):
@@ -121,11 +230,23 @@ def create_vectorstore_from_pdf(pdf_path: str, vectorstore_dir: str):
     Unstructuredを使用して単一のPDFファイルからFAISSベクトルストアを作成する関数。
     成功した場合はTrue、失敗した場合はFalseを返す。
     """
+    with metrics.span('ingest', pipeline='unstructured'):
+        return _create_vectorstore_from_pdf(pdf_path, vectorstore_dir)
+
+
+def _create_vectorstore_from_pdf(pdf_path: str, vectorstore_dir: str):
+    from langchain_community.document_loaders import UnstructuredPDFLoader
+
     try:
+        index, pdf_hash = _open_incremental_index(pdf_path, vectorstore_dir)
+        if index is None:
+            return True
+
         print(f"--- Loading PDF from: {pdf_path} ---")
         # ローダーをUnstructuredPDFLoaderに変更
         loader = UnstructuredPDFLoader(pdf_path, mode="elements")
-        documents = loader.load()
+        with metrics.span('pdf_extract', pipeline='unstructured'):
+            documents = loader.load()
 
         if not documents:
             print("--- Warning: No documents were loaded from the PDF. It might be empty or unreadable. ---")
@@ -140,33 +261,15 @@ def create_vectorstore_from_pdf(pdf_path: str, vectorstore_dir: str):
             print("--- Warning: Document could not be split into texts. ---")
             return False
             
-        print(f"--- Split into {len(texts)} chunks. ---")
-
-        embeddings = OpenAIEmbeddings()
-        db = FAISS.from_documents(texts, embeddings)
-        
-        os.makedirs(vectorstore_dir, exist_ok=True)
-        db.save_local(vectorstore_dir)
+        if not _save_incremental_index(index, pdf_hash, [texts]):
+            return False
         print(f"--- Vector store saved to: {vectorstore_dir} ---")
         return True
     except Exception as e:
         print(f"--- An error occurred during vector store creation: {e} ---")
         return False
 
-def ask_question(query: str, vectorstore_path: str) -> str:
-    """
-    指定されたベクトルストアを使用して、ユーザーの質問に回答を生成する関数。
-    """
-    if not os.path.exists(vectorstore_path):
-        return "ベクトルストアが見つかりません。マニュアルの読み込みからやり直してください。"
-
-    embeddings = OpenAIEmbeddings()
-    vectorstore = FAISS.load_local(vectorstore_path, embeddings, allow_dangerous_deserialization=True)
-
-    retriever = vectorstore.as_retriever(search_kwargs={'k': 4})
-    llm = ChatOpenAI(model_name="gpt-3.5-turbo", temperature=0)
-    
-    prompt_template = """
+QA_PROMPT_TEMPLATE = """
     あなたは製品マニュアルの内容に精通したアシスタントです。
     提供された「コンテキスト情報」だけを元にして、ユーザーの「質問」に日本語で回答してください。
     注意事項としてユーザーからの質問とコンテキスト情報に同じ単語がない場合でも、あなたが意味を予測して答えることは構いません。
@@ -181,17 +284,509 @@ def ask_question(query: str, vectorstore_path: str) -> str:
 
     回答:
     """
-    PROMPT = PromptTemplate(
-        template=prompt_template, input_variables=["context", "question"]
-    )
+RETRIEVAL_K = 4
+QA_PROMPT = PromptTemplate(
+    template=QA_PROMPT_TEMPLATE, input_variables=["context", "question"]
+)
+
+_query_embeddings = None
+_llm = None
+
+
+def get_query_embeddings() -> 'OpenAIEmbeddings':
+    """
+    質問の埋め込みに使うOpenAIEmbeddingsを返す関数。プロセス内で1つを使い回す。
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    global _query_embeddings
+    if _query_embeddings is None:
+        _query_embeddings = OpenAIEmbeddings()
+    return _query_embeddings
+
+
+def get_llm() -> 'ChatOpenAI':
+    """
+    回答生成に使うChatOpenAIを返す関数。プロセス内で1つを使い回す。
+    """
+    from langchain_openai import ChatOpenAI
+
+    global _llm
+    if _llm is None:
+        _llm = ChatOpenAI(model_name=getattr(settings, 'RAG_LLM_MODEL', 'gpt-3.5-turbo'), temperature=0)
+    return _llm
+
+
+_answer_chain = None
+
+
+def get_answer_chain():
+    """
+    検索したチャンクとプロンプトから回答を生成するチェーンを返す関数。プロセス内で1つを使い回す。
+    """
+    global _answer_chain
+    if _answer_chain is None:
+        from langchain.chains.question_answering import load_qa_chain
+
+        _answer_chain = load_qa_chain(llm=get_llm(), chain_type="stuff", prompt=QA_PROMPT)
+    return _answer_chain
+
+
+class LoadedVectorStore:
+    """
+    ロード済みのベクトルストアと、BM25インデックス、親セクション(構造化チャンクの場合)の組
+    """
+
+    def __init__(self, vectorstore, sparse_index=None, parents=None):
+        self.vectorstore = vectorstore
+        self.sparse_index = sparse_index
+        self.parents = parents
+
+
+def vectorstore_exists(vectorstore_path: str) -> bool:
+    if is_shared_path(vectorstore_path):
+        return get_shared_store().manual_range(parse_shared_path(vectorstore_path)) is not None
+    return os.path.exists(vectorstore_path)
+
+
+def load_vectorstore(vectorstore_path: str) -> LoadedVectorStore:
+    """
+    ディスクからベクトルストアを読み込む関数。
+    通常は get_vectorstore_cache() 経由で呼ばれる。
+    """
+    from .docstore import load_vectorstore_dir
+    from .index_factory import set_search_params
+
+    if is_shared_path(vectorstore_path):
+        shared_store = get_shared_store()
+        manual_id = parse_shared_path(vectorstore_path)
+        manual_dir = shared_store.manual_dir(manual_id)
+        return LoadedVectorStore(SharedManualView(shared_store, manual_id), BM25Index.load(manual_dir),
+                                 ParentStore.load(manual_dir))
+
+    print(f"--- Loading vector store from: {vectorstore_path} ---")
+    vectorstore = load_vectorstore_dir(vectorstore_path, get_query_embeddings())
+    set_search_params(vectorstore.index, nprobe=getattr(settings, 'RAG_INDEX_NPROBE', 8),
+                      ef_search=getattr(settings, 'RAG_INDEX_EF_SEARCH', 64))
+    return LoadedVectorStore(vectorstore, BM25Index.load(vectorstore_path), ParentStore.load(vectorstore_path))
+
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def _get_search_pool() -> ThreadPoolExecutor:
+    global _search_pool
+    if _search_pool is None:
+        with _search_pool_lock:
+            if _search_pool is None:
+                _search_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'RAG_SEARCH_THREADS', 8))
+    return _search_pool
+
+
+def _dense_search_ids(vectorstore, vector, k: int) -> list:
+    if isinstance(vectorstore, SharedManualView):
+        return vectorstore.search_ids(vector, k)
+    return _dense_search_ids_batch(vectorstore, [vector], k)[0]
+
+
+def _dense_search_ids_batch(vectorstore, vectors, k: int) -> list:
+    """
+    複数の質問のベクトルをまとめてFAISSで検索し、質問ごとのdocstoreのIDのリストを返す。
+    """
+    import numpy as np
+
+    query = np.asarray(vectors, dtype=np.float32)
+    if vectorstore._normalize_L2:
+        import faiss
+        faiss.normalize_L2(query)
+    _, indices = vectorstore.index.search(query, k)
+    return [[vectorstore.index_to_docstore_id[i] for i in row if i != -1] for row in indices]
+
+
+def retrieve_documents(store: LoadedVectorStore, query: str, vector, k: int = None,
+                       vector_weight: float = None, sparse_weight: float = None) -> list:
+    """
+    ベクトル検索とBM25検索を並列に行い、Reciprocal Rank Fusionで統合した上位k件のチャンクを返す関数。
+    型番やエラーコードのような、ベクトル検索では拾いにくい完全一致の語句に強くなる。
+    BM25インデックスが無い古いベクトルストアや sparse_weight が0の場合はベクトル検索だけを行う。
+    構造化チャンクのベクトルストアでは、検索した子チャンクをトークン数の予算内で親セクションに広げて返す。
+    """
+    docs = _retrieve_chunks(store, query, vector, k, vector_weight, sparse_weight)
+    if store.parents is None:
+        return docs
+    return expand_to_parents(store.parents, docs)
+
+
+def _retrieve_chunks(store: LoadedVectorStore, query: str, vector, k: int = None,
+                     vector_weight: float = None, sparse_weight: float = None) -> list:
+    k = k or RETRIEVAL_K
+    vector_weight = getattr(settings, 'RAG_HYBRID_VECTOR_WEIGHT', 1.0) if vector_weight is None else vector_weight
+    sparse_weight = getattr(settings, 'RAG_HYBRID_SPARSE_WEIGHT', 1.0) if sparse_weight is None else sparse_weight
+    if store.sparse_index is None or not sparse_weight:
+        return store.vectorstore.similarity_search_by_vector(vector, k=k)
+
+    fetch_k = k * getattr(settings, 'RAG_HYBRID_FETCH_MULTIPLIER', 4)
+    pool = _get_search_pool()
+    dense_future = pool.submit(_dense_search_ids, store.vectorstore, vector, fetch_k) if vector_weight else None
+    sparse_future = pool.submit(store.sparse_index.search, query, fetch_k)
+    dense_ids = dense_future.result() if dense_future is not None else []
+    sparse_ids = [doc_id for doc_id, _ in sparse_future.result()]
+
+    fused_ids = reciprocal_rank_fusion([dense_ids, sparse_ids], [vector_weight, sparse_weight],
+                                       getattr(settings, 'RAG_HYBRID_RRF_K', 60))[:k]
+    return [store.vectorstore.docstore.search(doc_id) for doc_id in fused_ids]
+
+
+def retrieve_documents_batch(store: LoadedVectorStore, queries: list, vectors: list, k: int = None,
+                             vector_weight: float = None, sparse_weight: float = None) -> list:
+    """
+    retrieve_documents の複数の質問版。ベクトル検索は全ての質問を1回のFAISSの検索で行う。
+    質問ごとのDocumentのリストを返す。共有インデックスのマニュアルでは1問ずつ検索する。
+    """
+    if isinstance(store.vectorstore, SharedManualView):
+        return [retrieve_documents(store, query, vector, k, vector_weight, sparse_weight)
+                for query, vector in zip(queries, vectors)]
+    k = k or RETRIEVAL_K
+    vector_weight = getattr(settings, 'RAG_HYBRID_VECTOR_WEIGHT', 1.0) if vector_weight is None else vector_weight
+    sparse_weight = getattr(settings, 'RAG_HYBRID_SPARSE_WEIGHT', 1.0) if sparse_weight is None else sparse_weight
+    hybrid = store.sparse_index is not None and sparse_weight
+    fetch_k = k * getattr(settings, 'RAG_HYBRID_FETCH_MULTIPLIER', 4) if hybrid else k
+    if vector_weight or not hybrid:
+        dense_ids = _dense_search_ids_batch(store.vectorstore, vectors, fetch_k)
+    else:
+        dense_ids = [[] for _ in queries]
+
+    results = []
+    for query, ids in zip(queries, dense_ids):
+        if hybrid:
+            sparse_ids = [doc_id for doc_id, _ in store.sparse_index.search(query, fetch_k)]
+            ids = reciprocal_rank_fusion([ids, sparse_ids], [vector_weight, sparse_weight],
+                                         getattr(settings, 'RAG_HYBRID_RRF_K', 60))[:k]
+        docs = [store.vectorstore.docstore.search(doc_id) for doc_id in ids[:k]]
+        if store.parents is not None:
+            docs = expand_to_parents(store.parents, docs)
+        results.append(docs)
+    return results
+
+
+class _QueryCacheContext:
+    """
+    1つの質問について回答キャッシュを引き、回答を保存するための情報。
+    キャッシュのスコープはベクトルストア(=ProcessedManual)と検索オプションの組で、ベクトルストアが再作成されると無効になる。
+    """
+
+    def __init__(self, query: str, vectorstore_path: str, retrieval_options: dict):
+        self.cache = get_answer_cache()
+        self.version = get_store_version(vectorstore_path)
+        self.normalized = normalize_question(query)
+        options = sorted((key, value) for key, value in retrieval_options.items() if value is not None)
+        self.scope_key = f"{vectorstore_path}?{options}" if options else vectorstore_path
+        self.vector = None
+
+    def get_exact(self):
+        if self.cache is None:
+            return None
+        return self.cache.get_exact(self.scope_key, self.version, self.normalized)
+
+    def get_similar(self, vector):
+        self.vector = vector
+        if self.cache is None:
+            return None
+        return self.cache.get_similar(self.scope_key, self.version, vector)
+
+    def remember(self, answer):
+        if self.cache is not None and answer:
+            self.cache.put(self.scope_key, self.version, self.normalized, self.vector, answer)
+
+
+def _prepare_query(query: str, vectorstore_path: str, retrieval_options: dict):
+    """
+    回答キャッシュを引き、ヒットしなければ検索用に質問のベクトルを計算する関数。
+    戻り値は (キャッシュされた回答またはNone, 質問のベクトル, 回答をキャッシュに保存する関数)。
+    """
+    context = _QueryCacheContext(query, vectorstore_path, retrieval_options)
+    answer = context.get_exact()
+    if answer is not None:
+        metrics.inc('rag_answer_cache_lookups_total', result='exact')
+        return answer, None, None
+    with metrics.span('query_embedding'):
+        vector = get_query_embeddings().embed_query(query)
+    answer = context.get_similar(vector)
+    metrics.inc('rag_answer_cache_lookups_total', result='similar' if answer is not None else 'miss')
+    if answer is not None:
+        return answer, vector, None
+    return None, vector, context.remember
+
+
+async def _aprepare_query(query: str, vectorstore_path: str, retrieval_options: dict):
+    """
+    _prepare_query の非同期版。質問のベクトル化は非同期のクライアントで行う。
+    """
+    context = _QueryCacheContext(query, vectorstore_path, retrieval_options)
+    answer = context.get_exact()
+    if answer is not None:
+        metrics.inc('rag_answer_cache_lookups_total', result='exact')
+        return answer, None, None
+    with metrics.span('query_embedding'):
+        vector = await get_query_embeddings().aembed_query(query)
+    answer = context.get_similar(vector)
+    metrics.inc('rag_answer_cache_lookups_total', result='similar' if answer is not None else 'miss')
+    if answer is not None:
+        return answer, vector, None
+    return None, vector, context.remember
+
+
+def _prompt_tokens(docs: list, query: str) -> int:
+    return count_tokens(QA_PROMPT.format(context="\n\n".join(doc.page_content for doc in docs), question=query))
+
+
+def compress_context(docs: list, query: str) -> list:
+    """
+    検索結果から質問に関係の深い文だけを残し、プロンプトをトークン数の予算内に収める関数。
+    圧縮前後のプロンプトのトークン数をログとメトリクスに記録する。RAG_COMPRESSION_ENABLED が無効なら何もしない。
+    """
+    if not docs or not getattr(settings, 'RAG_COMPRESSION_ENABLED', True):
+        return docs
+    with metrics.span('context_compression') as span:
+        before = _prompt_tokens(docs, query)
+        compressed = compress_documents(docs, query)
+        after = _prompt_tokens(compressed, query)
+        span.set(prompt_tokens_before=before, prompt_tokens_after=after)
+    metrics.inc('rag_prompt_tokens_total', before, stage='before_compression')
+    metrics.inc('rag_prompt_tokens_total', after, stage='after_compression')
+    print(f"--- Prompt tokens: {before} -> {after} ({len(docs)} -> {len(compressed)} chunks) ---")
+    return compressed
+
+
+def _count_llm_io(docs: list, query: str, answer: str):
+    metrics.inc('rag_llm_context_bytes_total', sum(len(doc.page_content.encode('utf-8')) for doc in docs)
+                + len(query.encode('utf-8')))
+    metrics.inc('rag_llm_answer_bytes_total', len(answer.encode('utf-8')))
+
+
+def ask_question(query: str, vectorstore_path: str, k: int = None,
+                 vector_weight: float = None, sparse_weight: float = None) -> str:
+    """
+    指定されたベクトルストアを使用して、ユーザーの質問に回答を生成する関数。
+    ロード済みのベクトルストアと回答生成のチェーンはプロセス内で使い回す。
+    同じ質問や十分に似た質問への回答は、回答キャッシュから返しLLMを呼ばない。
+    k, vector_weight, sparse_weight でハイブリッド検索の件数と重みを指定できる(省略時は設定値)。
+    """
+    retrieval_options = {'k': k, 'vector_weight': vector_weight, 'sparse_weight': sparse_weight}
+    if not vectorstore_exists(vectorstore_path):
+        return "ベクトルストアが見つかりません。マニュアルの読み込みからやり直してください。"
+
+    with metrics.span('ask_question'):
+        cached_answer, vector, remember = _prepare_query(query, vectorstore_path, retrieval_options)
+        if cached_answer is not None:
+            return cached_answer
+
+        with metrics.span('index_load'):
+            store = get_vectorstore_cache().get_or_load(vectorstore_path, load_vectorstore)
+        with metrics.span('retrieval'):
+            docs = retrieve_documents(store, query, vector, **retrieval_options)
+        docs = compress_context(docs, query)
+        with metrics.span('llm'):
+            result = get_answer_chain().invoke({"input_documents": docs, "question": query})
+        answer = result['output_text']
+        _count_llm_io(docs, query, answer)
+        remember(answer)
+        return answer
+
+
+async def aask_question(query: str, vectorstore_path: str, k: int = None,
+                        vector_weight: float = None, sparse_weight: float = None) -> str:
+    """
+    ask_question の非同期版。ASGIのイベントループ上で動き、ベクトル化とLLMの呼び出しを待つ間スレッドを占有しない。
+    ベクトルストアの読み込みと検索(CPU処理)はスレッドプールで行う。
+    """
+    retrieval_options = {'k': k, 'vector_weight': vector_weight, 'sparse_weight': sparse_weight}
+    if not await sync_to_async(vectorstore_exists, thread_sensitive=False)(vectorstore_path):
+        return "ベクトルストアが見つかりません。マニュアルの読み込みからやり直してください。"
+
+    with metrics.span('ask_question'):
+        cached_answer, vector, remember = await _aprepare_query(query, vectorstore_path, retrieval_options)
+        if cached_answer is not None:
+            return cached_answer
+
+        with metrics.span('index_load'):
+            store = await sync_to_async(get_vectorstore_cache().get_or_load, thread_sensitive=False)(
+                vectorstore_path, load_vectorstore)
+        with metrics.span('retrieval'):
+            docs = await sync_to_async(retrieve_documents, thread_sensitive=False)(
+                store, query, vector, **retrieval_options)
+        docs = await sync_to_async(compress_context, thread_sensitive=False)(docs, query)
+        with metrics.span('llm'):
+            result = await get_answer_chain().ainvoke({"input_documents": docs, "question": query})
+        answer = result['output_text']
+        _count_llm_io(docs, query, answer)
+        remember(answer)
+        return answer
+
+
+def answer_questions(questions: list, vectorstore_path: str, k: int = None, vector_weight: float = None,
+                     sparse_weight: float = None, concurrency: int = None):
+    """
+    1つのマニュアルに対する複数の質問に回答し、終わったものから結果の辞書を順に返すジェネレータ。
+    質問のベクトル化は1回のAPI呼び出しで、ベクトル検索は1回のFAISSの検索でまとめて行う。
+    回答の生成は最大 concurrency 件(省略時は RAG_BATCH_LLM_CONCURRENCY)を並列に行う。
+    正規化すると同じになる質問は1回だけ回答し、同じ結果をそれぞれの番号で入力の順に返す。
+    結果には質問の番号(index)、回答またはエラー、回答キャッシュを使ったかどうかと、段階ごとの時間(ミリ秒)が入る。
+    ベクトル化と検索の時間は全ての質問で共通。
+    """
+    retrieval_options = {'k': k, 'vector_weight': vector_weight, 'sparse_weight': sparse_weight}
+    concurrency = concurrency or getattr(settings, 'RAG_BATCH_LLM_CONCURRENCY', 8)
+    started = time.perf_counter()
+
+    def elapsed_ms(since):
+        return round((time.perf_counter() - since) * 1000, 1)
+
+    def result(index, answer=None, error=None, cached=False, **timing):
+        timing['total_ms'] = elapsed_ms(started)
+        item = {'index': index, 'question': questions[index], 'cached': cached, 'timing': timing}
+        if error is not None:
+            item['error'] = error
+        else:
+            item['answer'] = answer
+        return item
+
+    def results(index, *args, **kwargs):
+        for same_index in duplicates[index]:
+            yield result(same_index, *args, **kwargs)
+
+    if not vectorstore_exists(vectorstore_path):
+        for index in range(len(questions)):
+            yield result(index, error="ベクトルストアが見つかりません。マニュアルの読み込みからやり直してください。")
+        return
+    metrics.inc('rag_batch_questions_total', len(questions))
+
+    # 正規化すると同じになる質問をまとめ、最初の質問の番号で1回だけ回答する
+    groups = {}
+    for index, query in enumerate(questions):
+        groups.setdefault(normalize_question(query), []).append(index)
+    duplicates = {indexes[0]: indexes for indexes in groups.values()}
+
+    # 完全一致の回答キャッシュ
+    contexts = {index: _QueryCacheContext(questions[index], vectorstore_path, retrieval_options) for index in duplicates}
+    pending = []
+    for index, context in contexts.items():
+        answer = context.get_exact()
+        if answer is not None:
+            metrics.inc('rag_answer_cache_lookups_total', result='exact')
+            yield from results(index, answer, cached=True)
+        else:
+            pending.append(index)
+    if not pending:
+        return
+
+    # ベクトル化と近似一致の回答キャッシュ
+    embedding_started = time.perf_counter()
+    with metrics.span('query_embedding', batch='true'):
+        vectors = get_query_embeddings().embed_documents([questions[index] for index in pending])
+    embedding_ms = elapsed_ms(embedding_started)
+    misses = []
+    for index, vector in zip(pending, vectors):
+        answer = contexts[index].get_similar(vector)
+        metrics.inc('rag_answer_cache_lookups_total', result='similar' if answer is not None else 'miss')
+        if answer is not None:
+            yield from results(index, answer, cached=True, embedding_ms=embedding_ms)
+        else:
+            misses.append((index, vector))
+    if not misses:
+        return
+
+    retrieval_started = time.perf_counter()
+    with metrics.span('index_load'):
+        store = get_vectorstore_cache().get_or_load(vectorstore_path, load_vectorstore)
+    with metrics.span('retrieval', batch='true'):
+        docs_list = retrieve_documents_batch(store, [questions[index] for index, _ in misses],
+                                             [vector for _, vector in misses], **retrieval_options)
+    retrieval_ms = elapsed_ms(retrieval_started)
+
+    def generate(index, docs):
+        llm_started = time.perf_counter()
+        query = questions[index]
+        docs = compress_context(docs, query)
+        with metrics.span('llm'):
+            answer = get_answer_chain().invoke({"input_documents": docs, "question": query})['output_text']
+        _count_llm_io(docs, query, answer)
+        contexts[index].remember(answer)
+        return answer, elapsed_ms(llm_started)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='rag-batch') as pool:
+        futures = {pool.submit(generate, index, docs): index for (index, _), docs in zip(misses, docs_list)}
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    answer, llm_ms = future.result()
+                except Exception as e:
+                    print(f"--- Batch question {index} failed: {e} ---")
+                    yield from results(index, error=str(e), embedding_ms=embedding_ms, retrieval_ms=retrieval_ms)
+                else:
+                    yield from results(index, answer, embedding_ms=embedding_ms, retrieval_ms=retrieval_ms,
+                                       llm_ms=llm_ms)
+        finally:
+            # 途中で読むのをやめられた場合(クライアントの切断など)は、まだ始まっていない回答の生成を取り消す
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_answer(query: str, vectorstore_path: str, k: int = None,
+                  vector_weight: float = None, sparse_weight: float = None):
+    """
+    ask_question のストリーミング版。以下のイベントを (種類, データ) の形で順に返すジェネレータ。
+      ('sources', 検索されたチャンクのメタデータのリスト)
+      ('token', 生成されたテキストの断片)
+      ('done', 最初のトークンまでの時間と全体の時間)
+    回答キャッシュにヒットした場合は、sourcesを空にして回答全体を1つのtokenとして返す。
+    """
+    retrieval_options = {'k': k, 'vector_weight': vector_weight, 'sparse_weight': sparse_weight}
+    started = time.perf_counter()
+    if not vectorstore_exists(vectorstore_path):
+        yield ('token', "ベクトルストアが見つかりません。マニュアルの読み込みからやり直してください。")
+        yield ('done', {'time_to_first_token': None, 'total_time': time.perf_counter() - started})
+        return
+
+    cached_answer, vector, remember = _prepare_query(query, vectorstore_path, retrieval_options)
+    if cached_answer is not None:
+        yield ('sources', [])
+        elapsed = time.perf_counter() - started
+        yield ('token', cached_answer)
+        yield ('done', {'time_to_first_token': elapsed, 'total_time': elapsed, 'cached': True})
+        return
+
+    with metrics.span('index_load'):
+        store = get_vectorstore_cache().get_or_load(vectorstore_path, load_vectorstore)
+    with metrics.span('retrieval'):
+        docs = retrieve_documents(store, query, vector, **retrieval_options)
+    docs = compress_context(docs, query)
+    yield ('sources', [
+        {'rank': rank, 'metadata': doc.metadata, 'preview': doc.page_content[:100]}
+        for rank, doc in enumerate(docs, start=1)
+    ])
 
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        chain_type_kwargs={"prompt": PROMPT},
-        return_source_documents=False
-    )
+    prompt = QA_PROMPT.format(context="\n\n".join(doc.page_content for doc in docs), question=query)
+    time_to_first_token = None
+    tokens = []
+    llm_started = time.perf_counter()
+    for chunk in get_llm().stream(prompt):
+        if not chunk.content:
+            continue
+        if time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - started
+        tokens.append(chunk.content)
+        yield ('token', chunk.content)
+    answer = "".join(tokens)
+    remember(answer)
 
-    result = qa_chain.invoke({"query": query})
-    return result['result']
\ No newline at end of file
+    total_time = time.perf_counter() - started
+    # ジェネレータは途中で止まることがあるため、spanではなく経過時間を直接記録する
+    metrics.observe('rag_stage_seconds', time.perf_counter() - llm_started, stage='llm_stream', outcome='ok')
+    metrics.observe('rag_stage_seconds', total_time, stage='stream_answer', outcome='ok')
+    if time_to_first_token is not None:
+        metrics.observe('rag_time_to_first_token_seconds', time_to_first_token)
+    metrics.inc('rag_llm_stream_chunks_total', len(tokens))
+    _count_llm_io(docs, query, answer)
+    print(f"--- Streamed answer: first token {time_to_first_token}s, total {total_time:.2f}s ---")
+    yield ('done', {'time_to_first_token': time_to_first_token, 'total_time': total_time, 'cached': False})
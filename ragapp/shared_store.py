@@ -0,0 +1,370 @@
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+# faissとlangchainは、共有インデックスを使わないプロセス(Webのワーカーなど)で読み込まないよう、使うメソッドの中でimportする
+
+# ProcessedManual.vectorstore_path にこの形式で保存されたマニュアルは共有インデックスを使う
+SHARED_PREFIX = 'shared://'
+STATE_NAME = 'state.json'
+# マニュアルごとのBM25インデックスと親セクションを置くディレクトリ
+MANUALS_DIR = 'manuals'
+
+
+def is_shared_path(vectorstore_path: str) -> bool:
+    return vectorstore_path.startswith(SHARED_PREFIX)
+
+
+def make_shared_path(manual_id: int) -> str:
+    return f"{SHARED_PREFIX}{manual_id}"
+
+
+def parse_shared_path(vectorstore_path: str) -> int:
+    return int(vectorstore_path[len(SHARED_PREFIX):])
+
+
+class SharedVectorStore:
+    """
+    全マニュアルのチャンクを1つのFAISSインデックスにまとめた共有ベクトルストア。
+    1つのマニュアルのチャンクはインデックス内で連続した行に置き、その範囲(ranges)だけを対象に検索する。
+    行ごとのマニュアルIDとチャンクIDは小さなnumpy配列で持ち、チャンクのテキストはSQLiteから必要な分だけ読む。
+    マニュアルを削除しても行はすぐには消えず、compact() で詰め直したときに回収される。
+
+    書き込みは世代(generation)ごとに新しいファイルを作り、最後に state.json を置き換えて公開する。
+    読み出し側は state.json の更新時刻を見て新しい世代を読み込む。
+    マニュアルごとのBM25インデックス(IDはチャンクのuid)と親セクションは manuals/<マニュアルID>/ に置く。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._state_mtime = None
+        self.state = {'generation': 0, 'files': None, 'ranges': {}, 'dead_rows': 0}
+        self.index = None
+        self.uids = np.zeros(0, dtype=np.int64)
+        self.manual_ids = np.zeros(0, dtype=np.int32)
+
+        self._db = sqlite3.connect(os.path.join(directory, 'chunks.sqlite3'), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "uid INTEGER PRIMARY KEY AUTOINCREMENT, manual_id INTEGER NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._db.commit()
+        self.refresh()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def manual_dir(self, manual_id: int) -> str:
+        return os.path.join(self.directory, MANUALS_DIR, str(manual_id))
+
+    def refresh(self):
+        """
+        他のプロセスが新しい世代を公開していれば読み込む。
+        """
+        import faiss
+
+        try:
+            mtime = os.stat(self._path(STATE_NAME)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._state_mtime:
+            return
+        with self._lock:
+            for attempt in range(3):
+                with open(self._path(STATE_NAME), encoding='utf-8') as f:
+                    state = json.load(f)
+                if state['files'] == self.state['files'] and self.index is not None:
+                    break
+                files = state['files']
+                try:
+                    index = faiss.read_index(self._path(f"index-{files}.faiss"))
+                    uids = np.load(self._path(f"uids-{files}.npy"), mmap_mode='r')
+                    manual_ids = np.load(self._path(f"manual_ids-{files}.npy"), mmap_mode='r')
+                except (FileNotFoundError, RuntimeError):
+                    # 読み込み中に2世代以上新しいものが公開されてファイルが消えた場合は、state.json から読み直す
+                    if attempt == 2:
+                        raise
+                    mtime = os.stat(self._path(STATE_NAME)).st_mtime_ns
+                    continue
+                self.index, self.uids, self.manual_ids = index, uids, manual_ids
+                break
+            self.state = state
+            self._state_mtime = mtime
+
+    def manual_range(self, manual_id: int):
+        self.refresh()
+        return self.state['ranges'].get(str(manual_id))
+
+    def manual_version(self, manual_id: int):
+        """
+        マニュアルのデータが変わると変わる値を返す。登録されていなければNoneを返す。
+        """
+        manual_range = self.manual_range(manual_id)
+        return (self.state['files'], tuple(manual_range)) if manual_range else None
+
+    def search(self, manual_id: int, vector, k: int) -> list:
+        """
+        指定したマニュアルの行の範囲だけを検索し、近い順にDocumentを返す。
+        """
+        return self.fetch_documents(self.search_ids(manual_id, vector, k))
+
+    def search_ids(self, manual_id: int, vector, k: int) -> list:
+        """
+        search と同じだが、チャンクのuidのリストを返す。
+        """
+        import faiss
+
+        self.refresh()
+        with self._lock:
+            index, uids, manual_range = self.index, self.uids, self.state['ranges'].get(str(manual_id))
+        if not manual_range:
+            return []
+        start, end = manual_range
+        query = np.asarray([vector], dtype=np.float32)
+        params = faiss.SearchParameters(sel=faiss.IDSelectorRange(start, end))
+        _, indices = index.search(query, min(k, end - start), params=params)
+        return [int(uids[i]) for i in indices[0] if i != -1]
+
+    def fetch_documents(self, uids: list) -> list:
+        from langchain_core.documents import Document
+
+        if not uids:
+            return []
+        placeholders = ','.join('?' * len(uids))
+        with self._lock:
+            rows = dict((uid, (text, metadata)) for uid, text, metadata in self._db.execute(
+                f"SELECT uid, text, metadata FROM chunks WHERE uid IN ({placeholders})", uids
+            ))
+        return [Document(page_content=rows[uid][0], metadata=json.loads(rows[uid][1])) for uid in uids if uid in rows]
+
+    @contextmanager
+    def _writing(self):
+        """
+        書き込み中はスレッド間・プロセス間で排他し、最新の世代を読み込んでから変更する。
+        """
+        with self._lock:
+            with open(self._path('.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.refresh()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add_manual(self, manual_id: int, texts: list, metadatas: list, vectors, before_publish=None):
+        """
+        マニュアルのチャンクを追加する。既に登録されている場合は古い行を削除扱いにして置き換える。
+        before_publish を渡すと、新しい世代を公開する直前に追加したチャンクのuidのリストで呼び出す。
+        """
+        import faiss
+
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._writing():
+            with self._db:
+                new_uids = []
+                for text, metadata in zip(texts, metadatas):
+                    cursor = self._db.execute(
+                        "INSERT INTO chunks (manual_id, text, metadata) VALUES (?, ?, ?)",
+                        (manual_id, text, json.dumps(metadata, ensure_ascii=False)),
+                    )
+                    new_uids.append(cursor.lastrowid)
+
+            # 検索中の他のスレッドに影響しないよう、複製したインデックスに追加する
+            index = faiss.clone_index(self.index) if self.index is not None else faiss.IndexFlatL2(vectors.shape[1])
+            start = index.ntotal
+            index.add(vectors)
+
+            ranges = dict(self.state['ranges'])
+            dead_rows = self.state['dead_rows']
+            old_range = ranges.pop(str(manual_id), None)
+            if old_range:
+                dead_rows += old_range[1] - old_range[0]
+            ranges[str(manual_id)] = [start, start + len(vectors)]
+
+            uids = np.concatenate([self.uids, np.asarray(new_uids, dtype=np.int64)])
+            manual_ids = np.concatenate([self.manual_ids, np.full(len(vectors), manual_id, dtype=np.int32)])
+            if before_publish is not None:
+                before_publish(new_uids)
+            self._publish(ranges, dead_rows, index, uids, manual_ids)
+
+    def delete_manual(self, manual_id: int):
+        """
+        マニュアルを検索対象から外す。行は compact() で回収される。
+        """
+        with self._writing():
+            ranges = dict(self.state['ranges'])
+            old_range = ranges.pop(str(manual_id), None)
+            if old_range:
+                self._publish(ranges, self.state['dead_rows'] + old_range[1] - old_range[0])
+            shutil.rmtree(self.manual_dir(manual_id), ignore_errors=True)
+
+    def compact(self) -> int:
+        """
+        削除されたマニュアルの行を取り除いてインデックスを作り直し、回収した行数を返す。
+        """
+        import faiss
+
+        with self._writing():
+            if self.index is None or not self.state['dead_rows']:
+                return 0
+            index = faiss.IndexFlatL2(self.index.d)
+            ranges = {}
+            live_rows = []
+            for manual_key, (start, end) in sorted(self.state['ranges'].items(), key=lambda item: item[1][0]):
+                ranges[manual_key] = [index.ntotal, index.ntotal + end - start]
+                index.add(self.index.reconstruct_n(start, end - start))
+                live_rows.extend(range(start, end))
+
+            live_rows = np.asarray(live_rows, dtype=np.int64)
+            uids = np.asarray(self.uids)[live_rows] if len(live_rows) else np.zeros(0, dtype=np.int64)
+            manual_ids = np.asarray(self.manual_ids)[live_rows] if len(live_rows) else np.zeros(0, dtype=np.int32)
+            reclaimed = self.index.ntotal - index.ntotal
+            self._publish(ranges, 0, index, uids, manual_ids)
+
+            # 検索対象から外れた行のチャンクをSQLiteからも削除する
+            with self._db:
+                if len(uids):
+                    self._db.execute("CREATE TEMP TABLE IF NOT EXISTS live_uids (uid INTEGER PRIMARY KEY)")
+                    self._db.execute("DELETE FROM live_uids")
+                    self._db.executemany("INSERT INTO live_uids (uid) VALUES (?)", [(int(uid),) for uid in uids])
+                    self._db.execute("DELETE FROM chunks WHERE uid NOT IN (SELECT uid FROM live_uids)")
+                else:
+                    self._db.execute("DELETE FROM chunks")
+            return reclaimed
+
+    def _publish(self, ranges, dead_rows, index=None, uids=None, manual_ids=None):
+        import faiss
+
+        generation = self.state['generation'] + 1
+        previous_files = files = self.state['files']
+        if index is not None:
+            files = generation
+            faiss.write_index(index, self._path(f"index-{files}.faiss"))
+            np.save(self._path(f"uids-{files}.npy"), uids)
+            np.save(self._path(f"manual_ids-{files}.npy"), manual_ids)
+
+        state = {'generation': generation, 'files': files, 'ranges': ranges, 'dead_rows': dead_rows}
+        tmp_path = self._path(f"{STATE_NAME}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._path(STATE_NAME))
+
+        if index is not None:
+            self.index = index
+            self.uids = uids
+            self.manual_ids = manual_ids
+        self.state = state
+        self._state_mtime = os.stat(self._path(STATE_NAME)).st_mtime_ns
+
+        # 古い世代のファイルを削除する(読み込み済みのプロセスはメモリ上のデータを使い続ける)
+        # 直前の世代は、新しい state.json を読む前に読み込みを始めたプロセスのために残す
+        keep = {str(files), str(previous_files)}
+        for name in os.listdir(self.directory):
+            for prefix, suffix in (('index-', '.faiss'), ('uids-', '.npy'), ('manual_ids-', '.npy')):
+                if name.startswith(prefix) and name.endswith(suffix) and name[len(prefix):-len(suffix)] not in keep:
+                    os.remove(self._path(name))
+
+    def import_directory(self, manual_id: int, vectorstore_dir: str, embeddings):
+        """
+        ディレクトリ形式のFAISSベクトルストアを読み込み、マニュアルとして追加する。追加したチャンク数を返す。
+        """
+        from .docstore import load_vectorstore_dir
+        from .index_factory import reconstruct_vectors
+
+        db = load_vectorstore_dir(vectorstore_dir, embeddings)
+        vectors = reconstruct_vectors(db, embeddings)
+        documents = [db.docstore.search(db.index_to_docstore_id[i]) for i in range(db.index.ntotal)]
+        if not documents:
+            return 0
+        texts = [doc.page_content for doc in documents]
+
+        def write_manual_files(uids):
+            self._write_manual_files(manual_id, vectorstore_dir, zip(uids, texts))
+
+        self.add_manual(manual_id, texts, [doc.metadata for doc in documents], vectors, write_manual_files)
+        return len(documents)
+
+    def _write_manual_files(self, manual_id: int, vectorstore_dir: str, uid_texts):
+        """
+        マニュアルのBM25インデックスを共有インデックスのuidで作り直し、親セクション(あれば)と一緒に
+        manual_dir() に置く。一時ディレクトリに書いてから置き換える。
+        """
+        from .chunking import PARENTS_NAME
+        from .sparse_index import BM25Index
+
+        target = self.manual_dir(manual_id)
+        tmp_dir = f"{target}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(tmp_dir)
+        try:
+            BM25Index.build(uid_texts).save(tmp_dir)
+            parents_path = os.path.join(vectorstore_dir, PARENTS_NAME)
+            if os.path.exists(parents_path):
+                shutil.copy2(parents_path, os.path.join(tmp_dir, PARENTS_NAME))
+            old_dir = None
+            if os.path.exists(target):
+                old_dir = f"{target}.old-{uuid.uuid4().hex}"
+                os.rename(target, old_dir)
+            os.rename(tmp_dir, target)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if old_dir:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+class _SharedDocstore:
+    """
+    uidでチャンクを読み出す、LangChainのdocstoreと同じ名前のメソッドを持つラッパー。
+    """
+
+    def __init__(self, store: SharedVectorStore):
+        self.store = store
+
+    def search(self, uid: int):
+        documents = self.store.fetch_documents([uid])
+        return documents[0] if documents else None
+
+
+class SharedManualView:
+    """
+    共有ベクトルストアを1つのマニュアルに絞って扱うためのラッパー。
+    LangChainのFAISSと同じ名前の検索メソッドと docstore を持つ。
+    """
+
+    def __init__(self, store: SharedVectorStore, manual_id: int):
+        self.store = store
+        self.manual_id = manual_id
+        self.docstore = _SharedDocstore(store)
+
+    def similarity_search_by_vector(self, vector, k: int = 4):
+        return self.store.search(self.manual_id, vector, k)
+
+    def search_ids(self, vector, k: int) -> list:
+        return self.store.search_ids(self.manual_id, vector, k)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_shared_store() -> SharedVectorStore:
+    """
+    プロセス全体で共有するSharedVectorStoreを返す関数。
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SharedVectorStore(str(getattr(settings, 'RAG_SHARED_INDEX_DIR',
+                                                       os.path.join(settings.BASE_DIR, 'vectorstores', 'shared'))))
+    return _store
@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .models import ProcessedManual
+from .shared_store import get_shared_store, is_shared_path, parse_shared_path
+
+
+@receiver(post_delete, sender=ProcessedManual)
+def remove_from_shared_store(sender, instance, **kwargs):
+    """
+    共有インデックスを使うマニュアルが削除されたら、そのマニュアルを検索対象から外す。
+    """
+    if not instance.vectorstore_path or not is_shared_path(instance.vectorstore_path):
+        return
+    # 同じ内容のPDFの別のマニュアルが使っている場合は残す
+    if not ProcessedManual.objects.filter(vectorstore_path=instance.vectorstore_path).exists():
+        get_shared_store().delete_manual(parse_shared_path(instance.vectorstore_path))
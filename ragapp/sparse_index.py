@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import re
+import unicodedata
+from collections import Counter
+
+SPARSE_INDEX_NAME = 'sparse_index.json'
+
+# 型番やエラーコード(例: "e-07", "msz-zw4024s")は記号を含めて1つのトークンにする
+_ASCII_TOKEN = re.compile(r'[a-z0-9]+(?:[-_./][a-z0-9]+)*')
+_CJK_RUN = re.compile(r'[぀-ヿ㐀-鿿豈-﫿]+')
+
+
+def tokenize(text: str) -> list:
+    """
+    BM25用のトークン分割。英数字は記号でつながった語とその構成要素、日本語は文字bigramにする。
+    """
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for match in _ASCII_TOKEN.finditer(text):
+        token = match.group()
+        tokens.append(token)
+        parts = re.split(r'[-_./]', token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+            tokens.append(''.join(parts))
+    for match in _CJK_RUN.finditer(text):
+        run = match.group()
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class BM25Index:
+    """
+    チャンクの転置インデックスとBM25によるスコア計算。
+    doc_ids にはFAISSのdocstoreと同じIDを使う。
+    """
+
+    def __init__(self, doc_ids, doc_lengths, postings, k1=1.5, b=0.75):
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+
+    @classmethod
+    def build(cls, documents):
+        """
+        (ID, テキスト) のイテラブルからインデックスを作る。
+        """
+        doc_ids, doc_lengths, postings = [], [], {}
+        for doc_id, text in documents:
+            tokens = tokenize(text)
+            doc_index = len(doc_ids)
+            doc_ids.append(doc_id)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_index, tf))
+        return cls(doc_ids, doc_lengths, postings)
+
+    def search(self, query: str, k: int) -> list:
+        """
+        スコアの高い順に (ID, スコア) のリストを返す。
+        """
+        n = len(self.doc_ids)
+        if not n:
+            return []
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_index, tf in posting:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_index] / (self.avg_length or 1))
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.doc_ids[doc_index], score) for doc_index, score in ranked]
+
+    def save(self, vectorstore_dir: str):
+        data = {'doc_ids': self.doc_ids, 'doc_lengths': self.doc_lengths, 'postings': self.postings}
+        with open(os.path.join(vectorstore_dir, SPARSE_INDEX_NAME), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, vectorstore_dir: str):
+        """
+        保存されたインデックスを読み込む。無い場合(古いベクトルストア)はNoneを返す。
+        """
+        path = os.path.join(vectorstore_dir, SPARSE_INDEX_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['doc_ids'], data['doc_lengths'], data['postings'])
+
+
+def save_sparse_index(db, vectorstore_dir: str):
+    """
+    FAISSベクトルストアの全チャンクからBM25インデックスを作り、同じディレクトリに保存する関数。
+    """
+    docstore = db.docstore
+    documents = ((doc_id, docstore.search(doc_id).page_content) for doc_id in db.index_to_docstore_id.values())
+    BM25Index.build(documents).save(vectorstore_dir)
+
+
+def reciprocal_rank_fusion(rankings: list, weights: list, rrf_k: int = 60) -> list:
+    """
+    複数のランキング(IDのリスト)をReciprocal Rank Fusionで1つにまとめ、スコアの高い順のIDを返す関数。
+    """
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        if not weight:
+            continue
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (rrf_k + rank)
+    return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True)]
@@ -1,3 +1,602 @@
+import hashlib
+import itertools
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models.query import QuerySet
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from .caption_cache import CaptionCache, caption_cache_key
+from .chunking import StructuredChunker
+from .compression import compress_documents
+from .devtools.synthetic_manual import generate_manual
+from .embeddings import CachedEmbeddings, EmbeddingStore
+from .incremental import MANIFEST_NAME, IncrementalIndex, make_chunk_ids
+from .jobs import (
+    _owned, claim_next_job, enqueue_product, enqueue_upload, prepare_build_dir, publish_build_dir, update_progress,
+)
+from .lifecycle import evict, find_orphans, plan_eviction, vectorstore_root
+from .models import ProcessedManual
+from .shared_store import make_shared_path
+from .sparse_index import BM25Index, reciprocal_rank_fusion, tokenize
+
+# テストはOpenAIにもtiktokenのダウンロードにもアクセスしない。
+# 埋め込みは文字列のハッシュから作り、トークンは1文字を1トークンとして数える。
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    テキストのハッシュから決まったベクトルを返すEmbeddings。呼ばれたテキストを calls に記録する。
+    """
+
+    def __init__(self, dim: int = 8):
+        self.dim = dim
+        self.calls = []
+
+    def _vector(self, text: str) -> list:
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        return [digest[i] / 255 for i in range(self.dim)]
+
+    def embed_documents(self, texts: list) -> list:
+        self.calls.append(list(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self._vector(text)
+
+
+class CharEncoding:
+    """
+    1文字を1トークンとして数えるtiktokenの代わり。
+    """
+
+    def encode(self, text: str, disallowed_special=()) -> list:
+        return [ord(char) for char in text]
+
+    def decode(self, tokens: list) -> str:
+        return ''.join(chr(token) for token in tokens)
+
+
+class FakeDocstore:
+    def __init__(self):
+        self.documents = {}
+
+    def search(self, doc_id: str):
+        return self.documents.get(doc_id, f"ID {doc_id} not found.")
+
+
+class FakeVectorStore:
+    """
+    IncrementalIndex から使われる範囲だけを実装した、FAISSの代わりのベクトルストア。
+    """
+    saved = {}
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.docstore = FakeDocstore()
+        self.index_to_docstore_id = {}
+
+    @classmethod
+    def from_documents(cls, docs, embeddings, ids):
+        db = cls(embeddings)
+        db.add_documents(docs, ids=ids)
+        return db
+
+    def add_documents(self, docs, ids):
+        self.embeddings.embed_documents([doc.page_content for doc in docs])
+        for doc_id, doc in zip(ids, docs):
+            self.docstore.documents[doc_id] = Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+        self._reindex()
+
+    def delete(self, ids):
+        for doc_id in ids:
+            del self.docstore.documents[doc_id]
+        self._reindex()
+
+    def _reindex(self):
+        self.index_to_docstore_id = dict(enumerate(self.docstore.documents))
+
+    @classmethod
+    def save(cls, db, vectorstore_dir):
+        os.makedirs(vectorstore_dir, exist_ok=True)
+        open(os.path.join(vectorstore_dir, 'index.faiss'), 'wb').close()
+        cls.saved[vectorstore_dir] = {doc_id: (doc.page_content, dict(doc.metadata))
+                                      for doc_id, doc in db.docstore.documents.items()}
+
+    @classmethod
+    def load(cls, vectorstore_dir, embeddings, lazy=True):
+        db = cls(embeddings)
+        for doc_id, (text, metadata) in cls.saved[vectorstore_dir].items():
+            db.docstore.documents[doc_id] = Document(page_content=text, metadata=dict(metadata))
+        db._reindex()
+        return db
+
+
+class TempDirMixin:
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp(prefix='ragapp-test-')
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+
+
+class SparseIndexTests(TestCase):
+    def test_tokenize_keeps_model_numbers_and_their_parts(self):
+        tokens = tokenize('MSZ-ZW4024S')
+        self.assertIn('msz-zw4024s', tokens)
+        self.assertIn('msz', tokens)
+        self.assertIn('zw4024s', tokens)
+        self.assertIn('mszzw4024s', tokens)
+
+    def test_tokenize_splits_japanese_into_bigrams(self):
+        self.assertEqual(tokenize('掃除方法'), ['掃除', '除方', '方法'])
+        self.assertEqual(tokenize('図'), ['図'])
+
+    def test_tokenize_normalizes_full_width_characters(self):
+        self.assertEqual(tokenize('Ｅ－０７'), tokenize('e-07'))
+
+    def test_bm25_finds_error_code(self):
+        index = BM25Index.build([
+            ('a', 'エラーコード E-07 が表示された場合は電源を入れ直してください。'),
+            ('b', 'フィルターは2週間に1回掃除してください。'),
+        ])
+        self.assertEqual(index.search('E-07', 2)[0][0], 'a')
+        self.assertEqual(index.search('該当なし', 2), [])
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'a']], [1.0, 1.0])
+        self.assertEqual(fused, ['a', 'c', 'b'])
+
+    def test_reciprocal_rank_fusion_ignores_zero_weight(self):
+        fused = reciprocal_rank_fusion([['a', 'b'], ['c']], [1.0, 0.0])
+        self.assertEqual(fused, ['a', 'b'])
+
+
+@mock.patch('ragapp.tokens._encoding', CharEncoding())
+class CompressionTests(TestCase):
+    def test_keeps_relevant_sentences_and_drops_duplicates(self):
+        docs = [
+            Document(page_content='フィルターの掃除は2週間に1回行ってください。電源コードを抜いてください。',
+                     metadata={'page': 3}),
+            Document(page_content='フィルターの掃除は2週間に1回行ってください。', metadata={'page': 7}),
+        ]
+        result = compress_documents(docs, 'フィルターの掃除の頻度は？', token_budget=1000)
+        content = "\n".join(doc.page_content for doc in result)
+        self.assertEqual(content.count('フィルターの掃除'), 1)
+        self.assertNotIn('電源コード', content)
+        self.assertEqual(result[0].metadata, {'page': 3})
+
+    def test_keeps_header_line_with_its_sentences(self):
+        docs = [Document(page_content='[ページ 3 のテキスト]\nフィルターの掃除は2週間に1回行ってください。')]
+        result = compress_documents(docs, 'フィルターの掃除', token_budget=1000)
+        self.assertTrue(result[0].page_content.startswith('[ページ 3 のテキスト]\n'))
+
+    def test_stays_within_budget(self):
+        docs = [Document(page_content='フィルターの掃除は2週間に1回行ってください。フィルターは水洗いできます。')]
+        result = compress_documents(docs, 'フィルターの掃除', token_budget=25)
+        self.assertLessEqual(sum(len(doc.page_content) for doc in result), 25)
+        self.assertIn('フィルターの掃除', result[0].page_content)
+
+    def test_truncates_top_sentence_when_nothing_fits(self):
+        docs = [Document(page_content='フィルターの掃除は2週間に1回行ってください。', metadata={'page': 1})]
+        result = compress_documents(docs, 'フィルターの掃除', token_budget=5)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].page_content, 'フィルター')
+        self.assertEqual(result[0].metadata, {'page': 1})
+
+
+class CaptionCacheTests(TempDirMixin, TestCase):
+    def test_key_depends_on_image_prompt_and_model(self):
+        key = caption_cache_key(b'image', 'prompt', 'gpt-4o')
+        self.assertEqual(key, caption_cache_key(b'image', 'prompt', 'gpt-4o'))
+        self.assertNotEqual(key, caption_cache_key(b'other', 'prompt', 'gpt-4o'))
+        self.assertNotEqual(key, caption_cache_key(b'image', 'other', 'gpt-4o'))
+        self.assertNotEqual(key, caption_cache_key(b'image', 'prompt', 'gpt-4o-mini'))
+
+    def test_persists_captions(self):
+        path = os.path.join(self.temp_dir, 'captions.sqlite3')
+        CaptionCache(path, max_bytes=1024).set_many({'a': '説明A', 'b': '説明B'})
+        self.assertEqual(CaptionCache(path, max_bytes=1024).get_many(['a', 'b', 'c']), {'a': '説明A', 'b': '説明B'})
+
+    def test_evicts_least_recently_used(self):
+        with mock.patch('ragapp.caption_cache.time') as clock:
+            clock.time.side_effect = itertools.count(1000).__next__
+            cache = CaptionCache(os.path.join(self.temp_dir, 'captions.sqlite3'), max_bytes=10)
+            cache.set_many({'a': '12345'})
+            cache.set_many({'b': '12345'})
+            cache.get_many(['a'])
+            cache.set_many({'c': '12345'})
+            self.assertEqual(sorted(cache.get_many(['a', 'b', 'c'])), ['a', 'c'])
+
+
+class EmbeddingCacheTests(TempDirMixin, TestCase):
+    def test_embeds_each_new_text_once(self):
+        base = FakeEmbeddings()
+        embeddings = CachedEmbeddings(base, 'fake', EmbeddingStore(self.temp_dir, 'fake'), batch_size=2)
+        vectors = embeddings.embed_documents(['a', 'b', 'a', 'c'])
+
+        self.assertEqual(base.calls, [['a', 'b'], ['c']])
+        self.assertEqual(vectors[0], vectors[2])
+        self.assertEqual(embeddings.stats, {'texts': 4, 'hits': 1, 'misses': 3, 'api_batches': 2})
+
+    def test_reuses_vectors_from_disk(self):
+        first = CachedEmbeddings(FakeEmbeddings(), 'fake', EmbeddingStore(self.temp_dir, 'fake'), batch_size=8)
+        expected = first.embed_documents(['a', 'c'])
+
+        base = FakeEmbeddings()
+        second = CachedEmbeddings(base, 'fake', EmbeddingStore(self.temp_dir, 'fake'), batch_size=8)
+        vectors = second.embed_documents(['c', 'a'])
+        self.assertEqual(base.calls, [])
+        self.assertEqual(second.hit_rate, 1.0)
+        for actual, wanted in zip(vectors, reversed(expected)):
+            self.assertEqual(len(actual), len(wanted))
+            for a, b in zip(actual, wanted):
+                self.assertAlmostEqual(a, b, places=6)
+
+    def test_rejects_dimension_mismatch(self):
+        store = EmbeddingStore(self.temp_dir, 'fake')
+        store.add_many({'a': [0.0] * 8})
+        with self.assertRaises(ValueError):
+            store.add_many({'b': [0.0] * 4})
+
+
+@mock.patch('ragapp.incremental.save_sparse_index')
+@mock.patch('ragapp.incremental.save_index_config')
+@mock.patch('ragapp.incremental.apply_index_config')
+@mock.patch('ragapp.incremental.to_flat')
+@mock.patch('ragapp.incremental.save_vectorstore', FakeVectorStore.save)
+@mock.patch('ragapp.incremental.load_vectorstore_dir', FakeVectorStore.load)
+@mock.patch('ragapp.incremental.FAISS', FakeVectorStore)
+class IncrementalIndexTests(TempDirMixin, TestCase):
+    def chunks(self, *texts, page=1):
+        return [Document(page_content=text, metadata={'page': page}) for text in texts]
+
+    def build(self, source_hash, chunks):
+        index = IncrementalIndex(self.temp_dir, FakeEmbeddings())
+        if not index.is_current('manual.pdf', source_hash):
+            index.update_source('manual.pdf', source_hash, chunks)
+        return index, index.save()
+
+    def test_make_chunk_ids_distinguishes_repeated_text(self, *mocks):
+        ids = make_chunk_ids('manual.pdf', ['a', 'b', 'a'])
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(ids[2], f"{ids[0]}-1")
+        self.assertEqual(ids, make_chunk_ids('manual.pdf', ['a', 'b']) + make_chunk_ids('manual.pdf', ['a'], {ids[0]: 1}))
+        self.assertNotEqual(ids[0], make_chunk_ids('other.pdf', ['a'])[0])
+
+    def test_skips_unchanged_source(self, *mocks):
+        self.build('v1', self.chunks('a', 'b'))
+        index, saved = self.build('v1', self.chunks('a', 'b'))
+        self.assertFalse(saved)
+        self.assertEqual(index.stats['skipped_sources'], 1)
+        self.assertEqual(index.embeddings.calls, [])
+
+    def test_embeds_only_new_chunks(self, *mocks):
+        self.build('v1', self.chunks('a', 'b'))
+        index, saved = self.build('v2', self.chunks('a', 'c'))
+        self.assertTrue(saved)
+        self.assertEqual(index.embeddings.calls, [['c']])
+        self.assertEqual((index.stats['embedded'], index.stats['reused'], index.stats['deleted']), (1, 1, 1))
+        texts = sorted(text for text, _ in FakeVectorStore.saved[self.temp_dir].values())
+        self.assertEqual(texts, ['a', 'c'])
+
+    def test_records_new_hash_when_every_chunk_is_reused(self, *mocks):
+        self.build('v1', self.chunks('a', 'b'))
+        index, saved = self.build('v2', self.chunks('a', 'b'))
+        self.assertTrue(saved)
+        self.assertEqual(index.stats['embedded'], 0)
+        self.assertTrue(IncrementalIndex(self.temp_dir, FakeEmbeddings()).is_current('manual.pdf', 'v2'))
+
+    def test_refreshes_metadata_of_reused_chunks(self, *mocks):
+        self.build('v1', self.chunks('a', page=1))
+        self.build('v2', self.chunks('a', page=2))
+        (_, metadata), = FakeVectorStore.saved[self.temp_dir].values()
+        self.assertEqual(metadata, {'page': 2})
+
+    def test_remove_source(self, *mocks):
+        self.build('v1', self.chunks('a'))
+        index = IncrementalIndex(self.temp_dir, FakeEmbeddings())
+        index.remove_source('manual.pdf')
+        self.assertTrue(index.save())
+        self.assertEqual(FakeVectorStore.saved[self.temp_dir], {})
+        with open(os.path.join(self.temp_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            self.assertNotIn('manual.pdf', f.read())
+
+
+class ClaimNextJobTests(TestCase):
+    def create(self, name, status='PENDING'):
+        return ProcessedManual.objects.create(product_name=name, status=status)
+
+    def test_claims_oldest_pending_job_once(self):
+        first = self.create('a')
+        second = self.create('b')
+        self.assertEqual(claim_next_job().id, first.id)
+        self.assertEqual(claim_next_job().id, second.id)
+        self.assertIsNone(claim_next_job())
+        self.assertEqual(ProcessedManual.objects.get(id=first.id).status, 'RUNNING')
+
+    def test_does_not_take_over_live_job(self):
+        self.create('a', status='RUNNING')
+        self.assertIsNone(claim_next_job())
+
+    def test_does_not_claim_job_changed_since_read(self):
+        manual = self.create('a')
+        values_list = QuerySet.values_list
+
+        def read_then_race(queryset, *fields, **kwargs):
+            rows = list(values_list(queryset, *fields, **kwargs))
+            # 候補を読んだ後、更新する前に他のワーカーがジョブを取る
+            ProcessedManual.objects.filter(id=manual.id).update(
+                status='RUNNING', updated_at=timezone.now() + timedelta(seconds=1))
+            return rows
+
+        with mock.patch.object(QuerySet, 'values_list', read_then_race):
+            self.assertIsNone(claim_next_job())
+        self.assertEqual(ProcessedManual.objects.get(id=manual.id).progress_message, '')
+
+    def test_takes_over_expired_lease(self):
+        manual = self.create('a')
+        old_worker = claim_next_job()
+        expired = timezone.now() - timedelta(hours=1)
+        ProcessedManual.objects.filter(id=manual.id).update(updated_at=expired, started_at=expired)
+        old_worker.started_at = expired
+
+        with self.settings(RAG_INGEST_LEASE_SECONDS=60):
+            new_worker = claim_next_job()
+        self.assertEqual(new_worker.id, manual.id)
+        self.assertNotEqual(new_worker.started_at, expired)
+
+        # リースを失ったワーカーからの更新は反映されない
+        update_progress(old_worker, 50, '古いワーカー')
+        self.assertFalse(_owned(old_worker).exists())
+        self.assertEqual(ProcessedManual.objects.get(id=manual.id).progress, 0)
+
+
+class PublishBuildDirTests(TempDirMixin, TestCase):
+    def build(self, vectorstore_path, text):
+        build_dir = prepare_build_dir(vectorstore_path)
+        os.makedirs(build_dir, exist_ok=True)
+        with open(os.path.join(build_dir, 'index.faiss'), 'w') as f:
+            f.write(text)
+        publish_build_dir(build_dir, vectorstore_path)
+        return build_dir
+
+    def test_keeps_previous_build_until_grace_period(self):
+        with self.settings(BASE_DIR=self.temp_dir):
+            os.makedirs(vectorstore_root())
+            path = os.path.join(vectorstore_root(), '1')
+            ProcessedManual.objects.create(product_name='a', status='COMPLETED', vectorstore_path=path)
+            first = self.build(path, 'v1')
+            second = self.build(path, 'v2')
+
+            with open(os.path.join(path, 'index.faiss')) as f:
+                self.assertEqual(f.read(), 'v2')
+            # 古いディレクトリを開いている検索があるため、公開してすぐには削除しない
+            self.assertTrue(os.path.exists(os.path.join(first, 'index.faiss')))
+            self.assertEqual(find_orphans(grace_seconds=3600), [])
+            self.assertEqual(find_orphans(grace_seconds=-1), [os.path.abspath(first)])
+            self.assertEqual(os.path.realpath(path), os.path.realpath(second))
+
+
+class PlanEvictionTests(TestCase):
+    def create(self, name, path, size, accessed):
+        return ProcessedManual.objects.create(
+            product_name=name, status='COMPLETED', vectorstore_path=path, size_bytes=size,
+            last_accessed_at=timezone.now() - timedelta(days=accessed),
+        )
+
+    def test_evicts_least_recently_used_until_within_quota(self):
+        self.create('a', '/vs/a', 100, accessed=5)
+        self.create('b', '/vs/b', 200, accessed=1)
+        self.create('c', '/vs/c', 300, accessed=3)
+        total, evictions = plan_eviction(350)
+        self.assertEqual(total, 600)
+        self.assertEqual(evictions, [('/vs/a', 100), ('/vs/c', 300)])
+
+    def test_counts_shared_store_once_with_latest_access(self):
+        self.create('a', '/vs/a', 100, accessed=5)
+        self.create('b', '/vs/b', 200, accessed=1)
+        self.create('upload:b', '/vs/b', 200, accessed=9)
+        total, evictions = plan_eviction(250)
+        self.assertEqual(total, 300)
+        self.assertEqual(evictions, [('/vs/a', 100)])
+
+    def test_ignores_shared_index_and_incomplete_manuals(self):
+        self.create('a', make_shared_path(1), 1000, accessed=5)
+        ProcessedManual.objects.create(product_name='b', status='RUNNING', vectorstore_path='/vs/b', size_bytes=500)
+        self.assertEqual(plan_eviction(0), (0, []))
+
+
+class EvictTests(TempDirMixin, TestCase):
+    def create(self, name, content_hash=''):
+        path = os.path.join(vectorstore_root(), name.replace(':', '_'))
+        os.makedirs(path)
+        return ProcessedManual.objects.create(
+            product_name=name, display_name=name, status='COMPLETED', vectorstore_path=path,
+            content_hash=content_hash, size_bytes=100,
+        )
+
+    def test_keeps_rows_and_removes_vectorstore(self):
+        with self.settings(BASE_DIR=self.temp_dir):
+            manual = self.create('upload:a', content_hash='abc')
+            evict(manual.vectorstore_path)
+
+            manual.refresh_from_db()
+            self.assertEqual(manual.status, 'EVICTED')
+            self.assertEqual(manual.content_hash, 'abc')
+            self.assertFalse(os.path.exists(manual.vectorstore_path))
+
+    def test_enqueue_product_rebuilds_evicted_manual(self):
+        with self.settings(BASE_DIR=self.temp_dir):
+            manual = self.create('aircon')
+            evict(manual.vectorstore_path)
+            self.assertEqual(enqueue_product('aircon').id, manual.id)
+            self.assertEqual(ProcessedManual.objects.get(id=manual.id).status, 'PENDING')
+
+    def test_enqueue_upload_rebuilds_evicted_manual_with_same_content(self):
+        with self.settings(BASE_DIR=self.temp_dir):
+            content = b'%PDF-1.4 manual'
+            manual = self.create('upload:a', content_hash=hashlib.sha256(content).hexdigest())
+            evict(manual.vectorstore_path)
+
+            queued = enqueue_upload(SimpleUploadedFile('manual.pdf', content))
+            self.assertEqual(queued.id, manual.id)
+            self.assertEqual(queued.status, 'PENDING')
+            self.assertTrue(os.path.exists(queued.source_path))
+
+    def test_chat_of_evicted_manual_reingests_instead_of_failing(self):
+        with self.settings(BASE_DIR=self.temp_dir):
+            manual = self.create('aircon')
+            session = self.client.session
+            session['vectorstore_path'] = manual.vectorstore_path
+            session.save()
+            evict(manual.vectorstore_path)
+
+            start_url = reverse('start_chat', args=[manual.id])
+            self.assertRedirects(self.client.get(reverse('chat')), start_url, fetch_redirect_response=False)
+            response = self.client.post(reverse('chat_api'), {'question': 'q'})
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['reload_url'], start_url)
+            self.assertRedirects(self.client.get(start_url), reverse('ingest_status', args=[manual.id]),
+                                 fetch_redirect_response=False)
+            self.assertEqual(ProcessedManual.objects.get(id=manual.id).status, 'PENDING')
+
+
+class AnswerQuestionsTests(TestCase):
+    def test_answers_normalized_duplicates_once(self):
+        from . import rag_handler
+
+        chain = mock.Mock()
+        chain.invoke.side_effect = lambda inputs: {'output_text': f"answer: {inputs['question']}"}
+        store_cache = mock.Mock()
+        with mock.patch.object(rag_handler, 'vectorstore_exists', return_value=True), \
+                mock.patch.object(rag_handler, 'get_answer_cache', return_value=None), \
+                mock.patch.object(rag_handler, 'get_store_version', return_value=1), \
+                mock.patch.object(rag_handler, 'get_query_embeddings', return_value=FakeEmbeddings()) as embeddings, \
+                mock.patch.object(rag_handler, 'get_vectorstore_cache', return_value=store_cache), \
+                mock.patch.object(rag_handler, 'retrieve_documents_batch',
+                                  side_effect=lambda store, queries, vectors, **options: [[] for _ in queries]), \
+                mock.patch.object(rag_handler, 'get_answer_chain', return_value=chain), \
+                mock.patch.object(rag_handler, '_count_llm_io'):
+            questions = ['フィルターの掃除は？', 'Filter', 'ﾌｨﾙﾀｰの掃除は', 'filter?']
+            items = list(rag_handler.answer_questions(questions, '/vs/a', concurrency=1))
+
+        self.assertEqual(embeddings.return_value.calls, [['フィルターの掃除は？', 'Filter']])
+        self.assertEqual(chain.invoke.call_count, 2)
+        self.assertEqual([item['index'] for item in items], [0, 2, 1, 3])
+        self.assertEqual([item['question'] for item in items], [questions[i] for i in (0, 2, 1, 3)])
+        self.assertEqual(items[1]['answer'], 'answer: フィルターの掃除は？')
+        self.assertEqual(items[3]['answer'], 'answer: Filter')
+
+
+class MetricsViewTests(TestCase):
+    def test_rejects_remote_clients(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 403)
+
+    def test_allows_listed_addresses(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+
+    def test_allows_staff_users(self):
+        from django.contrib.auth.models import User
+
+        self.client.force_login(User.objects.create_user('admin', is_staff=True))
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 200)
+
+    def test_allows_bearer_token(self):
+        with self.settings(RAG_METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.5',
+                                       HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.5',
+                                       HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+
+
+class StructuredChunkerTests(TestCase):
+    def split(self, pages, **kwargs):
+        parents = []
+        chunker = StructuredChunker(child_size=200, child_overlap=0, **kwargs)
+        children = list(chunker.split(pages, lambda *parent: parents.append(parent)))
+        return children, parents
+
+    def test_builds_parent_sections_and_children(self):
+        pages = [
+            (1, [{'type': 'heading', 'text': 'お手入れ'}, {'type': 'text', 'text': 'フィルターを外します。'}]),
+            (2, [{'type': 'text', 'text': '水洗いします。'},
+                 {'type': 'figure', 'figure_id': 'p2-1', 'text': 'フィルターの図'},
+                 {'type': 'heading', 'text': '仕様'}, {'type': 'text', 'text': '定格電圧 100V'}]),
+        ]
+        children, parents = self.split(pages)
+
+        self.assertEqual([(heading, pages) for _, heading, pages, _ in parents], [('お手入れ', [1, 2]), ('仕様', [2])])
+        self.assertIn('[図 p2-1 の説明]\nフィルターの図', parents[0][3])
+        self.assertEqual([doc.page_content for doc in children], [
+            'お手入れ\nフィルターを外します。', 'お手入れ\n水洗いします。', 'お手入れ\nフィルターの図', '仕様\n定格電圧 100V',
+        ])
+        self.assertEqual(children[0].metadata, {'parent_id': parents[0][0], 'heading': 'お手入れ', 'page': 1})
+        self.assertEqual(children[2].metadata['figure_id'], 'p2-1')
+        self.assertEqual(children[3].metadata['parent_id'], parents[1][0])
+
+    def test_parent_id_depends_on_heading_and_ordinal(self):
+        _, parents = self.split([(1, [{'type': 'heading', 'text': '注意'}, {'type': 'text', 'text': 'A'},
+                                      {'type': 'heading', 'text': '注意'}, {'type': 'text', 'text': 'B'}])])
+        _, edited = self.split([(1, [{'type': 'heading', 'text': '注意'}, {'type': 'text', 'text': '変更後'}])])
+        self.assertNotEqual(parents[0][0], parents[1][0])
+        self.assertEqual(parents[0][0], edited[0][0])
+
+    def test_splits_long_sections_under_the_same_heading(self):
+        blocks = [{'type': 'heading', 'text': '手順'}] + [{'type': 'text', 'text': 'あ' * 60} for _ in range(3)]
+        _, parents = self.split([(1, blocks)], max_parent_chars=100)
+        self.assertEqual([heading for _, heading, _, _ in parents], ['手順', '手順', '手順'])
+        self.assertEqual(len({parent_id for parent_id, _, _, _ in parents}), 3)
+
+
+class SyntheticManualTests(TempDirMixin, TestCase):
+    def test_generates_pages_with_text_and_images(self):
+        import fitz
+
+        path = os.path.join(self.temp_dir, 'manual.pdf')
+        generate_manual(path, 2)
+        with fitz.open(path) as doc:
+            self.assertEqual(doc.page_count, 2)
+            self.assertIn('1. 安全上のご注意', doc[0].get_text())
+            # ロゴ(全ページ共通)と図
+            self.assertEqual(len(doc[1].get_images()), 2)
+
+    def test_same_arguments_give_same_text(self):
+        import fitz
+
+        paths = [os.path.join(self.temp_dir, f"{i}.pdf") for i in range(2)]
+        for path in paths:
+            generate_manual(path, 2, seed=3)
+        texts = []
+        for path in paths:
+            with fitz.open(path) as doc:
+                texts.append([page.get_text() for page in doc])
+        self.assertEqual(texts[0], texts[1])
+
 
-# Create your tests here.
+class LazyImportTests(TestCase):
+    def test_chat_modules_do_not_load_heavy_dependencies(self):
+        # テストのプロセスでは既に読み込まれているため、別のプロセスで確かめる
+        code = (
+            "import sys, django; django.setup(); import ragapp.views, ragapp.rag_handler; "
+            "print(','.join(m for m in ('langchain_openai', 'openai', 'faiss', 'fitz', 'langchain_community', "
+            "'tiktoken') if m in sys.modules))"
+        )
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='config.settings')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, env=env, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(result.stdout.strip(), '')
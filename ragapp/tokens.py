@@ -0,0 +1,27 @@
+import threading
+
+from django.conf import settings
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """
+    回答生成に使うモデルのトークナイザーを返す関数。モデルが不明な場合は cl100k_base を使う。
+    """
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                import tiktoken
+
+                try:
+                    _encoding = tiktoken.encoding_for_model(getattr(settings, 'RAG_LLM_MODEL', 'gpt-3.5-turbo'))
+                except KeyError:
+                    _encoding = tiktoken.get_encoding('cl100k_base')
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoding().encode(text, disallowed_special=()))
@@ -5,5 +5,11 @@ urlpatterns = [
     path('', views.load_manual_view, name='load_manual'),
     path('chat/', views.chat_view, name='chat'),
     path('api/chat/', views.chat_api_view, name='chat_api'),
+    path('api/chat/stream/', views.chat_stream_api_view, name='chat_stream_api'),
     path('upload/', views.upload_manual_view, name='upload_manual'),
+    path('manuals/<int:manual_id>/status/', views.ingest_status_view, name='ingest_status'),
+    path('manuals/<int:manual_id>/chat/', views.start_chat_view, name='start_chat'),
+    path('api/manuals/<int:manual_id>/status/', views.ingest_status_api_view, name='ingest_status_api'),
+    path('api/manuals/<int:manual_id>/batch/', views.batch_questions_api_view, name='batch_questions_api'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
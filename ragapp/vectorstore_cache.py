@@ -0,0 +1,161 @@
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .shared_store import get_shared_store, is_shared_path, parse_shared_path
+
+
+def get_store_version(vectorstore_path: str):
+    """
+    ベクトルストアのバージョンを返す関数。
+    ディレクトリとその中のファイルのstat情報だけを使うため、ファイルの読み込みは発生しない。
+    存在しない場合はNoneを返す。
+    共有インデックス上のマニュアルの場合は、そのマニュアルのデータの世代を返す。
+    """
+    if is_shared_path(vectorstore_path):
+        return get_shared_store().manual_version(parse_shared_path(vectorstore_path))
+    try:
+        dir_stat = os.stat(vectorstore_path)
+        index_stat = os.stat(os.path.join(vectorstore_path, 'index.faiss'))
+    except OSError:
+        return None
+    return (dir_stat.st_ino, dir_stat.st_mtime_ns, index_stat.st_mtime_ns, index_stat.st_size)
+
+
+def get_store_size(vectorstore_path: str) -> int:
+    """
+    ベクトルストアのディスク上のサイズ(バイト)を返す関数。メモリ使用量の目安として使う。
+    共有インデックスは個別のマニュアルごとにはメモリを使わないため0とする。
+    """
+    if is_shared_path(vectorstore_path):
+        return 0
+    total = 0
+    for entry in os.scandir(vectorstore_path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class _CacheEntry:
+    def __init__(self, version, value, size):
+        self.version = version
+        self.value = value
+        self.size = size
+
+
+class VectorStoreCache:
+    """
+    ロード済みのベクトルストアをプロセス内に保持するLRUキャッシュ。
+    キーはvectorstore_pathで、ディレクトリの更新時刻が変わった場合は再ロードする。
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, vectorstore_path: str, loader):
+        """
+        キャッシュ済みの値を返す。無い場合や古い場合はloader(vectorstore_path)でロードする。
+        同じパスへの同時ロードは1回にまとめる。
+        """
+        version = get_store_version(vectorstore_path)
+        value = self._lookup(vectorstore_path, version)
+        if value is not None:
+            return value
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(vectorstore_path, threading.Lock())
+
+        with load_lock:
+            # 待っている間に他のスレッドがロードしているかもしれない
+            value = self._lookup(vectorstore_path, version, count=False)
+            if value is not None:
+                return value
+
+            with self._lock:
+                self.misses += 1
+            value = loader(vectorstore_path)
+            self._store(vectorstore_path, version, value, get_store_size(vectorstore_path))
+            return value
+
+    def _lookup(self, vectorstore_path, version, count=True):
+        with self._lock:
+            entry = self._entries.get(vectorstore_path)
+            if entry is None:
+                return None
+            if entry.version != version:
+                self._remove(vectorstore_path)
+                return None
+            self._entries.move_to_end(vectorstore_path)
+            if count:
+                self.hits += 1
+            return entry.value
+
+    def _store(self, vectorstore_path, version, value, size):
+        with self._lock:
+            if vectorstore_path in self._entries:
+                self._remove(vectorstore_path)
+            self._entries[vectorstore_path] = _CacheEntry(version, value, size)
+            self._total_bytes += size
+            # 直前に追加したエントリは予算を超えていても残す
+            while len(self._entries) > 1 and (
+                self._total_bytes > self.max_bytes or len(self._entries) > self.max_entries
+            ):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, vectorstore_path):
+        entry = self._entries.pop(vectorstore_path)
+        self._total_bytes -= entry.size
+
+    def invalidate(self, vectorstore_path: str):
+        with self._lock:
+            if vectorstore_path in self._entries:
+                self._remove(vectorstore_path)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_vectorstore_cache() -> VectorStoreCache:
+    """
+    プロセス全体で共有するVectorStoreCacheを返す関数。
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = VectorStoreCache(
+                    max_bytes=getattr(settings, 'RAG_VECTORSTORE_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+                    max_entries=getattr(settings, 'RAG_VECTORSTORE_CACHE_MAX_ENTRIES', 32),
+                )
+    return _cache
@@ -1,15 +1,19 @@
-import os
-import requests
-import uuid
-from django.shortcuts import render, redirect
+import hmac
+import json
+
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
-from django.views.decorators.http import require_POST
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.views.decorators.http import require_POST, require_GET
 from django.views.decorators.csrf import csrf_exempt
 
+from . import metrics
 from .models import ProcessedManual
-from .rag_handler import create_vectorstore_from_vision_pdf, ask_question
-from googlesearch import search
+from .jobs import enqueue_product, enqueue_upload, find_indexed_manual
+from .lifecycle import find_evicted_manual, touch
 
 SUGGESTED_DATA = {
     'aircon': {
@@ -93,47 +97,14 @@ def load_manual_view(request):
 
         if not product_name_raw: return render_error('製品名を入力してください。')
 
-        product_name = product_name_raw.lower()
-        manual, created = ProcessedManual.objects.get_or_create(product_name=product_name)
+        manual = enqueue_product(product_name_raw)
 
-        if not created and manual.status == 'COMPLETED':
+        if manual.status == 'COMPLETED':
             request.session['vectorstore_path'] = manual.vectorstore_path; request.session['product_name'] = product_name_raw
             return redirect('chat')
-        
-        if manual.status == 'FAILED': manual.status = 'COMPLETED'; manual.save()
-
-        query = f'"{product_name_raw}" 取扱説明書 filetype:pdf'
-        pdf_url = None
-        try:
-            for url in search(query, num_results=5, lang="ja", sleep_interval=1):
-                if url.endswith('.pdf'): pdf_url = url; break
-        except Exception as e: return render_error(f'Google検索中にエラーが発生: {e}')
-        
-        if not pdf_url: return render_error('取扱説明書のPDFが見つかりませんでした。')
-
-        temp_pdf_path = ""
-        try:
-            response = requests.get(pdf_url, timeout=30, verify=False); response.raise_for_status()
-            temp_dir = os.path.join(settings.BASE_DIR, 'temp_manuals'); os.makedirs(temp_dir, exist_ok=True)
-            temp_pdf_path = os.path.join(temp_dir, f"{uuid.uuid4()}.pdf")
-            with open(temp_pdf_path, 'wb') as f: f.write(response.content)
-            
-            vectorstore_id = str(manual.id)
-            vectorstore_path = os.path.join(settings.BASE_DIR, 'vectorstores', vectorstore_id)
-            success = create_vectorstore_from_vision_pdf(temp_pdf_path, vectorstore_path)
-
-            if success:
-                manual.vectorstore_path = vectorstore_path; manual.status = 'COMPLETED'; manual.save()
-                request.session['vectorstore_path'] = vectorstore_path; request.session['product_name'] = product_name_raw
-                return redirect('chat')
-            else:
-                manual.status = 'FAILED'; manual.save()
-                return render_error('PDFの解析に失敗しました。(Popplerはインストールされていますか？)')
-        except requests.exceptions.RequestException as e:
-            manual.status = 'FAILED'; manual.save()
-            return render_error(f'PDFのダウンロードに失敗: {e}')
-        finally:
-            if os.path.exists(temp_pdf_path): os.remove(temp_pdf_path)
+
+        # 取り込みはワーカーで行い、ここでは進捗画面へ移動する
+        return redirect('ingest_status', manual_id=manual.id)
 
     return render(request, 'ragapp/load_manual.html', {'categories': SUGGESTED_DATA.values()})
 
@@ -156,49 +127,243 @@ def upload_manual_view(request):
         if not pdf_file.name.lower().endswith('.pdf'):
             return render_error('PDFファイルを選択してください。')
 
-        temp_pdf_path = ""
-        try:
-            # アップロードされたファイルを一時的に保存
-            temp_dir = os.path.join(settings.BASE_DIR, 'temp_manuals')
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_pdf_path = os.path.join(temp_dir, f"{uuid.uuid4()}_{pdf_file.name}")
-            with open(temp_pdf_path, 'wb+') as f:
-                for chunk in pdf_file.chunks():
-                    f.write(chunk)
-            
-            vectorstore_id = str(uuid.uuid4())
-            vectorstore_path = os.path.join(settings.BASE_DIR, 'vectorstores', vectorstore_id)
-            
-            # PDFを解析してベクトルストアを作成
-            success = create_vectorstore_from_vision_pdf(temp_pdf_path, vectorstore_path)
-
-            if success:
-                # 成功したらセッションに情報を保存してチャットページへ
-                request.session['vectorstore_path'] = vectorstore_path
-                request.session['product_name'] = f"アップロードされたファイル: {pdf_file.name}"
-                return redirect('chat')
-            else:
-                return render_error('PDFの解析に失敗しました。(Popplerはインストールされていますか？)')
-        finally:
-            # 処理が終わったら一時ファイルを削除
-            if os.path.exists(temp_pdf_path):
-                os.remove(temp_pdf_path)
+        # アップロードされたファイルを保存し、取り込みはワーカーで行う
+        manual = enqueue_upload(pdf_file)
+        return redirect('ingest_status', manual_id=manual.id)
 
     # POSTリクエスト以外はトップページに戻す
     return redirect('load_manual')
 # ★★★ ここまでが新しく追加する関数 ★★★
 
+def ingest_status_view(request, manual_id):
+    """
+    取り込みジョブの進捗画面。完了するとチャット画面へ移動する。
+    """
+    manual = get_object_or_404(ProcessedManual, id=manual_id)
+    if manual.status in ('COMPLETED', 'EVICTED'):
+        return redirect('start_chat', manual_id=manual.id)
+    context = {'manual': manual, 'product_name': manual.display_name or manual.product_name}
+    return render(request, 'ragapp/ingest_status.html', context)
+
+@require_GET
+def ingest_status_api_view(request, manual_id):
+    """
+    取り込みジョブの状態をJSONで返すAPI。進捗画面からポーリングされる。
+    """
+    manual = get_object_or_404(ProcessedManual, id=manual_id)
+    data = {
+        'status': manual.status,
+        'status_display': manual.get_status_display(),
+        'progress': manual.progress,
+        'message': manual.progress_message,
+        'error': manual.error_message,
+    }
+    if manual.status == 'COMPLETED':
+        data['chat_url'] = reverse('start_chat', args=[manual.id])
+    return JsonResponse(data)
+
+def start_chat_view(request, manual_id):
+    """
+    取り込みが完了したマニュアルをセッションに設定してチャット画面へ移動する。
+    容量の上限のためにベクトルストアを削除したマニュアルは、製品名で検索したものであれば取り込み直す。
+    アップロードされたPDFは、同じ内容のPDFが取り込み直されていればそれを使い、無ければもう一度アップロードしてもらう。
+    """
+    manual = get_object_or_404(ProcessedManual, id=manual_id)
+    if manual.status == 'EVICTED':
+        if manual.product_name.startswith('upload:'):
+            indexed = find_indexed_manual(manual.content_hash) if manual.content_hash else None
+            if indexed is not None: return redirect('start_chat', manual_id=indexed.id)
+            context = {'error': 'マニュアルのデータは削除されました。PDFをもう一度アップロードしてください。',
+                       'categories': SUGGESTED_DATA.values()}
+            return render(request, 'ragapp/load_manual.html', context)
+        manual = enqueue_product(manual.display_name or manual.product_name)
+    if manual.status != 'COMPLETED':
+        return redirect('ingest_status', manual_id=manual.id)
+    request.session['vectorstore_path'] = manual.vectorstore_path
+    request.session['product_name'] = manual.display_name or manual.product_name
+    return redirect('chat')
+
 def chat_view(request):
     if not request.session.get('vectorstore_path'): return redirect('load_manual')
+    evicted = find_evicted_manual(request.session['vectorstore_path'])
+    if evicted is not None: return redirect('start_chat', manual_id=evicted.id)
     context = {'product_name': request.session.get('product_name', 'マニュアル')}
     return render(request, 'ragapp/chat.html', context)
 
+def _retrieval_options(params):
+    """
+    検索オプション(k, vector_weight, sparse_weight)をPOSTパラメータ(またはJSONの辞書)から読み取る。
+    戻り値は (オプションの辞書, エラーメッセージまたはNone)。指定の無いものはNoneで、設定値が使われる。
+    """
+    options = {'k': None, 'vector_weight': None, 'sparse_weight': None}
+    try:
+        if params.get('k'):
+            options['k'] = int(params['k'])
+            if not 1 <= options['k'] <= 20: return options, 'k must be between 1 and 20'
+        for name in ('vector_weight', 'sparse_weight'):
+            if params.get(name):
+                options[name] = float(params[name])
+                if options[name] < 0: return options, f'{name} must not be negative'
+    except ValueError:
+        return options, 'Invalid retrieval options'
+    return options, None
+
+def _evicted_response(vectorstore_path):
+    """
+    セッションのベクトルストアが削除されていれば、チャット画面を開き直して取り込み直すよう伝えるレスポンスを返す。
+    """
+    evicted = find_evicted_manual(vectorstore_path)
+    if evicted is None: return None
+    return JsonResponse({'error': 'Manual was evicted. Reload the page to re-ingest it.',
+                         'reload_url': reverse('start_chat', args=[evicted.id])}, status=409)
+
+@csrf_exempt
+@require_POST
+async def chat_api_view(request):
+    """
+    質問に回答するAPI。非同期ビューなので、ASGIではモデルの応答を待つ間もスレッドを占有しない。
+    セッションの読み込みは aget でスレッドに逃がす。
+    """
+    vectorstore_path = await request.session.aget('vectorstore_path')
+    if not vectorstore_path: return JsonResponse({'error': 'Session expired'}, status=400)
+    question = request.POST.get('question', '')
+    if not question: return JsonResponse({'error': 'Question is empty'}, status=400)
+    options, error = _retrieval_options(request.POST)
+    if error: return JsonResponse({'error': error}, status=400)
+    evicted = await sync_to_async(_evicted_response)(vectorstore_path)
+    if evicted is not None: return evicted
+    await sync_to_async(touch)(vectorstore_path)
+    # rag_handler はlangchainなどを読み込むため、最初のチャットのときにimportする
+    from .rag_handler import aask_question
+
+    answer = await aask_question(question, vectorstore_path, **options)
+    return JsonResponse({'answer': answer})
+
+def _format_sse(events):
+    for event, data in events:
+        yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _iterate_in_thread(iterator):
+    """
+    同期イテレータを1要素ずつ別スレッドで進める非同期イテレータ。
+    ASGIで同期イテレータを渡すと全体がバッファされてしまうため、これで包んで返す。
+    """
+    sentinel = object()
+    while True:
+        item = await sync_to_async(next, thread_sensitive=False)(iterator, sentinel)
+        if item is sentinel:
+            break
+        yield item
+
+def _stream_events(question, vectorstore_path, options):
+    from .rag_handler import stream_answer
+
+    try:
+        yield from stream_answer(question, vectorstore_path, **options)
+    except Exception as e:
+        print(f"--- Streaming chat error: {e} ---")
+        yield ('error', {'message': 'エラーが発生しました。'})
+
 @csrf_exempt
 @require_POST
-def chat_api_view(request):
+def chat_stream_api_view(request):
+    """
+    回答をServer-Sent Eventsで逐次返すAPI。
+    最初に検索したチャンクの情報(sources)を送り、続けてトークン(token)、最後に所要時間(done)を送る。
+    """
     vectorstore_path = request.session.get('vectorstore_path')
     if not vectorstore_path: return JsonResponse({'error': 'Session expired'}, status=400)
     question = request.POST.get('question', '')
     if not question: return JsonResponse({'error': 'Question is empty'}, status=400)
-    answer = ask_question(question, vectorstore_path)
-    return JsonResponse({'answer': answer})
\ No newline at end of file
+    options, error = _retrieval_options(request.POST)
+    if error: return JsonResponse({'error': error}, status=400)
+    evicted = _evicted_response(vectorstore_path)
+    if evicted is not None: return evicted
+    touch(vectorstore_path)
+
+    stream = _format_sse(_stream_events(question, vectorstore_path, options))
+    if isinstance(request, ASGIRequest):
+        stream = _iterate_in_thread(stream)
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def _batch_events(questions, vectorstore_path, options, concurrency):
+    from .rag_handler import answer_questions
+
+    try:
+        for item in answer_questions(questions, vectorstore_path, concurrency=concurrency, **options):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+    except Exception as e:
+        print(f"--- Batch question error: {e} ---")
+        yield json.dumps({'error': 'エラーが発生しました。'}, ensure_ascii=False) + "\n"
+
+@require_POST
+def batch_questions_api_view(request, manual_id):
+    """
+    1つのマニュアルに対する複数の質問にまとめて回答するAPI。
+    リクエストはJSON({"questions": [...], "concurrency": 同時に生成する回答数, 検索オプション})で、
+    回答は終わったものから1行1件のJSON(JSON Lines)で返す。各行には質問の番号(index)と段階ごとの時間が入る。
+    チャットと同じく、セッションで開いているマニュアル(スタッフは全てのマニュアル)だけを対象にできる。
+    CSRFトークンが必要。
+    """
+    manual = get_object_or_404(ProcessedManual, id=manual_id)
+    is_staff = request.user.is_authenticated and request.user.is_staff
+    if not is_staff and request.session.get('vectorstore_path') != manual.vectorstore_path:
+        return JsonResponse({'error': 'Forbidden'}, status=403)
+    if manual.status != 'COMPLETED':
+        return JsonResponse({'error': 'Manual is not ready'}, status=409)
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(payload, dict): return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    questions = payload.get('questions')
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) and q for q in questions):
+        return JsonResponse({'error': 'questions must be a non-empty list of strings'}, status=400)
+    max_questions = getattr(settings, 'RAG_BATCH_MAX_QUESTIONS', 100)
+    if len(questions) > max_questions:
+        return JsonResponse({'error': f'At most {max_questions} questions are allowed'}, status=400)
+    options, error = _retrieval_options(payload)
+    if error: return JsonResponse({'error': error}, status=400)
+    try:
+        concurrency = int(payload['concurrency']) if payload.get('concurrency') else None
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid concurrency'}, status=400)
+    if concurrency is not None and not 1 <= concurrency <= 32:
+        return JsonResponse({'error': 'concurrency must be between 1 and 32'}, status=400)
+    touch(manual.vectorstore_path)
+
+    stream = _batch_events(questions, manual.vectorstore_path, options, concurrency)
+    if isinstance(request, ASGIRequest):
+        stream = _iterate_in_thread(stream)
+    response = StreamingHttpResponse(stream, content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def _metrics_allowed(request) -> bool:
+    """
+    /metrics を見てよいアクセスかどうかを返す関数。
+    スタッフのユーザー、RAG_METRICS_ALLOWED_IPS のアドレス、RAG_METRICS_TOKEN のBearerトークンのどれかで許可する。
+    """
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'RAG_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1']):
+        return True
+    token = getattr(settings, 'RAG_METRICS_TOKEN', '')
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode('utf-8'), f"Bearer {token}".encode('utf-8'))
+
+@require_GET
+def metrics_view(request):
+    """
+    パイプラインの各段階の所要時間、カウンター、キャッシュの状態をPrometheusのテキスト形式で返す。
+    内部の情報を含むため、許可されたアクセスにだけ返す(_metrics_allowed)。
+    """
+    if not metrics.enabled():
+        raise Http404
+    if not _metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
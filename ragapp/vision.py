@@ -0,0 +1,177 @@
+import base64
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+from django.conf import settings
+from openai import OpenAI
+
+from . import metrics
+from .caption_cache import caption_cache_key, get_caption_cache
+
+VISION_PROMPT = "これは製品マニュアルに含まれる図やイラストです。この画像が何を示しているか、誰が見てもわかるように詳細に説明してください。専門用語や部品名があればそれも使って説明してください。"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RateLimiter:
+    """
+    1秒あたりのリクエスト数を制限するスレッドセーフなレートリミッタ。
+    rate が0以下の場合は制限しない。
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next_time)
+            self._next_time = scheduled + self.interval
+        delay = scheduled - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_vision_client() -> OpenAI:
+    """
+    Vision呼び出しで共有するOpenAIクライアントを返す関数。
+    接続はワーカー数に合わせてプールし、リトライはcaption_image側で行う。
+    接続先はOPENAI_BASE_URL環境変数で差し替えられる(ローカルのフェイクサーバーなど)。
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                workers = _setting('RAG_VISION_MAX_WORKERS', 8)
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+                    timeout=_setting('RAG_VISION_TIMEOUT', 60),
+                )
+                _client = OpenAI(max_retries=0, http_client=http_client)
+    return _client
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    return False
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Retry-Afterヘッダーがあればそれに従い、無ければ指数バックオフ(ジッター付き)で待つ。
+    """
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    base = _setting('RAG_VISION_BACKOFF_BASE', 1.0)
+    return base * (2 ** attempt) + random.uniform(0, base)
+
+
+def caption_image(image_bytes: bytes, rate_limiter: RateLimiter = None) -> str:
+    """
+    画像データをOpenAIのVisionモデルに渡し、説明文を生成する関数。
+    429と5xxはバックオフしながら再試行し、最終的に失敗した場合は空文字を返す。
+    """
+    client = get_vision_client()
+    base64_image = base64.b64encode(image_bytes).decode('utf-8')
+    max_retries = _setting('RAG_VISION_MAX_RETRIES', 5)
+
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            response = client.chat.completions.create(
+                model=_setting('RAG_VISION_MODEL', 'gpt-4o'),
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": VISION_PROMPT},
+                            {
+                                "type": "image_url",
+                                "image_url": {
+                                    "url": f"data:image/jpeg;base64,{base64_image}"
+                                }
+                            }
+                        ]
+                    }
+                ],
+                max_tokens=300
+            )
+            return response.choices[0].message.content or ""
+        except Exception as e:
+            if attempt < max_retries and _is_retryable(e):
+                delay = _retry_delay(e, attempt)
+                print(f"--- Vision API: retrying in {delay:.1f}s ({e}) ---")
+                time.sleep(delay)
+                continue
+            print(f"--- Vision API Error: {e} ---")
+            return ""
+    return ""
+
+
+def caption_images(images: list):
+    """
+    複数の画像の説明文を並列に生成する関数。
+    同じ内容の画像は1回だけVisionに送り、説明文キャッシュにある画像は送らない。
+    同時実行数とレート制限は設定値に従い、説明文は入力と同じ順序で返す。
+    戻り値は (説明文のリスト, 統計情報の辞書)。
+    """
+    stats = {'images': len(images), 'cache_hits': 0, 'duplicates': 0, 'api_calls': 0}
+    if not images:
+        return [], stats
+
+    model = _setting('RAG_VISION_MODEL', 'gpt-4o')
+    keys = [caption_cache_key(image, VISION_PROMPT, model) for image in images]
+    cache = get_caption_cache()
+    known = cache.get_many(keys) if cache is not None else {}
+
+    # キャッシュに無い画像を内容ごとに1つだけ選ぶ
+    pending = {}
+    for key, image in zip(keys, images):
+        if key in known:
+            stats['cache_hits'] += 1
+        elif key in pending:
+            stats['duplicates'] += 1
+        else:
+            pending[key] = image
+
+    if pending:
+        workers = _setting('RAG_VISION_MAX_WORKERS', 8)
+        rate_limiter = RateLimiter(_setting('RAG_VISION_RATE_LIMIT', 0))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda image: caption_image(image, rate_limiter), pending.values()))
+        stats['api_calls'] = len(pending)
+        generated = {key: text for key, text in zip(pending.keys(), results) if text}
+        if cache is not None:
+            cache.set_many(generated)
+        known.update(generated)
+
+    metrics.inc('rag_vision_images_total', stats['cache_hits'], result='cache_hit')
+    metrics.inc('rag_vision_images_total', stats['duplicates'], result='duplicate')
+    metrics.inc('rag_vision_images_total', stats['api_calls'], result='api_call')
+    print(f"--- Vision API: {stats['api_calls']} calls for {stats['images']} images "
+          f"(cache hits: {stats['cache_hits']}, duplicates: {stats['duplicates']}). ---")
+    return [known.get(key, "") for key in keys], stats
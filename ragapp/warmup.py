@@ -0,0 +1,66 @@
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+
+from .models import ProcessedManual
+
+
+def recent_vectorstore_paths(limit: int) -> list:
+    """
+    最近使われた順に、取り込み済みのマニュアルのベクトルストアのパスを最大 limit 件返す関数。
+    """
+    manuals = (ProcessedManual.objects.filter(status='COMPLETED').exclude(vectorstore_path='')
+               .order_by(F('last_accessed_at').desc(nulls_last=True), '-updated_at')
+               .values_list('vectorstore_path', flat=True))
+    paths = []
+    for path in manuals.iterator():
+        if path not in paths:
+            paths.append(path)
+        if len(paths) >= limit:
+            break
+    return paths
+
+
+def warm_up(limit: int):
+    """
+    チャットで使うモジュール、OpenAIのクライアント、トークナイザーを読み込み、
+    最近使われたマニュアルのベクトルストアをキャッシュに読み込む関数。
+    """
+    from .rag_handler import get_answer_chain, get_query_embeddings, load_vectorstore, vectorstore_exists
+    from .tokens import get_encoding
+    from .vectorstore_cache import get_vectorstore_cache
+
+    started = time.perf_counter()
+    get_query_embeddings()
+    get_answer_chain()
+    get_encoding()
+    clients_time = time.perf_counter() - started
+
+    loaded = 0
+    try:
+        for path in recent_vectorstore_paths(limit):
+            if vectorstore_exists(path):
+                get_vectorstore_cache().get_or_load(path, load_vectorstore)
+                loaded += 1
+    finally:
+        close_old_connections()
+    print(f"--- Warm-up: clients {clients_time:.2f}s, {loaded} vector stores, "
+          f"total {time.perf_counter() - started:.2f}s ---")
+
+
+def start_warm_up():
+    """
+    warm_up() をバックグラウンドのスレッドで実行する。プロセスの起動はこの完了を待たない。
+    """
+    limit = getattr(settings, 'RAG_WARMUP_MANUALS', 0)
+
+    def run():
+        try:
+            warm_up(limit)
+        except Exception as e:
+            print(f"--- Warm-up failed: {e} ---")
+
+    threading.Thread(target=run, name='rag-warmup', daemon=True).start()